@@ -0,0 +1,155 @@
+import copy
+import random
+import time
+import multiprocessing as mp
+import queue
+import numpy as np
+import torch
+from torch.nn.utils import parameters_to_vector, vector_to_parameters
+from Adapter import ActionScaler, Done_adapter, Reward_adapter
+from RunningStat import RunningStat, ZFilter
+
+
+def _run_actor(env_id, params, buffer, actor, weights, stats, version, lock, steps, stop_event, \
+			   stat_queue, start_steps, total_steps, seed, stat_every):
+	'''Interaction loop of one actor process: step its own env and add the transitions to the buffer'''
+	import gym
+	import gym_carla
+	torch.set_num_threads(1)
+	torch.manual_seed(seed)
+	np.random.seed(seed)
+	random.seed(seed)
+	env = gym.make(env_id, params=params)
+	env.seed(seed)
+	env.action_space.seed(seed)
+	action_scaler = ActionScaler(env.act_low, env.act_high)
+	weights, stats = np.frombuffer(weights, dtype=np.float32), np.frombuffer(stats, dtype=np.float64)
+	running_state = ZFilter((env.observation_space.shape[0],), clip=5.0)
+	local_version = -1
+	# raw observations of this actor not merged into the statistics of the learner yet
+	new_stat = RunningStat(running_state.rs.shape)
+
+	def observe(s):
+		new_stat.push(s)
+		return running_state(s, update=False)
+
+	s, current_steps = None, 0
+	while not stop_event.is_set():
+		with steps.get_lock():
+			t = steps.value
+			if t >= total_steps:
+				break
+			steps.value += 1
+		if version.value != local_version:
+			with lock:
+				vector_to_parameters(torch.from_numpy(weights.copy()), actor.parameters())
+				running_state.rs.load_state_dict({'n': stats[0], 'mean': stats[1:1 + len(new_stat.mean)], \
+												  'M2': stats[1 + len(new_stat.mean):]})
+				local_version = version.value
+		if s is None:
+			s, current_steps = observe(env.reset()), 0
+		current_steps += 1
+
+		if t < start_steps:
+			act = env.action_space.sample()
+			a = action_scaler.reverse(act)
+		else:
+			with torch.no_grad():
+				a, _ = actor(torch.FloatTensor(s.reshape(1, -1)), False, False)
+			a = a.numpy().flatten()
+			act = action_scaler(a)
+
+		ref = act
+		tra_state = np.array(env.ego_state[0]) + np.array(ref[0])
+		ref_obj = [tra_state] + list(ref[1:8])
+		ref_traj = env.ego_state + ref_obj + env.goal_state
+		_act, pred_traj = env.high_mpc.solve(ref_traj)
+
+		s_prime, r, done, info = env.step(_act)
+		s_prime = observe(s_prime)
+		if type(r) == tuple:
+			r = np.array(list(r))
+		dead = Done_adapter(r, done, current_steps)
+		r = Reward_adapter(r)
+		buffer.add(s, a, r, s_prime, dead, done)
+		s = None if done else s_prime
+
+		if new_stat.n >= stat_every:
+			stat_queue.put(new_stat)
+			new_stat = RunningStat(new_stat.shape)
+	if new_stat.n:
+		stat_queue.put(new_stat)
+	buffer.close()
+
+
+class ActorPool(object):
+	'''Collect transitions with num_actors processes, each stepping its own env, into a SharedBuffer.
+
+	Every actor acts with a copy of the actor network and normalizes its states with the ZFilter
+	statistics of the learner, both reloaded when publish() bumps their version. The actors push
+	their raw observations into RunningStats sent every stat_every of them, which poll() merges
+	into the learner's ZFilter. Actions are random for the first start_steps steps of all actors.
+	With ports, actor i connects its env to ports[i], one CARLA server each.
+	'''
+	def __init__(self, env_id, params, buffer, actor, running_state, num_actors, start_steps, total_steps, \
+				 ports=None, seed=0, stat_every=100):
+		ctx = mp.get_context('spawn')
+		self.buffer = buffer
+		self.running_state = running_state
+		self.total_steps = total_steps
+		n = len(parameters_to_vector(actor.parameters()))
+		self.weights = ctx.RawArray('f', n)
+		self.stats = ctx.RawArray('d', 1 + 2 * int(np.prod(running_state.rs.shape)))
+		self.version = ctx.RawValue('q', 0)
+		self.lock = ctx.Lock()
+		self.steps = ctx.Value('q', 0)
+		self.stop_event = ctx.Event()
+		self.stat_queue = ctx.Queue()
+		self.publish(actor)
+
+		actor = copy.deepcopy(actor).cpu()
+		self.processes = []
+		for i in range(num_actors):
+			actor_params = dict(params, port=ports[i]) if ports else params
+			self.processes.append(ctx.Process(target=_run_actor, daemon=True, args=(env_id, actor_params, buffer, \
+				actor, self.weights, self.stats, self.version, self.lock, self.steps, self.stop_event, \
+				self.stat_queue, start_steps, total_steps, seed + i, stat_every)))
+
+	def start(self, step=0):
+		'''Start the actors, counting the steps from step'''
+		self.steps.value = step
+		for process in self.processes:
+			process.start()
+
+	def publish(self, actor):
+		'''Publish the weights of the actor and the statistics of the ZFilter to the actors'''
+		state = self.running_state.rs.state_dict()
+		with self.lock:
+			np.frombuffer(self.weights, dtype=np.float32)[:] = parameters_to_vector(actor.parameters()).detach().cpu().numpy()
+			np.frombuffer(self.stats, dtype=np.float64)[:] = np.concatenate([[state['n']], state['mean'].ravel(), state['M2'].ravel()])
+			self.version.value += 1
+
+	def poll(self):
+		'''Merge the statistics sent by the actors and return the steps taken so far'''
+		while True:
+			try:
+				self.running_state.rs.merge(self.stat_queue.get_nowait())
+			except queue.Empty:
+				break
+		for i, process in enumerate(self.processes):
+			if process.exitcode not in (None, 0):
+				raise RuntimeError('actor process {} exited with code {}'.format(i, process.exitcode))
+		return self.steps.value
+
+	@property
+	def done(self):
+		return all(not process.is_alive() for process in self.processes)
+
+	def close(self):
+		'''Stop the actors, merge their last statistics and free the buffer'''
+		self.stop_event.set()
+		while not self.done:
+			self.poll()
+			time.sleep(0.01)
+		self.poll()
+		self.buffer.unlink()
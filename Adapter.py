@@ -30,3 +30,30 @@ def Action_adapter_reverse(act, act_low, act_high):#(act,max_action):
     for dim in range(len(act)):
         action += [((act[dim]-((act_low[dim]+act_high[dim])/2))/((abs(act_high[dim]-act_low[dim]))/2)).tolist()]
     return  action
+
+class ActionScaler(object):
+    '''Array version of Action_adapter and Action_adapter_reverse, for actions of shape (..., action_dim).
+
+    The offset and scale are computed once, results are NumPy arrays, written into out if given
+    (e.g. out=act to map in place). The maps are computed in float64: for float64 actions they give
+    exactly the values of the per-dimension functions, float32 actions (e.g. the policy output) may
+    differ by about 1e-7 relative, as Action_adapter rounds act * |high - low| to float32 first.
+    '''
+    def __init__(self, act_low, act_high):
+        # in the dtype of the bounds, as Action_adapter does, then in float64
+        act_low = np.asarray(act_low)
+        act_high = np.asarray(act_high)
+        self.offset = ((act_low + act_high) / 2).astype(float)
+        self.scale = (np.abs(act_high - act_low) / 2).astype(float)
+
+    def __call__(self, act, out=None):
+        #from [-1,1] to [-max,max]
+        out = np.multiply(act, self.scale, out=out)
+        out += self.offset
+        return out
+
+    def reverse(self, act, out=None):
+        #from [-max,max] to [-1,1]
+        out = np.subtract(act, self.offset, out=out)
+        out /= self.scale
+        return out
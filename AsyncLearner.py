@@ -0,0 +1,127 @@
+import copy
+import threading
+import time
+import torch
+from torch.nn.utils import parameters_to_vector, vector_to_parameters
+from ReplayBuffer import BatchPrefetcher, device
+from SAC import NumpyPolicy
+
+
+class AsyncLearner(object):
+	'''Train a SAC_Agent on a background thread while the interaction loop keeps stepping the env.
+
+	The learner thread runs model.train(buffer) continuously, at most utd_ratio updates per
+	transition added through add() since start(). Every publish_every updates it copies the actor
+	weights into a shared-memory vector and bumps their version; select_action() and
+	export_policy() act with a local copy of the actor, reloaded when the version changed.
+	The buffer is wrapped in a BatchPrefetcher, whose lock keeps add() and sampling apart.
+	An exception raised by the learner thread stops it and is raised again by add() and sync().
+	'''
+	def __init__(self, model, replay_buffer, utd_ratio=1.0, publish_every=50, prefetch=2):
+		self.model = model
+		if not isinstance(replay_buffer, BatchPrefetcher):
+			replay_buffer = BatchPrefetcher(replay_buffer, model.batch_size, K=prefetch)
+		self.buffer = replay_buffer
+		self.utd_ratio = utd_ratio
+		self.publish_every = publish_every
+
+		# published actor weights and their version, in shared memory
+		self.weights = parameters_to_vector(model.actor.parameters()).detach().cpu().clone().share_memory_()
+		self.version = torch.zeros(1, dtype=torch.int64).share_memory_()
+		self.publish_lock = threading.Lock()
+		self.actor = copy.deepcopy(model.actor)
+		self.actor_version = 0
+
+		# held by the learner for every update, take it to read or save the model consistently
+		self.lock = threading.Lock()
+		self.cond = threading.Condition()
+		self.stop_event = threading.Event()
+		self.thread = None
+		self.error = None
+		self.steps = 0
+		self.updates = 0
+		self.start_time = None
+
+	@property
+	def started(self):
+		return self.thread is not None
+
+	def start(self):
+		'''Start training, the update-to-data ratio counts the transitions added from now on'''
+		self.steps = 0
+		self.updates = 0
+		self.start_time = time.perf_counter()
+		self.thread = threading.Thread(target=self._work, daemon=True)
+		self.thread.start()
+
+	def add(self, state, action, reward, next_state, dead, done=False):
+		self._check()
+		self.buffer.add(state, action, reward, next_state, dead, done)
+		with self.cond:
+			self.steps += 1
+			self.cond.notify()
+
+	def _work(self):
+		try:
+			while not self.stop_event.is_set():
+				with self.cond:
+					while self.updates >= self.utd_ratio * self.steps and not self.stop_event.is_set():
+						self.cond.wait(0.1)
+				if self.stop_event.is_set():
+					break
+				with self.lock:
+					self.model.train(self.buffer)
+				self.updates += 1
+				if self.updates % self.publish_every == 0:
+					self.publish()
+		except Exception as e:
+			# the thread is a daemon, nobody would see it fail otherwise
+			self.error = e
+
+	def _check(self):
+		if self.error is not None:
+			raise self.error
+
+	def publish(self):
+		'''Copy the actor weights of the model into the shared vector, as a new version'''
+		with self.publish_lock:
+			self.weights.copy_(parameters_to_vector(self.model.actor.parameters()).detach())
+			self.version += 1
+
+	def sync(self):
+		'''Load the last published weights into the local actor, if newer'''
+		self._check()
+		version = int(self.version)
+		if version != self.actor_version:
+			with self.publish_lock:
+				vector_to_parameters(self.weights.to(device), self.actor.parameters())
+				self.actor_version = int(self.version)
+
+	def select_action(self, state, deterministic, with_logprob=False):
+		self.sync()
+		with torch.no_grad():
+			state = torch.FloatTensor(state.reshape(1, -1)).to(device)
+			a, _ = self.actor(state, deterministic, with_logprob)
+		return a.cpu().numpy().flatten()
+
+	def export_policy(self):
+		self.sync()
+		return NumpyPolicy(self.actor)
+
+	def save(self, episode):
+		with self.lock:
+			self.model.save(episode)
+
+	def stats(self):
+		elapsed = time.perf_counter() - self.start_time if self.start_time else 0.0
+		return {'steps': self.steps, 'updates': self.updates, 'version': int(self.version), \
+				'updates_per_s': self.updates / max(elapsed, 1e-9)}
+
+	def close(self):
+		self.stop_event.set()
+		with self.cond:
+			self.cond.notify()
+		if self.thread is not None:
+			self.thread.join()
+			self.thread = None
+		self.buffer.close()
@@ -0,0 +1,76 @@
+import copy
+import os
+import random
+import threading
+import numpy as np
+import torch
+
+# bumped whenever the layout of the bundle changes
+CHECKPOINT_VERSION = 1
+
+
+def get_rng_state():
+	'''States of the python, numpy and torch random generators'''
+	return {
+		'python': random.getstate(),
+		'numpy': np.random.get_state(),
+		'torch': torch.get_rng_state(),
+		'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None
+	}
+
+
+def set_rng_state(state):
+	random.setstate(state['python'])
+	np.random.set_state(state['numpy'])
+	torch.set_rng_state(state['torch'])
+	if state['cuda'] is not None and torch.cuda.is_available():
+		torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class CheckpointWriter(object):
+	'''Write checkpoint bundles to path on a background thread.
+
+	write() snapshots the bundle with a deep copy on the calling thread, so training can go on
+	while the copy is pickled to a temporary file, fsynced and renamed over path. A crash leaves
+	either the previous bundle or the new one. A write waits for the previous one to finish.
+	'''
+	def __init__(self, path):
+		self.path = path
+		self.thread = None
+		self.error = None
+		directory = os.path.dirname(path)
+		if directory:
+			os.makedirs(directory, exist_ok=True)
+
+	def write(self, bundle):
+		self.wait()
+		bundle = dict(copy.deepcopy(bundle), version=CHECKPOINT_VERSION)
+		self.thread = threading.Thread(target=self._write, args=(bundle,), daemon=True)
+		self.thread.start()
+
+	def _write(self, bundle):
+		tmp_path = self.path + '.tmp'
+		try:
+			with open(tmp_path, 'wb') as f:
+				torch.save(bundle, f, pickle_protocol=4)
+				f.flush()
+				os.fsync(f.fileno())
+			os.replace(tmp_path, self.path)
+		except Exception as e:
+			self.error = e
+
+	def wait(self):
+		'''Wait for the last write, and raise its error if it failed'''
+		if self.thread is not None:
+			self.thread.join()
+			self.thread = None
+		if self.error is not None:
+			error, self.error = self.error, None
+			raise error
+
+
+def load_checkpoint(path):
+	bundle = torch.load(path, map_location='cpu', weights_only=False)
+	if bundle.get('version') != CHECKPOINT_VERSION:
+		raise ValueError('{} is a version {} checkpoint, expected version {}'.format(path, bundle.get('version'), CHECKPOINT_VERSION))
+	return bundle
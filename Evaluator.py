@@ -0,0 +1,95 @@
+import copy
+import functools
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from Adapter import ActionScaler
+
+
+def run_episode(env, policy, running_state, render=False):
+	'''One episode of the policy driving the MPC references, returns the sum of the rewards'''
+	s, done, ep_r = env.reset(), False, 0
+	action_scaler = ActionScaler(env.act_low, env.act_high)
+
+	s = running_state(s)
+	while not done:
+		a = policy(s)
+		act = action_scaler(a)  # [0,1] to [-max,max]
+
+		ref = act
+		tra_state = np.array(env.ego_state[0]) + np.array(ref[0])
+		ref_obj = [tra_state] + list(ref[1:8])
+
+		# compute the mpc reference
+		ref_traj = env.ego_state + ref_obj + env.goal_state
+		# run  model predictive control
+		_act, pred_traj = env.high_mpc.solve(ref_traj)
+
+		s_prime, r, done, info = env.step(_act)
+
+		s_prime = running_state(s_prime)
+		if type(r) == tuple:
+			r = np.array(list(r))
+		ep_r += r
+
+		s = s_prime
+
+		if render:
+			env.render()
+	return ep_r
+
+
+# the env of a worker process, built once by _init_worker
+_env = None
+
+
+def _init_worker(env_id, params, ports, counter):
+	global _env
+	import gym
+	import gym_carla
+	with counter.get_lock():
+		worker = counter.value
+		counter.value += 1
+	if ports:
+		params = dict(params, port=ports[worker % len(ports)])
+	_env = gym.make(env_id, params=params)
+
+
+def _evaluate_episode(policy, running_state):
+	# the snapshot of the ZFilter stays frozen
+	return run_episode(_env, policy, functools.partial(running_state, update=False))
+
+
+class Evaluator(object):
+	'''Evaluate snapshots of the policy on a pool of worker processes, each with its own env.
+
+	submit() sends eval_turn episodes of a frozen policy (e.g. SAC_Agent.export_policy()) and
+	ZFilter and returns at once; poll() returns the (step, average score) of the evaluations
+	finished since, in submission order. With ports, worker i connects its env to ports[i], one
+	CARLA server each; without, the workers use params['port'].
+	'''
+	def __init__(self, env_id, params, num_workers, eval_turn, ports=None):
+		ctx = mp.get_context('spawn')
+		self.eval_turn = eval_turn
+		self.pool = ProcessPoolExecutor(num_workers, mp_context=ctx, initializer=_init_worker, \
+										initargs=(env_id, params, ports, ctx.Value('i', 0)))
+		self.pending = []
+
+	def submit(self, step, policy, running_state):
+		running_state = copy.deepcopy(running_state)
+		futures = [self.pool.submit(_evaluate_episode, policy, running_state) for _ in range(self.eval_turn)]
+		self.pending.append((step, futures))
+
+	def poll(self, wait=False):
+		'''(step, score) of the finished evaluations, all of them with wait'''
+		results = []
+		while self.pending and (wait or all(f.done() for f in self.pending[0][1])):
+			step, futures = self.pending.pop(0)
+			results.append((step, sum(f.result() for f in futures) / len(futures)))
+		return results
+
+	def close(self):
+		'''Wait for the pending evaluations, and return them as poll() does'''
+		results = self.poll(wait=True)
+		self.pool.shutdown()
+		return results
@@ -1,11 +1,26 @@
 import numpy as np
 import torch
 import os
+import json
+import queue
+import threading
+import time
+import collections
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from SegmentTree import SumSegmentTree, MinSegmentTree
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
 class RandomBuffer(object):
-	def __init__(self, state_dim, action_dim, Env_with_dead , max_size=int(1e6)):
+	# prioritized buffers also return importance weights and indices from sample()
+	prioritized = False
+	# whether sample() overwrites the tensors it returned before
+	reuses_outputs = False
+	# arrays of the transitions, in state_dict()
+	state_arrays = ('state', 'action', 'reward', 'next_state', 'dead', 'discount')
+
+	def __init__(self, state_dim, action_dim, Env_with_dead , max_size=int(1e6), n_step=1, gamma=0.99):
 		self.max_size = max_size
 		self.ptr = 0
 		self.size = 0
@@ -16,11 +31,45 @@ class RandomBuffer(object):
 		self.reward = np.zeros((max_size, 1))
 		self.next_state = np.zeros((max_size, state_dim))
 		self.dead = np.zeros((max_size, 1),dtype=np.uint8)
+		self.discount = np.zeros((max_size, 1))
 
+		self._init_n_step(n_step, gamma)
 		self.device = device
 
+	def _init_n_step(self, n_step, gamma):
+		'''With n_step > 1, add() stores n-step returns and sample() also returns the discount of each transition'''
+		self.n_step = n_step
+		self.gamma = gamma
+		self._pending = collections.deque()   # (state, action, reward) of the last steps, not stored yet
+
+
+	def add(self, state, action, reward, next_state, dead, done=False):
+		'''Store a transition, with n_step > 1 as the n-step transition of the oldest pending state.
+
+		The step from state k steps back is stored as (state, action, sum of gamma^i reward_i, next_state,
+		dead, gamma^k). Once n steps are pending the oldest one is stored, all of them are stored when
+		the episode ends (dead or done), bootstrapping from the last next_state unless dead.
+		'''
+		if self.n_step == 1:
+			self._store(state, action, reward, next_state, dead, self.gamma)
+			return
+		self._pending.append((np.array(state), np.array(action), reward))
+		if dead or done:
+			while self._pending:
+				self._store_pending(next_state, dead)
+		elif len(self._pending) == self.n_step:
+			self._store_pending(next_state, False)
+
+	def _store_pending(self, next_state, dead):
+		'''Store the oldest pending step, with the return of all the pending rewards'''
+		ret, discount = 0.0, 1.0
+		for _, _, reward in self._pending:
+			ret = ret + discount * reward
+			discount *= self.gamma
+		state, action, _ = self._pending.popleft()
+		self._store(state, action, ret, next_state, dead, discount)
 
-	def add(self, state, action, reward, next_state, dead):
+	def _store(self, state, action, reward, next_state, dead, discount):
 		self.state[self.ptr] = state
 		self.action[self.ptr] = action
 		self.reward[self.ptr] = reward
@@ -31,6 +80,7 @@ class RandomBuffer(object):
 			self.dead[self.ptr] = dead
 		else:
 			self.dead[self.ptr] = False
+		self.discount[self.ptr] = discount
 
 		self.ptr = (self.ptr + 1) % self.max_size
 		self.size = min(self.size + 1, self.max_size)
@@ -39,13 +89,16 @@ class RandomBuffer(object):
 	def sample(self, batch_size):
 		ind = np.random.randint(0, self.size, size=batch_size)
 		with torch.no_grad():
-			return (
+			batch = (
 				torch.FloatTensor(self.state[ind]).to(self.device),
 				torch.FloatTensor(self.action[ind]).to(self.device),
 				torch.FloatTensor(self.reward[ind]).to(self.device),
 				torch.FloatTensor(self.next_state[ind]).to(self.device),
 				torch.FloatTensor(self.dead[ind]).to(self.device)
 			)
+			if self.n_step > 1:
+				batch += (torch.FloatTensor(self.discount[ind]).to(self.device),)
+			return batch
 
 	def save(self):
 		'''save the replay buffer if you want'''
@@ -56,6 +109,26 @@ class RandomBuffer(object):
 		np.save("buffer/reward.npy", self.reward)
 		np.save("buffer/next_state.npy", self.next_state)
 		np.save("buffer/dead.npy", self.dead)
+		np.save("buffer/discount.npy", self.discount)
+
+	def _stored(self):
+		'''Number of leading slots in use'''
+		return self.size
+
+	def state_dict(self):
+		'''Stored transitions (views, copy them to keep a snapshot), ring position and pending n-step steps'''
+		n = self._stored()
+		state = {name: getattr(self, name)[:n] for name in self.state_arrays}
+		state.update(ptr=int(self.ptr), size=int(self.size), pending=list(self._pending))
+		return state
+
+	def load_state_dict(self, state):
+		n = len(state[self.state_arrays[0]])
+		for name in self.state_arrays:
+			getattr(self, name)[:n] = state[name]
+		self.ptr = state['ptr']
+		self.size = state['size']
+		self._pending = collections.deque(state['pending'])
 
 	def load(self):
 		scaller = np.load("buffer/scaller.npy")
@@ -70,4 +143,694 @@ class RandomBuffer(object):
 		self.reward = np.load("buffer/reward.npy")
 		self.next_state = np.load("buffer/next_state.npy")
 		self.dead = np.load("buffer/dead.npy")
+		if os.path.exists("buffer/discount.npy"):
+			self.discount = np.load("buffer/discount.npy")
+
+
+class TensorBuffer(RandomBuffer):
+	'''RandomBuffer keeping float32 (uint8 for dead) torch tensors, sampled without temporary copies.
+
+	add() writes through numpy views of the tensors. sample() gathers with torch.index_select
+	into output tensors reused across calls, so a batch is only valid until the next sample().
+	With pin_memory the storage and outputs are page-locked, for asynchronous copies to the GPU.
+	'''
+	reuses_outputs = True
+
+	def __init__(self, state_dim, action_dim, Env_with_dead , max_size=int(1e6), pin_memory=False, n_step=1, gamma=0.99):
+		self.max_size = max_size
+		self.ptr = 0
+		self.size = 0
+		self.Env_with_dead = Env_with_dead
+		self.pin_memory = pin_memory and torch.cuda.is_available()
+
+		self.state_t = self._empty((max_size, state_dim), torch.float32)
+		self.action_t = self._empty((max_size, action_dim), torch.float32)
+		self.reward_t = self._empty((max_size, 1), torch.float32)
+		self.next_state_t = self._empty((max_size, state_dim), torch.float32)
+		self.dead_t = self._empty((max_size, 1), torch.uint8)
+		self.discount_t = self._empty((max_size, 1), torch.float32)
+
+		# numpy views sharing memory with the tensors, used by add(), save() and load()
+		self.state = self.state_t.numpy()
+		self.action = self.action_t.numpy()
+		self.reward = self.reward_t.numpy()
+		self.next_state = self.next_state_t.numpy()
+		self.dead = self.dead_t.numpy()
+		self.discount = self.discount_t.numpy()
+
+		self._init_n_step(n_step, gamma)
+		self.device = device
+		self._batch_size = None
+
+	def _empty(self, shape, dtype):
+		return torch.zeros(shape, dtype=dtype, pin_memory=self.pin_memory)
+
+	def _alloc_outputs(self, batch_size):
+		'''Allocate the gather outputs on the host, and their copies on the device'''
+		self._batch_size = batch_size
+		self._ind = torch.empty(batch_size, dtype=torch.int64)
+		self._host = [self._empty((batch_size,) + tuple(t.shape[1:]), t.dtype) for t in self._storage()]
+		self._host_dead = self._empty((batch_size, 1), torch.float32)
+		# dead as float, then the discount when n_step > 1
+		self._host_out = self._host[:4] + [self._host_dead] + self._host[5:]
+		self._copied = None
+		if self.device.type == 'cpu':
+			self._out = self._host_out
+		else:
+			self._out = [torch.empty(t.shape, dtype=torch.float32, device=self.device) for t in self._host_out]
+			if self.pin_memory:
+				self._copied = torch.cuda.Event()
+
+	def _storage(self):
+		storage = [self.state_t, self.action_t, self.reward_t, self.next_state_t, self.dead_t]
+		if self.n_step > 1:
+			storage.append(self.discount_t)
+		return storage
+
+	def sample(self, batch_size):
+		if batch_size != self._batch_size:
+			self._alloc_outputs(batch_size)
+		with torch.no_grad():
+			# the host outputs are reused, wait until the last asynchronous copy has read them
+			if self._copied is not None:
+				self._copied.synchronize()
+			self._gather()
+			self._host_dead.copy_(self._host[4])
+			if self.device.type != 'cpu':
+				for host, out in zip(self._host_out, self._out):
+					out.copy_(host, non_blocking=self.pin_memory)
+				if self._copied is not None:
+					self._copied.record()
+			return tuple(self._out)
+
+	def _gather(self):
+		'''Draw the batch indices and gather the transitions into the host outputs'''
+		self._ind.random_(0, self.size)
+		self._gather_ind()
+
+	def _gather_ind(self):
+		for t, out in zip(self._storage(), self._host):
+			torch.index_select(t, 0, self._ind, out=out)
+
+	def load(self):
+		'''load into the existing storage, keeping the numpy views attached to the tensors'''
+		scaller = np.load("buffer/scaller.npy")
+		assert scaller[0] == self.max_size, 'buffer/ was saved with a different max_size'
+
+		self.ptr = scaller[1]
+		self.size = scaller[2]
+		self.Env_with_dead = scaller[3]
+
+		self.state[...] = np.load("buffer/state.npy")
+		self.action[...] = np.load("buffer/action.npy")
+		self.reward[...] = np.load("buffer/reward.npy")
+		self.next_state[...] = np.load("buffer/next_state.npy")
+		self.dead[...] = np.load("buffer/dead.npy")
+		if os.path.exists("buffer/discount.npy"):
+			self.discount[...] = np.load("buffer/discount.npy")
+
+
+class LinkedBuffer(TensorBuffer):
+	'''TensorBuffer storing every observation once, next_state is found by index.
+
+	Slot k holds an observation, and, when valid[k], the transition from it to the observation in
+	slot k+1. After each add() the slot at ptr holds the pending next_state. If the next add()
+	starts from that observation (s == last s_prime, as in main.py) the transition is appended
+	behind it, otherwise it stays the final observation of its episode and a new slot is opened.
+	Observation memory is halved, at the cost of one slot per episode. Since next_state is the
+	following observation, transitions are always one-step (n_step = 1).
+	'''
+	state_arrays = ('obs', 'action', 'reward', 'dead', 'valid')
+
+	def __init__(self, state_dim, action_dim, Env_with_dead , max_size=int(1e6), pin_memory=False):
+		self.max_size = max_size
+		self.ptr = 0
+		self.size = 0
+		self.filled = 0
+		self.Env_with_dead = Env_with_dead
+		self.pin_memory = pin_memory and torch.cuda.is_available()
+
+		self.obs_t = self._empty((max_size, state_dim), torch.float32)
+		self.action_t = self._empty((max_size, action_dim), torch.float32)
+		self.reward_t = self._empty((max_size, 1), torch.float32)
+		self.dead_t = self._empty((max_size, 1), torch.uint8)
+		self.valid_t = torch.zeros(max_size, dtype=torch.bool)
+
+		self.obs = self.obs_t.numpy()
+		self.action = self.action_t.numpy()
+		self.reward = self.reward_t.numpy()
+		self.dead = self.dead_t.numpy()
+		self.valid = self.valid_t.numpy()
+
+		# the pending next_state in full precision, to recognize the next state of the episode
+		self._last_next = None
+
+		self._init_n_step(1, 0.99)
+		self.device = device
+		self._batch_size = None
+
+	def _storage(self):
+		return [self.obs_t, self.action_t, self.reward_t, self.obs_t, self.dead_t]
+
+	def _alloc_outputs(self, batch_size):
+		TensorBuffer._alloc_outputs(self, batch_size)
+		self._next_ind = torch.empty(batch_size, dtype=torch.int64)
+
+	def _write_obs(self, obs):
+		'''Write an observation into the slot at ptr, dropping the transition stored there'''
+		self.size -= int(self.valid[self.ptr])
+		self.valid[self.ptr] = False
+		self.obs[self.ptr] = obs
+		self.filled = min(self.filled + 1, self.max_size)
+
+	def add(self, state, action, reward, next_state, dead, done=False):
+		if self._last_next is None or not np.array_equal(state, self._last_next):
+			# a new episode, the pending slot keeps the final observation of the last one
+			if self._last_next is not None:
+				self.ptr = (self.ptr + 1) % self.max_size
+			self._write_obs(state)
+
+		self.action[self.ptr] = action
+		self.reward[self.ptr] = reward
+		if self.Env_with_dead:
+			self.dead[self.ptr] = dead
+		else:
+			self.dead[self.ptr] = False
+		self.valid[self.ptr] = True
+		self.size += 1
+
+		self.ptr = (self.ptr + 1) % self.max_size
+		self._write_obs(next_state)
+		self._last_next = np.array(next_state)
+
+	def _gather(self):
+		# rejection sampling of the slots holding a transition, nearly all of them
+		self._ind.random_(0, self.filled)
+		invalid = ~self.valid_t[self._ind]
+		while invalid.any():
+			self._ind[invalid] = torch.randint(0, self.filled, (int(invalid.sum()),))
+			invalid = ~self.valid_t[self._ind]
+		torch.add(self._ind, 1, out=self._next_ind)
+		self._next_ind.remainder_(self.max_size)
+		torch.index_select(self.obs_t, 0, self._ind, out=self._host[0])
+		torch.index_select(self.action_t, 0, self._ind, out=self._host[1])
+		torch.index_select(self.reward_t, 0, self._ind, out=self._host[2])
+		torch.index_select(self.obs_t, 0, self._next_ind, out=self._host[3])
+		torch.index_select(self.dead_t, 0, self._ind, out=self._host[4])
+
+	def _stored(self):
+		return self.filled
+
+	def state_dict(self):
+		state = TensorBuffer.state_dict(self)
+		state.update(filled=int(self.filled), last_next=self._last_next)
+		return state
+
+	def load_state_dict(self, state):
+		TensorBuffer.load_state_dict(self, state)
+		self.filled = state['filled']
+		self._last_next = state['last_next']
+
+	def save(self):
+		'''save the replay buffer if you want'''
+		scaller = np.array([self.max_size,self.ptr,self.size,self.Env_with_dead,self.filled],dtype=np.uint32)
+		np.save("buffer/scaller.npy",scaller)
+		np.save("buffer/obs.npy", self.obs)
+		np.save("buffer/action.npy", self.action)
+		np.save("buffer/reward.npy", self.reward)
+		np.save("buffer/dead.npy", self.dead)
+		np.save("buffer/valid.npy", self.valid)
+		np.save("buffer/last_next.npy", self._last_next)
+
+	def load(self):
+		scaller = np.load("buffer/scaller.npy")
+		assert scaller[0] == self.max_size, 'buffer/ was saved with a different max_size'
+
+		self.ptr = scaller[1]
+		self.size = scaller[2]
+		self.Env_with_dead = scaller[3]
+		self.filled = scaller[4]
+
+		self.obs[...] = np.load("buffer/obs.npy")
+		self.action[...] = np.load("buffer/action.npy")
+		self.reward[...] = np.load("buffer/reward.npy")
+		self.dead[...] = np.load("buffer/dead.npy")
+		self.valid[...] = np.load("buffer/valid.npy")
+		self._last_next = np.load("buffer/last_next.npy", allow_pickle=True)
+		if self._last_next.shape == ():
+			self._last_next = None
+
+
+class PrioritizedBuffer(TensorBuffer):
+	'''TensorBuffer sampling transitions proportionally to priority^alpha (prioritized experience replay).
+
+	sample() returns (s, a, r, s_prime, dead, weights, ind), with the discount before weights
+	when n_step > 1: the importance-sampling weights
+	(batch, 1) correct the bias of the Q loss, and the priorities of ind are then updated
+	from the TD errors with update_priorities(). beta grows by beta_increment per sample, up to 1.
+	'''
+	prioritized = True
+
+	def __init__(self, state_dim, action_dim, Env_with_dead , max_size=int(1e6), pin_memory=False, n_step=1, gamma=0.99, \
+				 alpha=0.6, beta=0.4, beta_increment=1e-6, eps=1e-6):
+		super(PrioritizedBuffer, self).__init__(state_dim, action_dim, Env_with_dead, max_size, pin_memory, n_step, gamma)
+		self.alpha = alpha
+		self.beta = beta
+		self.beta_increment = beta_increment
+		self.eps = eps
+		self.max_priority = 1.0
+
+		self.sum_tree = SumSegmentTree(max_size)
+		self.min_tree = MinSegmentTree(max_size)
+
+	def _store(self, state, action, reward, next_state, dead, discount):
+		# new transitions get the highest priority seen, so they are replayed at least once
+		ptr = self.ptr
+		TensorBuffer._store(self, state, action, reward, next_state, dead, discount)
+		self.sum_tree[[ptr]] = self.max_priority ** self.alpha
+		self.min_tree[[ptr]] = self.max_priority ** self.alpha
+
+	def _gather(self):
+		# stratified proportional sampling, one draw in each of batch_size equal segments of the total
+		total = self.sum_tree.sum()
+		prefixsum = (np.arange(self._batch_size) + np.random.rand(self._batch_size)) * (total / self._batch_size)
+		ind = np.minimum(self.sum_tree.find_prefixsum_idx(prefixsum), self.size - 1)
+		self._ind.copy_(torch.from_numpy(ind))
+		TensorBuffer._gather_ind(self)
+
+		# importance-sampling weights, normalized by the largest one
+		self.beta = min(1.0, self.beta + self.beta_increment)
+		p_min = self.min_tree.min() / total
+		max_weight = (p_min * self.size) ** (-self.beta)
+		p = self.sum_tree[ind] / total
+		self._weights = (p * self.size) ** (-self.beta) / max_weight
+		self._sampled_ind = ind
+
+	def sample(self, batch_size):
+		batch = TensorBuffer.sample(self, batch_size)
+		weights = torch.as_tensor(self._weights, dtype=torch.float32).reshape(-1, 1).to(self.device)
+		return batch + (weights, self._sampled_ind)
+
+	def update_priorities(self, ind, td_errors):
+		'''Set the priorities of the transitions ind to |td_errors| + eps'''
+		priorities = np.abs(td_errors) + self.eps
+		self.sum_tree[ind] = priorities ** self.alpha
+		self.min_tree[ind] = priorities ** self.alpha
+		self.max_priority = max(self.max_priority, float(priorities.max()))
+
+	def state_dict(self):
+		state = TensorBuffer.state_dict(self)
+		state.update(sum_tree=self.sum_tree.value, min_tree=self.min_tree.value, \
+					 max_priority=self.max_priority, beta=self.beta)
+		return state
+
+	def load_state_dict(self, state):
+		TensorBuffer.load_state_dict(self, state)
+		self.sum_tree.value[...] = state['sum_tree']
+		self.min_tree.value[...] = state['min_tree']
+		self.max_priority = state['max_priority']
+		self.beta = state['beta']
+
+
+class MemmapBuffer(TensorBuffer):
+	'''TensorBuffer living in np.memmap files under buffer_dir, saved by a flush and reopened lazily.
+
+	The arrays are written in place. save() flushes them to disk, then atomically replaces
+	meta.json (ptr, size, shapes), so a crash, even in the middle of save(), leaves the last saved
+	metadata pointing to complete files. Constructing the buffer on an existing buffer_dir
+	reopens it without reading the arrays.
+
+	The transitions sampled are the size slots before ptr on the ring. Before add() writes past
+	the slots announced in meta.json, it announces the next reserve_slots ones there, so meta.json
+	bounds the slots that may have been overwritten since the last save(). Reopening drops those
+	from the saved ones, as load_state_dict() drops the slots written after its state was taken:
+	after a crash the buffer holds the saved transitions that were not overwritten since. A
+	resumed run thus only matches an uninterrupted one if the ring did not wrap onto them.
+	'''
+	# slots announced in meta.json at a time, before add() writes them
+	reserve_slots = 1024
+
+	def __init__(self, state_dim, action_dim, Env_with_dead , max_size=int(1e6), buffer_dir='buffer', n_step=1, gamma=0.99):
+		self.max_size = max_size
+		self.ptr = 0
+		self.size = 0
+		self.Env_with_dead = Env_with_dead
+		self.pin_memory = False
+		self.buffer_dir = buffer_dir
+		self.meta_path = os.path.join(buffer_dir, 'meta.json')
+		os.makedirs(buffer_dir, exist_ok=True)
+
+		shapes = {'state': (max_size, state_dim), 'action': (max_size, action_dim), 'reward': (max_size, 1), \
+				  'next_state': (max_size, state_dim), 'dead': (max_size, 1), 'discount': (max_size, 1)}
+		resume = os.path.exists(self.meta_path)
+		if resume:
+			with open(self.meta_path) as f:
+				meta = json.load(f)
+			if meta['max_size'] != max_size or meta['state_dim'] != state_dim or meta['action_dim'] != action_dim:
+				raise ValueError('{} holds a buffer of another shape: {}'.format(buffer_dir, meta))
+			if meta.get('n_step', 1) != n_step:
+				raise ValueError('{} holds {}-step transitions, not {}-step'.format(buffer_dir, meta.get('n_step', 1), n_step))
+
+		for name, shape in shapes.items():
+			dtype = np.uint8 if name == 'dead' else np.float32
+			path = os.path.join(buffer_dir, name + '.dat')
+			mode = 'r+' if resume and os.path.exists(path) else 'w+'
+			setattr(self, name, np.memmap(path, dtype=dtype, mode=mode, shape=shape))
+			setattr(self, name + '_t', torch.from_numpy(getattr(self, name)))
+
+		self.state_dim = state_dim
+		self.action_dim = action_dim
+		self._init_n_step(n_step, gamma)
+		self.device = device
+		self._batch_size = None
+		self.total = 0        # transitions stored since the buffer was created
+		self._reserved = 0    # self.total may grow up to this before meta.json is rewritten
+		self._written = 0     # bound of the transitions a crashed run wrote into the files
+		if resume:
+			self.load()
+		else:
+			self.save()
+
+	def _store(self, state, action, reward, next_state, dead, discount):
+		if self.total >= self._reserved:
+			self._reserved = self.total + min(self.reserve_slots, self.max_size)
+			self._write_meta(dict(self._meta, reserved=self._reserved))
+		super()._store(state, action, reward, next_state, dead, discount)
+		self.total += 1
+
+	def _gather(self):
+		self._ind.random_(0, self.size)
+		# the valid slots of a ring reopened after a crash do not start at 0
+		first = (self.ptr - self.size) % self.max_size
+		if self.size < self.max_size and first:
+			self._ind.add_(first).remainder_(self.max_size)
+		self._gather_ind()
+
+	def save(self):
+		'''flush the arrays, then publish ptr and size'''
+		for array in [self.state, self.action, self.reward, self.next_state, self.dead, self.discount]:
+			array.flush()
+		self._reserved = self.total
+		self._meta = {'max_size': int(self.max_size), 'ptr': int(self.ptr), 'size': int(self.size), \
+					  'Env_with_dead': bool(self.Env_with_dead), 'state_dim': self.state_dim, 'action_dim': self.action_dim, \
+					  'n_step': self.n_step, 'total': int(self.total), 'reserved': int(self.total)}
+		self._write_meta(self._meta)
+
+	def _write_meta(self, meta):
+		tmp_path = self.meta_path + '.tmp'
+		with open(tmp_path, 'w') as f:
+			json.dump(meta, f)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp_path, self.meta_path)
+		# make the rename itself durable, where directories can be opened
+		try:
+			fd = os.open(self.buffer_dir, os.O_RDONLY)
+		except OSError:
+			return
+		try:
+			os.fsync(fd)
+		except OSError:
+			pass
+		finally:
+			os.close(fd)
+
+	def state_dict(self):
+		'''save() the arrays in place, the state only holds the ring position and pending n-step steps'''
+		self.save()
+		return {'buffer_dir': self.buffer_dir, 'ptr': int(self.ptr), 'size': int(self.size), 'total': int(self.total), \
+				'pending': list(self._pending)}
+
+	def load_state_dict(self, state):
+		'''Rewind to the state, the arrays are the ones in buffer_dir, without the slots written since'''
+		self.ptr = state['ptr']
+		self.size = state['size']
+		if 'total' in state:
+			self._drop_written(max(self._written, self.total) - state['total'])
+			self.total = self._written = state['total']
+		self._pending = collections.deque(state['pending'])
+		self.save()
+
+	def _drop_written(self, written):
+		'''Drop the slots before ptr that written transitions from ptr on wrapped around onto'''
+		self.size = max(min(self.size, self.max_size - written), 0)
+
+	def load(self):
+		'''read ptr and size back, the arrays are paged in on demand'''
+		with open(self.meta_path) as f:
+			meta = json.load(f)
+		self.ptr = meta['ptr']
+		self.size = meta['size']
+		self.Env_with_dead = meta['Env_with_dead']
+		self.total = meta.get('total', self.size)
+		# the slots add() announced since the last save() may hold newer or partial transitions
+		self._written = meta.get('reserved', self.total)
+		self._drop_written(self._written - self.total)
+		self.save()
+
+
+class BatchPrefetcher(object):
+	'''Wrap a replay buffer and sample its next K minibatches on a background thread.
+
+	The thread fills a bounded queue while the optimizer works on the previous batches, so
+	sample() only pops a ready batch. add() and update_priorities() take the same lock as the
+	sampling thread, every other attribute is read from the wrapped buffer. wait_time and
+	num_batches record how long sample() waited for batches. An exception raised while sampling
+	on the thread stops it and is raised again by every following sample().
+	'''
+	def __init__(self, buffer, batch_size, K=8):
+		self.buffer = buffer
+		self.batch_size = batch_size
+		self.queue = queue.Queue(maxsize=K)
+		self.lock = threading.Lock()
+		self.stop_event = threading.Event()
+		self.thread = None
+		self.error = None
+
+		self.wait_time = 0.0
+		self.num_batches = 0
+
+	def __getattr__(self, name):
+		# only called for attributes not found on the prefetcher itself
+		return getattr(self.buffer, name)
+
+	def add(self, state, action, reward, next_state, dead, done=False):
+		with self.lock:
+			self.buffer.add(state, action, reward, next_state, dead, done)
+
+	def update_priorities(self, ind, td_errors):
+		with self.lock:
+			self.buffer.update_priorities(ind, td_errors)
+
+	def _work(self):
+		try:
+			while not self.stop_event.is_set():
+				with self.lock:
+					batch = self.buffer.sample(self.batch_size)
+					if self.buffer.reuses_outputs:
+						batch = tuple(x.clone() if torch.is_tensor(x) else x.copy() for x in batch)
+				self._put(batch)
+		except Exception as e:
+			# handed to sample(), which would wait for a batch forever otherwise
+			self._put(e)
+
+	def _put(self, item):
+		while not self.stop_event.is_set():
+			try:
+				self.queue.put(item, timeout=0.1)
+				break
+			except queue.Full:
+				pass
+
+	def sample(self, batch_size):
+		if batch_size != self.batch_size:
+			with self.lock:
+				return self.buffer.sample(batch_size)
+		if self.error is not None:
+			raise self.error
+		if self.thread is None:
+			self.thread = threading.Thread(target=self._work, daemon=True)
+			self.thread.start()
+		start_time = time.perf_counter()
+		batch = self.queue.get()
+		self.wait_time += time.perf_counter() - start_time
+		if isinstance(batch, Exception):
+			self.error = batch
+			raise batch
+		self.num_batches += 1
+		return batch
+
+	def stats(self, reset=True):
+		'''Time spent waiting for batches since the last call'''
+		stats = {'batches': self.num_batches, 'wait_time': self.wait_time, \
+				 'mean_wait_ms': 1e3 * self.wait_time / max(self.num_batches, 1)}
+		if reset:
+			self.wait_time, self.num_batches = 0.0, 0
+		return stats
+
+	def close(self):
+		self.stop_event.set()
+		if self.thread is not None:
+			self.thread.join()
+			self.thread = None
+
+
+class SharedBuffer(RandomBuffer):
+	'''RandomBuffer whose float32 arrays live in one multiprocessing.shared_memory block.
+
+	Pass the buffer to other processes (e.g. as a Process argument): they attach to the same
+	memory and can add() concurrently. A lock is held only to reserve the next ring slot, the
+	transition is then written outside of it. Every slot has a sequence number, odd while the
+	slot is written and even once it holds a transition; sample() reads it before and after
+	copying the rows (a seqlock) and redraws the slots that were empty, being written or
+	overwritten meanwhile. A slot still being written is skipped by the next actor reaching it.
+	The creating process should call unlink() once all processes are done.
+	Pass the multiprocessing context the actor processes are started from as ctx. With n_step > 1
+	every process keeps the pending steps of its own episodes.
+	'''
+	def __init__(self, state_dim, action_dim, Env_with_dead , max_size=int(1e6), ctx=None, n_step=1, gamma=0.99):
+		self.max_size = max_size
+		self.Env_with_dead = Env_with_dead
+		self.state_dim = state_dim
+		self.action_dim = action_dim
+		ctx = ctx or mp.get_context()
+		self.lock = ctx.Lock()
+		self.counter = ctx.Value('q', 0, lock=False)   # transitions reserved so far, guarded by lock
+
+		nbytes = sum(int(np.prod(shape)) * np.dtype(dtype).itemsize for _, shape, dtype in self._layout())
+		self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+		self._owner = True
+		self._attach_arrays()
+		self.seq[:] = 0
+
+		self._init_n_step(n_step, gamma)
+		self.device = device
+
+	def _layout(self):
+		n = self.max_size
+		return [('state', (n, self.state_dim), np.float32), ('action', (n, self.action_dim), np.float32), \
+				('reward', (n, 1), np.float32), ('next_state', (n, self.state_dim), np.float32), \
+				('dead', (n, 1), np.uint8), ('discount', (n, 1), np.float32), ('seq', (n,), np.int64)]
+
+	def _attach_arrays(self):
+		offset = 0
+		for name, shape, dtype in self._layout():
+			array = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset)
+			setattr(self, name, array)
+			offset += array.nbytes
+
+	def __getstate__(self):
+		state = {k: v for k, v in self.__dict__.items() if k not in ('shm',) + tuple(name for name, _, _ in self._layout())}
+		state['shm_name'] = self.shm.name
+		state['_owner'] = False
+		return state
+
+	def __setstate__(self, state):
+		shm_name = state.pop('shm_name')
+		self.__dict__.update(state)
+		# processes started by multiprocessing share the creator's resource tracker, which keeps the
+		# block alive until the creator unlinks it
+		self.shm = shared_memory.SharedMemory(name=shm_name)
+		self._attach_arrays()
+
+	@property
+	def ptr(self):
+		return self.counter.value % self.max_size
+
+	@property
+	def size(self):
+		return min(self.counter.value, self.max_size)
+
+	def _store(self, state, action, reward, next_state, dead, discount):
+		with self.lock:
+			# skip a slot another actor, lapped by the ring, is still writing
+			while True:
+				count = self.counter.value
+				ptr = count % self.max_size
+				self.counter.value += 1
+				if self.seq[ptr] % 2 == 0:
+					break
+			self.seq[ptr] = 2 * count + 1
+
+		self.state[ptr] = state
+		self.action[ptr] = action
+		self.reward[ptr] = reward
+		self.next_state[ptr] = next_state
+		# it is important to distinguish between dead and done!!!
+		if self.Env_with_dead:
+			self.dead[ptr] = dead
+		else:
+			self.dead[ptr] = False
+		self.discount[ptr] = discount
+		self.seq[ptr] = 2 * count + 2
+
+	def sample(self, batch_size):
+		size = self.size
+		ind = np.random.randint(0, size, size=batch_size)
+		names = self.state_arrays if self.n_step > 1 else self.state_arrays[:-1]
+		seq = self.seq[ind]
+		rows = [getattr(self, name)[ind] for name in names]
+		# redraw the slots that were empty or written by an actor before or during the copy
+		torn = (seq == 0) | (seq % 2 == 1) | (self.seq[ind] != seq)
+		while torn.any():
+			redo = np.flatnonzero(torn)
+			ind[redo] = np.random.randint(0, size, size=len(redo))
+			seq[redo] = self.seq[ind[redo]]
+			for row, name in zip(rows, names):
+				row[redo] = getattr(self, name)[ind[redo]]
+			torn[redo] = (seq[redo] == 0) | (seq[redo] % 2 == 1) | (self.seq[ind[redo]] != seq[redo])
+		with torch.no_grad():
+			batch = (
+				torch.from_numpy(rows[0]).to(self.device),
+				torch.from_numpy(rows[1]).to(self.device),
+				torch.from_numpy(rows[2]).to(self.device),
+				torch.from_numpy(rows[3]).to(self.device),
+				torch.from_numpy(rows[4].astype(np.float32)).to(self.device)
+			)
+			if self.n_step > 1:
+				batch += (torch.from_numpy(rows[5]).to(self.device),)
+			return batch
+
+	def state_dict(self):
+		'''Copy of the stored transitions, ring position and pending n-step steps.
+
+		Actors may keep adding meanwhile: as in sample(), the slots being written or overwritten
+		during the copy are copied again until their sequence number is even and unchanged.
+		'''
+		with self.lock:
+			# every slot reserved so far is then marked as being written
+			count = self.counter.value
+		n = min(count, self.max_size)
+		seq = self.seq[:n].copy()
+		state = {name: getattr(self, name)[:n].copy() for name in self.state_arrays}
+		torn = (seq % 2 == 1) | (self.seq[:n] != seq)
+		while torn.any():
+			redo = np.flatnonzero(torn)
+			seq[redo] = self.seq[redo]
+			for name in self.state_arrays:
+				state[name][redo] = getattr(self, name)[redo]
+			torn[redo] = (seq[redo] % 2 == 1) | (self.seq[redo] != seq[redo])
+		state.update(ptr=count % self.max_size, size=n, pending=list(self._pending))
+		return state
+
+	def load_state_dict(self, state):
+		n = len(state[self.state_arrays[0]])
+		with self.lock:
+			for name in self.state_arrays:
+				getattr(self, name)[:n] = state[name]
+			self.seq[:n] = 2
+			# the ring position follows from the number of transitions reserved
+			self.counter.value = state['ptr'] if state['size'] < self.max_size else self.max_size + state['ptr']
+		self._pending = collections.deque(state['pending'])
+
+	def close(self):
+		'''Detach this process from the shared memory'''
+		for name, _, _ in self._layout():
+			setattr(self, name, None)
+		self.shm.close()
 
+	def unlink(self):
+		'''Detach and free the shared memory, from the creating process once every actor is done'''
+		self.close()
+		if self._owner:
+			self.shm.unlink()
@@ -0,0 +1,145 @@
+import numpy as np
+
+
+class RunningStat(object):
+    '''Running count, mean and sum of squared deviations (M2) of observations of a fixed shape.
+
+    push() adds one observation (Welford), push_batch() a batch and merge() the statistics of
+    another RunningStat, e.g. from another actor process, both with the parallel update of Chan
+    et al. std is cached until the next update.
+    '''
+    def __init__(self, shape):
+        self._n = 0
+        self._M = np.zeros(shape)
+        self._S = np.zeros(shape)
+        self._init_cache()
+
+    def _init_cache(self):
+        self._std = None
+        self._delta = np.empty(self._M.shape)
+        self._tmp = np.empty(self._M.shape)
+
+    def __getstate__(self):
+        # pickled without the cache, as before it was added
+        return {'_n': self._n, '_M': self._M, '_S': self._S}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_cache()
+
+    def push(self, x):
+        x = np.asarray(x)
+        #print(x.shape, self._M.shape)
+        assert x.shape == self._M.shape
+        self._n += 1
+        self._std = None
+        if self._n == 1:
+            self._M[...] = x
+        else:
+            # M += (x - M) / n; S += (x - old M) * (x - M), without temporaries
+            np.subtract(x, self._M, out=self._delta)
+            np.divide(self._delta, self._n, out=self._tmp)
+            self._M += self._tmp
+            np.subtract(x, self._M, out=self._tmp)
+            self._tmp *= self._delta
+            self._S += self._tmp
+
+    def push_batch(self, xs):
+        '''Add a batch of observations, of shape (batch,) + shape'''
+        xs = np.asarray(xs)
+        assert xs.shape[1:] == self._M.shape
+        if len(xs) == 0:
+            return
+        mean = xs.mean(axis=0)
+        self._merge(len(xs), mean, np.square(xs - mean).sum(axis=0))
+
+    def merge(self, other):
+        '''Add the observations counted by another RunningStat'''
+        assert other.shape == self.shape
+        self._merge(other.n, other.mean, other._S)
+
+    def _merge(self, n, mean, M2):
+        if n == 0:
+            return
+        self._std = None
+        if self._n == 0:
+            self._n = n
+            self._M[...] = mean
+            self._S[...] = M2
+            return
+        total = self._n + n
+        delta = mean - self._M
+        self._S += M2 + np.square(delta) * (self._n * n / total)
+        self._M += delta * (n / total)
+        self._n = total
+
+    @property
+    def n(self):
+        return self._n
+
+    @property
+    def mean(self):
+        return self._M
+
+    @property
+    def var(self):
+        return self._S / (self._n - 1) if self._n > 1 else np.square(self._M)
+
+    @property
+    def std(self):
+        if self._std is None:
+            self._std = np.sqrt(self.var)
+        return self._std
+
+    @property
+    def shape(self):
+        return self._M.shape
+
+    def state_dict(self):
+        return {'n': np.array(self._n), 'mean': self._M, 'M2': self._S}
+
+    def load_state_dict(self, state):
+        self._n = int(state['n'])
+        self._M[...] = state['mean']
+        self._S[...] = state['M2']
+        self._std = None
+
+
+class ZFilter:
+    """
+    y = (x-mean)/std
+    using running estimates of mean,std
+    """
+
+    def __init__(self, shape, demean=True, destd=True, clip=10.0):
+        self.demean = demean
+        self.destd = destd
+        self.clip = clip
+
+        self.rs = RunningStat(shape)
+
+    def __call__(self, x, update=True):
+        if update: self.rs.push(x)
+        if self.demean:
+            x = x - self.rs.mean
+        if self.destd:
+            x = x / (self.rs.std + 1e-5) # 1e-8
+        if self.clip:
+            x = np.clip(x, -self.clip, self.clip)
+        return x
+
+    def output_shape(self, input_space):
+        return input_space.shape
+
+    def save(self, path):
+        '''Save the statistics and options as a small .npz'''
+        np.savez(path, demean=self.demean, destd=self.destd, clip=self.clip if self.clip else 0.0, \
+                 **self.rs.state_dict())
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            zfilter = cls(data['mean'].shape, demean=bool(data['demean']), destd=bool(data['destd']), \
+                          clip=float(data['clip']))
+            zfilter.rs.load_state_dict(data)
+        return zfilter
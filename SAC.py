@@ -58,6 +58,45 @@ class Actor(nn.Module):
 
 
 
+class NumpyPolicy(object):
+	'''Deterministic tanh(mu) of an Actor, in NumPy with preallocated buffers, for a single state.
+
+	The weights are copied, so the policy does not follow later training of the actor.
+	'''
+	def __init__(self, actor):
+		linears = [m for m in actor.a_net if isinstance(m, nn.Linear)] + [actor.mu_layer]
+		slopes = []
+		for m in actor.a_net:
+			if isinstance(m, nn.LeakyReLU):
+				slopes.append(m.negative_slope)
+			elif isinstance(m, nn.ReLU):
+				slopes.append(0.0)
+			elif not isinstance(m, nn.Linear):
+				raise ValueError('NumpyPolicy does not support {}'.format(type(m).__name__))
+
+		# (in, out) weights, so that a layer is np.dot(x, W, out=h); h += b
+		self.weights = [m.weight.detach().cpu().numpy().T.astype(np.float32, order='C') for m in linears]
+		self.biases = [m.bias.detach().cpu().numpy().astype(np.float32) for m in linears]
+		self.slopes = slopes
+		self._x = np.empty(self.weights[0].shape[0], dtype=np.float32)
+		self._h = [np.empty(w.shape[1], dtype=np.float32) for w in self.weights]
+		self._tmp = [np.empty(w.shape[1], dtype=np.float32) for w in self.weights]
+
+	def __call__(self, state):
+		x = self._x
+		x[...] = np.ravel(state)
+		for j, (w, b, h) in enumerate(zip(self.weights, self.biases, self._h)):
+			np.dot(x, w, out=h)
+			h += b
+			if j < len(self.slopes):
+				# leaky relu, max(h, slope * h)
+				np.multiply(h, self.slopes[j], out=self._tmp[j])
+				np.maximum(h, self._tmp[j], out=h)
+			x = h
+		return np.tanh(x)
+
+
+
 class Q_Critic(nn.Module):
 	def __init__(self, state_dim, action_dim, hid_shape):
 		super(Q_Critic, self).__init__()
@@ -75,6 +114,37 @@ class Q_Critic(nn.Module):
 
 
 
+class Ensemble_Q_Critic(nn.Module):
+	'''num_critics Q nets with their layers stacked, all evaluated at once by torch.baddbmm.
+
+	forward() returns a (num_critics, batch, 1) tensor, so q1, q2 = critic(state, action) still
+	works for two critics.
+	'''
+	def __init__(self, state_dim, action_dim, hid_shape, num_critics=2):
+		super(Ensemble_Q_Critic, self).__init__()
+		layers = [state_dim + action_dim] + list(hid_shape) + [1]
+		self.num_critics = num_critics
+
+		self.weights = nn.ParameterList()
+		self.biases = nn.ParameterList()
+		for j in range(len(layers)-1):
+			# the default initialization of nn.Linear, drawn for every critic
+			bound = 1 / math.sqrt(layers[j])
+			self.weights.append(nn.Parameter(torch.empty(num_critics, layers[j], layers[j+1]).uniform_(-bound, bound)))
+			self.biases.append(nn.Parameter(torch.empty(num_critics, 1, layers[j+1]).uniform_(-bound, bound)))
+
+
+	def forward(self, state, action):
+		sa = torch.cat([state, action], 1)
+		x = sa.expand(self.num_critics, *sa.shape)
+		for j, (weight, bias) in enumerate(zip(self.weights, self.biases)):
+			x = torch.baddbmm(bias, x, weight)
+			if j < len(self.weights) - 1:
+				x = F.leaky_relu(x)
+		return x
+
+
+
 class SAC_Agent(object):
 	def __init__(
 		self,
@@ -86,14 +156,30 @@ class SAC_Agent(object):
 		c_lr=3e-4,
 		batch_size = 256,
 		alpha = 0.2,
-		adaptive_alpha = True
+		adaptive_alpha = True,
+		ensemble_critic = False,
+		num_critics = 2,
+		critic_subset = 2,
+		compile_update = False
 	):
+		# compile_update compiles the loss computations with torch.compile, where available, and
+		# steps the optimizers with the multi-tensor (foreach) Adam
+		adam_kwargs = {'foreach': True} if compile_update else {}
 
 		self.actor = Actor(state_dim, action_dim, hid_shape).to(device)
-		self.actor_optimizer = torch.optim.Adam(self.actor.parameters(), lr=a_lr)
+		self.actor_params = list(self.actor.parameters())
+		self.actor_optimizer = torch.optim.Adam(self.actor_params, lr=a_lr, **adam_kwargs)
 
-		self.q_critic = Q_Critic(state_dim, action_dim, hid_shape).to(device)
-		self.q_critic_optimizer = torch.optim.Adam(self.q_critic.parameters(), lr=c_lr)
+		# the ensemble evaluates num_critics critics in one pass, its target takes the min of a random
+		# subset of critic_subset of them (REDQ). Q_Critic is the two separate nets.
+		if ensemble_critic:
+			self.q_critic = Ensemble_Q_Critic(state_dim, action_dim, hid_shape, num_critics).to(device)
+		else:
+			assert num_critics == 2, 'Q_Critic holds two critics, use ensemble_critic for more'
+			self.q_critic = Q_Critic(state_dim, action_dim, hid_shape).to(device)
+		self.num_critics = num_critics
+		self.critic_subset = critic_subset
+		self.q_critic_optimizer = torch.optim.Adam(self.q_critic.parameters(), lr=c_lr, **adam_kwargs)
 		self.q_critic_target = copy.deepcopy(self.q_critic)
 		# Freeze target networks with respect to optimizers (only update via polyak averaging)
 		for p in self.q_critic_target.parameters():
@@ -111,7 +197,12 @@ class SAC_Agent(object):
 			self.target_entropy = torch.tensor(-action_dim, dtype=float, requires_grad=True, device=device)
 			# We learn log_alpha instead of alpha to ensure exp(log_alpha)=alpha>0
 			self.log_alpha = torch.tensor(np.log(alpha), dtype=float, requires_grad=True, device=device)
-			self.alpha_optim = torch.optim.Adam([self.log_alpha], lr=c_lr)
+			self.alpha_optim = torch.optim.Adam([self.log_alpha], lr=c_lr, **adam_kwargs)
+
+		self.compile_update = compile_update and hasattr(torch, 'compile')
+		if self.compile_update:
+			self._critic_loss = torch.compile(self._critic_loss)
+			self._actor_loss = torch.compile(self._actor_loss)
 
 
 
@@ -125,41 +216,74 @@ class SAC_Agent(object):
 
 
 
-	def train(self,replay_buffer):
-		s, a, r, s_prime, dead_mask = replay_buffer.sample(self.batch_size)
+	def export_policy(self):
+		'''Inference-only copy of the deterministic policy, see NumpyPolicy'''
+		return NumpyPolicy(self.actor)
 
-		#----------------------------- ↓↓↓↓↓ Update Q Net ↓↓↓↓↓ ------------------------------#
+
+
+	def _all_Q(self, critic, state, action):
+		'''Q values of every critic, (num_critics, batch, 1)'''
+		q = critic(state, action)
+		return q if torch.is_tensor(q) else torch.stack(q)
+
+
+
+	def _critic_loss(self, s, a, r, s_prime, dead_mask, discount, weights, alpha):
+		'''Summed MSE of every critic (importance-weighted when weights is given), and the mean |TD error|'''
 		with torch.no_grad():
 			a_prime, log_pi_a_prime = self.actor(s_prime)
-			target_Q1, target_Q2 = self.q_critic_target(s_prime, a_prime)
-			target_Q = torch.min(target_Q1, target_Q2)
-			target_Q = r + (1 - dead_mask) * self.gamma * (target_Q - self.alpha * log_pi_a_prime) #Dead or Done is tackled by Randombuffer
+			target_Q = self._all_Q(self.q_critic_target, s_prime, a_prime)
+			if self.critic_subset < self.num_critics:
+				target_Q = target_Q[torch.randperm(self.num_critics, device=target_Q.device)[:self.critic_subset]]
+			target_Q = target_Q.min(dim=0)[0]
+			target_Q = r + (1 - dead_mask) * discount * (target_Q - alpha * log_pi_a_prime) #Dead or Done is tackled by Randombuffer
 
 		# Get current Q estimates
-		current_Q1, current_Q2 = self.q_critic(s, a)
+		current_Q = self._all_Q(self.q_critic, s, a)
+		td = current_Q - target_Q
+		if weights is None:
+			q_loss = self.num_critics * td.pow(2).mean()
+		else:
+			q_loss = self.num_critics * (weights * td.pow(2)).mean()
+		return q_loss, td.abs().mean(dim=0).detach()
+
+
+
+	def _actor_loss(self, s, alpha):
+		a, log_pi_a = self.actor(s)
+		current_Q = self._all_Q(self.q_critic, s, a)
+		# the min of the two critics, or the ensemble mean as in REDQ
+		Q = current_Q.min(dim=0)[0] if self.num_critics == 2 else current_Q.mean(dim=0)
+		return (alpha * log_pi_a - Q).mean(), log_pi_a.detach()
+
+
+
+	def train(self,replay_buffer):
+		batch = replay_buffer.sample(self.batch_size)
+		s, a, r, s_prime, dead_mask = batch[:5]
+		# n-step buffers return the discount of every transition, gamma^n or less at episode ends
+		discount = batch[5] if replay_buffer.n_step > 1 else self.gamma
+		# importance-sampling weights of prioritized buffers, the TD errors become the new priorities
+		weights, ind = batch[-2:] if replay_buffer.prioritized else (None, None)
 
-		q_loss = F.mse_loss(current_Q1, target_Q) + F.mse_loss(current_Q2, target_Q)
+		#----------------------------- ↓↓↓↓↓ Update Q Net ↓↓↓↓↓ ------------------------------#
+		q_loss, td_errors = self._critic_loss(s, a, r, s_prime, dead_mask, discount, weights, self.alpha)
 		self.q_critic_optimizer.zero_grad()
 		q_loss.backward()
 		self.q_critic_optimizer.step()
+		if replay_buffer.prioritized:
+			replay_buffer.update_priorities(ind, td_errors.cpu().numpy().ravel())
 
 		#----------------------------- ↓↓↓↓↓ Update Actor Net ↓↓↓↓↓ ------------------------------#
-		# Freeze Q-networks so you don't waste computational effort
-		# computing gradients for them during the policy learning step.
-		for params in self.q_critic.parameters():
-			params.requires_grad = 	False
-
-		a, log_pi_a = self.actor(s)
-		current_Q1, current_Q2 = self.q_critic(s, a)
-		Q = torch.min(current_Q1, current_Q2)
-
-		a_loss = (self.alpha * log_pi_a - Q).mean()
-		self.actor_optimizer.zero_grad()
-		a_loss.backward()
+		a_loss, log_pi_a = self._actor_loss(s, self.alpha)
+		# differentiate w.r.t. the actor only, so no gradient is computed for the Q-networks
+		# during the policy learning step
+		a_grads = torch.autograd.grad(a_loss, self.actor_params)
+		for param, grad in zip(self.actor_params, a_grads):
+			param.grad = grad
 		self.actor_optimizer.step()
 
-		for params in self.q_critic.parameters():
-			params.requires_grad = 	True
 		#----------------------------- ↓↓↓↓↓ Update alpha ↓↓↓↓↓ ------------------------------#
 		if self.adaptive_alpha:
 			# we optimize log_alpha instead of aplha, which is aimed to force alpha = exp(log_alpha)> 0
@@ -168,12 +292,43 @@ class SAC_Agent(object):
 			self.alpha_optim.zero_grad()
 			alpha_loss.backward()
 			self.alpha_optim.step()
-			self.alpha = self.log_alpha.exp()
+			self.alpha = self.log_alpha.exp().detach()
 
 		#----------------------------- ↓↓↓↓↓ Update Target Net ↓↓↓↓↓ ------------------------------#
-		for param, target_param in zip(self.q_critic.parameters(), self.q_critic_target.parameters()):
-			target_param.data.copy_(self.tau * param.data + (1 - self.tau) * target_param.data)
+		# target = target + tau * (param - target), for all the parameters at once
+		with torch.no_grad():
+			torch._foreach_lerp_(list(self.q_critic_target.parameters()), list(self.q_critic.parameters()), self.tau)
+
+
 
+	def state_dict(self):
+		'''Everything train() depends on: the networks, the target critic, the optimizers and alpha'''
+		state = {
+			'actor': self.actor.state_dict(),
+			'q_critic': self.q_critic.state_dict(),
+			'q_critic_target': self.q_critic_target.state_dict(),
+			'actor_optimizer': self.actor_optimizer.state_dict(),
+			'q_critic_optimizer': self.q_critic_optimizer.state_dict(),
+			'alpha': self.alpha
+		}
+		if self.adaptive_alpha:
+			state['log_alpha'] = self.log_alpha.detach()
+			state['alpha_optim'] = self.alpha_optim.state_dict()
+		return state
+
+
+	def load_state_dict(self, state):
+		self.actor.load_state_dict(state['actor'])
+		self.q_critic.load_state_dict(state['q_critic'])
+		self.q_critic_target.load_state_dict(state['q_critic_target'])
+		self.actor_optimizer.load_state_dict(state['actor_optimizer'])
+		self.q_critic_optimizer.load_state_dict(state['q_critic_optimizer'])
+		self.alpha = state['alpha']
+		if self.adaptive_alpha:
+			# in place, alpha_optim holds log_alpha
+			with torch.no_grad():
+				self.log_alpha.copy_(state['log_alpha'])
+			self.alpha_optim.load_state_dict(state['alpha_optim'])
 
 
 	def save(self,episode):
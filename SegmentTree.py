@@ -0,0 +1,67 @@
+import numpy as np
+
+
+class SegmentTree(object):
+	'''Array-based binary tree reducing the leaves with operation, updated and queried in batches.
+
+	Node 1 is the root, the children of node i are 2i and 2i+1, leaves start at capacity.
+	'''
+	def __init__(self, capacity, operation, neutral_element):
+		self.capacity = 1
+		while self.capacity < capacity:
+			self.capacity *= 2
+		self.operation = operation
+		self.neutral_element = neutral_element
+		self.value = np.full(2 * self.capacity, neutral_element, dtype=np.float64)
+
+	def __setitem__(self, idx, val):
+		'''Set a batch of leaves, then recompute their ancestors level by level, O(k log n)'''
+		idx = np.asarray(idx, dtype=np.int64) + self.capacity
+		self.value[idx] = val
+		if idx.size == 1:
+			# a single leaf, as in add(), walks up faster with scalars
+			i = int(idx.reshape(-1)[0]) // 2
+			while i >= 1:
+				self.value[i] = self.operation(self.value[2 * i], self.value[2 * i + 1])
+				i //= 2
+			return
+		# duplicated parents just compute the same value twice, cheaper than deduplicating them
+		idx = idx // 2
+		while idx[0] >= 1:
+			self.value[idx] = self.operation(self.value[2 * idx], self.value[2 * idx + 1])
+			idx //= 2
+
+	def __getitem__(self, idx):
+		return self.value[np.asarray(idx, dtype=np.int64) + self.capacity]
+
+	def reduce(self):
+		'''Reduction of all the leaves'''
+		return self.value[1]
+
+
+class SumSegmentTree(SegmentTree):
+	def __init__(self, capacity):
+		super(SumSegmentTree, self).__init__(capacity, np.add, 0.0)
+
+	def sum(self):
+		return self.reduce()
+
+	def find_prefixsum_idx(self, prefixsum):
+		'''Find, for every prefixsum, the highest leaf i with sum(leaves[:i]) <= prefixsum, O(k log n)'''
+		prefixsum = np.array(prefixsum, dtype=np.float64)
+		idx = np.ones(len(prefixsum), dtype=np.int64)
+		while idx[0] < self.capacity:
+			left = 2 * idx
+			left_sum = self.value[left]
+			go_right = prefixsum >= left_sum
+			prefixsum = np.where(go_right, prefixsum - left_sum, prefixsum)
+			idx = np.where(go_right, left + 1, left)
+		return idx - self.capacity
+
+
+class MinSegmentTree(SegmentTree):
+	def __init__(self, capacity):
+		super(MinSegmentTree, self).__init__(capacity, np.minimum, np.inf)
+
+	def min(self):
+		return self.reduce()
@@ -0,0 +1,82 @@
+"""
+Time Ensemble_Q_Critic against the two nets of Q_Critic, alone and in full SAC updates
+
+    python benchmarks/ensemble_critic.py --threads 1
+
+The critic is timed for a forward and backward pass at every batch size,
+then SAC_Agent.train for Q_Critic and for Ensemble_Q_Critic with E critics
+and a target subset of 2 (REDQ). The shapes are those of carla-kinematic-v0
+(77-dim states, 8-dim actions) with the default 256x256 hidden layers.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ReplayBuffer import TensorBuffer
+from SAC import SAC_Agent, Q_Critic, Ensemble_Q_Critic
+
+
+def best_time(fn, calls, repeat):
+    """Best time per call, over repeat runs of calls calls of fn"""
+    fn()
+    best = np.inf
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        for _ in range(calls):
+            fn()
+        best = min(best, (time.perf_counter() - start_time) / calls)
+    return best
+
+
+def critic_step(critic, s, a):
+    def step():
+        q = critic(s, a)
+        loss = sum(qi.pow(2).mean() for qi in q)
+        critic.zero_grad()
+        loss.backward()
+    return step
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--state_dim', type=int, default=77)
+    parser.add_argument('--action_dim', type=int, default=8)
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[32, 256])
+    parser.add_argument('--num_critics', type=int, nargs='+', default=[2, 10], help='ensemble sizes of the SAC updates')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--calls', type=int, default=200, help='calls per run')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of every variant, the best one is reported')
+    opt = parser.parse_args()
+
+    torch.set_num_threads(opt.threads)
+    torch.manual_seed(0)
+    print('{} threads, best of {} runs of {} calls'.format(opt.threads, opt.repeat, opt.calls))
+
+    critic = Q_Critic(opt.state_dim, opt.action_dim, (256, 256))
+    ensemble = Ensemble_Q_Critic(opt.state_dim, opt.action_dim, (256, 256), num_critics=2)
+    for batch_size in opt.batch_sizes:
+        s, a = torch.randn(batch_size, opt.state_dim), torch.randn(batch_size, opt.action_dim)
+        two_nets = best_time(critic_step(critic, s, a), opt.calls, opt.repeat)
+        fused = best_time(critic_step(ensemble, s, a), opt.calls, opt.repeat)
+        print('critic forward + backward, batch {:4d}: two nets {:6.2f} ms, fused {:6.2f} ms'.format( \
+              batch_size, 1e3 * two_nets, 1e3 * fused))
+
+    buffer = TensorBuffer(opt.state_dim, opt.action_dim, True, max_size=10000)
+    for _ in range(buffer.max_size):
+        buffer.add(np.random.randn(opt.state_dim), np.random.uniform(-1, 1, opt.action_dim), np.random.randn(), \
+                   np.random.randn(opt.state_dim), False)
+    variants = [('Q_Critic', {})]
+    variants += [('Ensemble_Q_Critic, E = {}'.format(E), {'ensemble_critic': True, 'num_critics': E}) for E in opt.num_critics]
+    for name, kwargs in variants:
+        agent = SAC_Agent(opt.state_dim, opt.action_dim, **kwargs)
+        update_time = best_time(lambda: agent.train(buffer), opt.calls // 4, opt.repeat)
+        print('SAC updates, {:<26s} {:6.1f} /s'.format(name, 1 / update_time))
+
+
+if __name__ == '__main__':
+    main()
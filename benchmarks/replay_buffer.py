@@ -0,0 +1,81 @@
+"""
+Time sample(), add() and update_priorities() of TensorBuffer and PrioritizedBuffer
+
+    python benchmarks/replay_buffer.py --max_size 1000000 --batch_size 256
+
+The buffers are filled with random transitions of the carla-kinematic-v0
+shapes (77-dim states, 8-dim actions) before anything is timed. The rates
+are calls per second, so sample() and update_priorities() handle
+batch_size transitions per call.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ReplayBuffer import TensorBuffer, PrioritizedBuffer
+
+
+def rate(fn, calls, repeat):
+    """Best rate, in calls per second, of repeat runs of calls calls of fn"""
+    best = np.inf
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        for _ in range(calls):
+            fn()
+        best = min(best, time.perf_counter() - start_time)
+    return calls / best
+
+
+def fill(buffer, state_dim, action_dim, rng):
+    # written through the numpy views, much faster than max_size calls of add()
+    n = buffer.max_size
+    buffer.state[:] = rng.standard_normal((n, state_dim), dtype=np.float32)
+    buffer.action[:] = rng.standard_normal((n, action_dim), dtype=np.float32)
+    buffer.reward[:] = rng.standard_normal((n, 1), dtype=np.float32)
+    buffer.next_state[:] = rng.standard_normal((n, state_dim), dtype=np.float32)
+    buffer.size = n
+    if isinstance(buffer, PrioritizedBuffer):
+        buffer.update_priorities(np.arange(n), rng.exponential(size=n))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--max_size', type=int, default=int(1e6))
+    parser.add_argument('--batch_size', type=int, default=256)
+    parser.add_argument('--state_dim', type=int, default=77)
+    parser.add_argument('--action_dim', type=int, default=8)
+    parser.add_argument('--calls', type=int, default=1000, help='calls per run')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of every variant, the best one is reported')
+    parser.add_argument('--seed', type=int, default=0)
+    opt = parser.parse_args()
+
+    rng = np.random.default_rng(opt.seed)
+    np.random.seed(opt.seed)
+    tensor = TensorBuffer(opt.state_dim, opt.action_dim, True, max_size=opt.max_size)
+    prioritized = PrioritizedBuffer(opt.state_dim, opt.action_dim, True, max_size=opt.max_size)
+    for buffer in (tensor, prioritized):
+        fill(buffer, opt.state_dim, opt.action_dim, rng)
+
+    s, a, r = np.zeros(opt.state_dim), np.zeros(opt.action_dim), 0.0
+    td_errors = rng.exponential(size=opt.batch_size)
+
+    def update():
+        prioritized.update_priorities(rng.integers(0, opt.max_size, size=opt.batch_size), td_errors)
+
+    print('max_size {}, batch_size {}, best of {} runs of {} calls'.format(opt.max_size, opt.batch_size, \
+          opt.repeat, opt.calls))
+    variants = [('TensorBuffer.sample()', lambda: tensor.sample(opt.batch_size)),
+                ('PrioritizedBuffer.sample()', lambda: prioritized.sample(opt.batch_size)),
+                ('PrioritizedBuffer.update_priorities()', update),
+                ('TensorBuffer.add()', lambda: tensor.add(s, a, r, s, False)),
+                ('PrioritizedBuffer.add()', lambda: prioritized.add(s, a, r, s, False))]
+    for name, fn in variants:
+        print('{:<40s} {:10.0f} /s'.format(name, rate(fn, opt.calls, opt.repeat)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Time High_MPC.solve_batch against K serial calls of High_MPC.solve
+
+    python benchmarks/solve_batch.py --K 8 --repeat 5
+
+The K references are drawn like the SAC proposals of main.py, around the
+ego vehicle of a reset carla-kinematic-v0 episode. Every solve() starts
+from the same cold warm start as the problems of solve_batch(), so all
+the variants solve the same NLPs.
+"""
+import argparse
+import os
+import sys
+import time
+
+import gym
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gym_carla
+from Adapter import ActionScaler
+
+
+def serial_solve(mpc, ref_trajs, init_state):
+    opt_u = []
+    for ref_traj in ref_trajs:
+        mpc.reset(init_state)
+        u, _ = mpc.solve(ref_traj)
+        opt_u.append(u.reshape(-1))
+    return np.array(opt_u)
+
+
+def best_time(fn, repeat):
+    times, result = [], None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start_time)
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--K', type=int, default=8, help='problems per batch')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of every variant, the best one is reported')
+    parser.add_argument('--seed', type=int, default=0)
+    opt = parser.parse_args()
+
+    params = {'display_size': 512, 'max_past_step': 1, 'dt': 0.1, 'ego_vehicle_filter': 'vehicle.tesla.model3*', \
+              'port': 2000, 'max_time_episode': 500, 'detect_range': 50, 'detector_num': 73, 'detect_angle': 180, \
+              'obs_range': 32, 'lidar_bin': 0.125, 'd_behind': 12, 'max_ego_spawn_times': 200, 'pixor_size': 64, \
+              'pixor': False}
+    env = gym.make('carla-kinematic-v0', params=params).unwrapped
+    env.seed(opt.seed)
+    env.reset()
+    mpc, init_state = env.high_mpc, list(env.ego_state)
+    action_scaler = ActionScaler(env.act_low, env.act_high)
+
+    rng = np.random.default_rng(opt.seed)
+    ref_trajs = []
+    for a in rng.uniform(-1, 1, size=(opt.K, env.action_space.shape[0])):
+        ref = action_scaler(a)
+        ref_obj = [np.array(env.ego_state[0]) + np.array(ref[0])] + list(ref[1:8])
+        ref_trajs.append(env.ego_state + ref_obj + env.goal_state)
+
+    print('K = {}, {} CPUs, best of {} runs'.format(opt.K, os.cpu_count(), opt.repeat))
+    serial_time, serial_u = best_time(lambda: serial_solve(mpc, ref_trajs, init_state), opt.repeat)
+    print('{:<34s} {:8.3f} s'.format('{} x solve()'.format(opt.K), serial_time))
+    mpc.reset(init_state)
+    variants = [('solve_batch(), default threads', {})]
+    variants += [('solve_batch(), map with {} threads'.format(n), {'n_threads': n}) for n in sorted({2, opt.K})]
+    for name, kwargs in variants:
+        batch_time, (batch_u, _, _) = best_time(lambda: mpc.solve_batch(ref_trajs, **kwargs), opt.repeat)
+        print('{:<34s} {:8.3f} s   speedup {:.2f}, max |du| {:.1e}'.format(name, batch_time, serial_time / batch_time, \
+              np.abs(batch_u - serial_u).max()))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,4 +3,14 @@ from gym.envs.registration import register
 register(
     id='carla-v0',
     entry_point='gym_carla.envs:CarlaEnv',
+)
+
+register(
+    id='carla-kinematic-v0',
+    entry_point='gym_carla.envs:CarlaKinematicEnv',
+)
+
+register(
+    id='carla-vector-v0',
+    entry_point='gym_carla.envs:VectorCarlaEnv',
 )
\ No newline at end of file
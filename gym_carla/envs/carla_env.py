@@ -20,6 +20,7 @@ import carla
 from high_mpc import High_MPC
 
 from gym_carla.envs.render import BirdeyeRender
+from gym_carla.envs.detector import get_detector_yaws, ray_polygon_distances
 from gym_carla.envs.misc import *
 
 
@@ -48,6 +49,41 @@ class CarlaEnv(gym.Env):
     else:
       self.pixor = False
 
+    # Compile the MPC solver ahead of time
+    if 'mpc_codegen' in params.keys():
+      self.mpc_codegen = params['mpc_codegen']
+    else:
+      self.mpc_codegen = False
+
+    # MPC solver: 'ipopt', 'sqp' or 'rti' (real-time iteration)
+    if 'mpc_solver' in params.keys():
+      self.mpc_solver = params['mpc_solver']
+    else:
+      self.mpc_solver = 'ipopt'
+
+    # Obstacle detector: 'analytic' (ray cast against the vehicle polygons) or 'sensor' (CARLA obstacle sensors)
+    if 'obstacle_detector' in params.keys():
+      self.obstacle_detector = params['obstacle_detector']
+    else:
+      self.obstacle_detector = 'analytic'
+
+    # Rendering of the birdeye and camera views: 'every_k' (every render_every steps),
+    # 'on_demand' (only in render()) or 'none' (never, and no camera sensor)
+    if 'render_mode' in params.keys():
+      self.render_mode = params['render_mode']
+    else:
+      self.render_mode = 'every_k'
+    if 'render_every' in params.keys():
+      self.render_every = params['render_every']
+    else:
+      self.render_every = 1
+
+    # Directory of the cached road map raster, None for the default one
+    if 'map_cache_dir' in params.keys():
+      self.map_cache_dir = params['map_cache_dir']
+    else:
+      self.map_cache_dir = None
+
     # Destination
     self.dests = None
 
@@ -103,6 +139,7 @@ class CarlaEnv(gym.Env):
 
     # Obstacle detector
     self.distance_measurements = []
+    self.detector_yaws = get_detector_yaws(self.detect_angle, self.detector_num)
     self.obstector_bp = self.world.get_blueprint_library().find('sensor.other.obstacle')
     self.obstector_bp.set_attribute('debug_linetrace', 'False')
     self.obstector_bp.set_attribute('distance', '50')
@@ -129,8 +166,8 @@ class CarlaEnv(gym.Env):
     self.reset_step = 0
     self.total_step = 0
     
-    # Initialize the renderer
-    self._init_renderer()
+    # The renderer is initialized when the first frame is drawn
+    self.birdeye_render = None
 
     # Get pixel grid points
     if self.pixor:
@@ -252,15 +289,18 @@ class CarlaEnv(gym.Env):
 
     for detector_i in range(self.detector_num):
       self.distance_measurements.append(self.detect_range)
-      self.obstector_trans = carla.Transform(carla.Location(x=0.0, z=0.5), carla.Rotation(yaw=-self.detect_angle/2+(self.detect_angle/(self.detector_num-1))*detector_i))
+      if self.obstacle_detector != 'sensor':
+        continue
+      self.obstector_trans = carla.Transform(carla.Location(x=0.0, z=0.5), carla.Rotation(yaw=self.detector_yaws[detector_i]))
 
       self.detector_list.append(self.world.spawn_actor(self.obstector_bp, self.obstector_trans, attach_to=self.ego))
 
       self.listen_dector_distance(detector_i)
 
     # Add camera sensor
-    self.camera_sensor = self.world.spawn_actor(self.camera_bp, self.camera_trans, attach_to=self.ego)
-    self.camera_sensor.listen(lambda data: get_camera_img(data))
+    if self.render_mode != 'none':
+      self.camera_sensor = self.world.spawn_actor(self.camera_bp, self.camera_trans, attach_to=self.ego)
+      self.camera_sensor.listen(lambda data: get_camera_img(data))
     def get_camera_img(data):
       array = np.frombuffer(data.raw_data, dtype = np.dtype("uint8"))
       array = np.reshape(array, (data.height, data.width, 4))
@@ -278,14 +318,17 @@ class CarlaEnv(gym.Env):
     self.world.apply_settings(self.settings)
 
     # Set ego information for render
-    self.birdeye_render.set_hero(self.ego, self.ego.id)
+    if self.birdeye_render is not None:
+      self.birdeye_render.set_hero(self.ego, self.ego.id)
 
     obs = self._get_obs()
 
     self.travelled_dist = None
 
+    # the NLP solver is cached by High_MPC, so only the warm start is rebuilt here
     self.high_mpc = High_MPC(T=self.plan_T, dt=self.plan_dt, L=self.inter_axle_distance, vehicle_length=self.vehicle_length,\
-                            vehicle_width = self.vehicle_width, lane_width = self.lane_width,  init_state=self.ego_state)
+                            vehicle_width = self.vehicle_width, lane_width = self.lane_width,  init_state=self.ego_state,\
+                            codegen=self.mpc_codegen, solver_mode=self.mpc_solver)
 
     return obs
   
@@ -308,7 +351,9 @@ class CarlaEnv(gym.Env):
     #print(act)
     self.ego.apply_control(act)
 
+    start_time = time.perf_counter()
     self.world.tick()
+    tick_time = time.perf_counter() - start_time
 
     # Append actors polygon list
     vehicle_poly_dict = self._get_actor_polygons('vehicle.*')
@@ -316,15 +361,25 @@ class CarlaEnv(gym.Env):
     while len(self.vehicle_polygons) > self.max_past_step:
       self.vehicle_polygons.pop(0)
 
+    if self.obstacle_detector == 'analytic':
+      self._detect_obstacles()
+    detect_time = time.perf_counter() - start_time - tick_time
+
     # Update timesteps
     self.t += self.sim_dt
     self.time_step += 1
     self.total_step += 1
 
     obs = self._get_obs()
-    # state information
+    # state information, and the wall time (s) spent in this step
     info = {
-      'ego_state': self.ego_state
+      'ego_state': self.ego_state,
+      'timing': {
+        'tick': tick_time,
+        'detect': detect_time,
+        'render': self.render_time,
+        'total': time.perf_counter() - start_time
+      }
     }
 
     self.done = self._terminal()
@@ -337,6 +392,10 @@ class CarlaEnv(gym.Env):
     return [seed]
 
   def render(self):
+    if self.render_mode == 'none':
+      return None
+    if self.render_mode == 'on_demand':
+      self._render_frame()
     frame = pygame.surfarray.array3d(self.display)
     return frame
   
@@ -373,7 +432,8 @@ class CarlaEnv(gym.Env):
     birdeye_params = {
       'screen_size': [self.display_size, self.display_size],
       'pixels_per_meter': pixels_per_meter,
-      'pixels_ahead_vehicle': pixels_ahead_vehicle
+      'pixels_ahead_vehicle': pixels_ahead_vehicle,
+      'map_cache_dir': self.map_cache_dir
     }
     self.birdeye_render = BirdeyeRender(self.world, birdeye_params)
 
@@ -443,7 +503,29 @@ class CarlaEnv(gym.Env):
 
   def _get_obs(self):
     """Get the observations."""
-      ## Birdeye rendering
+    self.render_time = 0.0
+    if self.render_mode == 'every_k' and self.time_step % self.render_every == 0:
+      start_time = time.perf_counter()
+      self._render_frame()
+      self.render_time = time.perf_counter() - start_time
+
+    self.ego_state = self.get_state_frenet(self.ego, self.map)
+
+    obs = []
+    obs += self.ego_state
+    obs += self.distance_measurements
+
+    obs = np.array(obs)
+
+    return obs
+
+  def _render_frame(self):
+    """Draw the birdeye and camera views on the pygame display."""
+    if self.birdeye_render is None:
+      self._init_renderer()
+      self.birdeye_render.set_hero(self.ego, self.ego.id)
+
+    ## Birdeye rendering
     self.birdeye_render.vehicle_polygons = self.vehicle_polygons
 
     # birdeye view with roadmap and actors
@@ -479,16 +561,6 @@ class CarlaEnv(gym.Env):
     # Display on pygame
     pygame.display.flip()
 
-    self.ego_state = self.get_state_frenet(self.ego, self.map)
-
-    obs = []
-    obs += self.ego_state
-    obs += self.distance_measurements
-
-    obs = np.array(obs)
-
-    return obs
-
   def _get_roatation_matrix(self,yaw):
         return np.array([[np.cos(yaw), -np.sin(yaw)], [np.sin(yaw), np.cos(yaw)]])
   
@@ -613,6 +685,15 @@ class CarlaEnv(gym.Env):
 
     return agent
   
+  def _detect_obstacles(self):
+    """Cast all detector beams against the other vehicles' polygons of this tick."""
+    polys = [poly for idx, poly in self.vehicle_polygons[-1].items() if idx != self.ego.id]
+    trans = self.ego.get_transform()
+    origin = np.array([trans.location.x, trans.location.y])
+    angles = np.deg2rad(trans.rotation.yaw + self.detector_yaws)
+    distances = ray_polygon_distances(origin, angles, np.reshape(polys, (-1, 4, 2)), self.detect_range)
+    self.distance_measurements = distances.tolist()
+
   def listen_dector_distance(self, line_i):
     self.detector_list[line_i].listen(lambda distance: get_obstacle_distance(distance, line_i))
     def get_obstacle_distance(info, detector_i):
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+# This work is licensed under the terms of the MIT license.
+# For a copy, see <https://opensource.org/licenses/MIT>.
+
+from __future__ import division
+
+import numpy as np
+
+
+def get_detector_yaws(detect_angle, detector_num):
+  """Yaws of the detector beams relative to the ego heading (deg), as mounted in CarlaEnv."""
+  return -detect_angle/2 + (detect_angle/(detector_num-1))*np.arange(detector_num)
+
+
+def ray_polygon_distances(origin, angles, polygons, detect_range):
+  """Distances along a fan of rays to the edges of polygons.
+
+  Every ray o + t*d is intersected with every polygon edge a + u*(b-a) at once,
+  the arrays broadcast over beams x polygons x edges.
+
+  Args:
+    origin: array (..., 2), start of the rays.
+    angles: array (..., B), absolute directions of the B rays (rad).
+    polygons: array (..., K, P, 2), K polygons of P corners, e.g. the
+      bounding boxes of CarlaEnv._get_actor_polygons.
+    detect_range: distance reported when nothing is hit.
+
+  Returns:
+    array (..., B) of the distance to the closest edge hit by every ray.
+  """
+  polygons = np.asarray(polygons, dtype=float)
+  origin = np.asarray(origin, dtype=float)
+  # edges a -> b, relative to the ray origin; shape (..., 1, K, P)
+  ax = polygons[..., 0] - origin[..., 0, None, None]
+  ay = polygons[..., 1] - origin[..., 1, None, None]
+  ex = np.roll(polygons[..., 0], -1, axis=-1) - polygons[..., 0]
+  ey = np.roll(polygons[..., 1], -1, axis=-1) - polygons[..., 1]
+  ax, ay, ex, ey = ax[..., None, :, :], ay[..., None, :, :], ex[..., None, :, :], ey[..., None, :, :]
+  # ray directions; shape (..., B, 1, 1)
+  dx = np.cos(angles)[..., :, None, None]
+  dy = np.sin(angles)[..., :, None, None]
+
+  # o + t*d = a + u*e, solved with 2D cross products
+  denom = dx*ey - dy*ex
+  with np.errstate(divide='ignore', invalid='ignore'):
+    t = (ax*ey - ay*ex)/denom
+    u = (ax*dy - ay*dx)/denom
+  hit = (denom != 0) & (t >= 0) & (u >= 0) & (u <= 1)
+  dist = np.where(hit, t, np.inf).min(axis=(-2, -1), initial=np.inf)
+  return np.minimum(dist, detect_range)
+
@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+
+# This work is licensed under the terms of the MIT license.
+# For a copy, see <https://opensource.org/licenses/MIT>.
+
+from __future__ import division
+
+import copy
+import numpy as np
+
+import gym
+from gym import spaces
+from gym.utils import seeding
+
+from high_mpc import High_MPC
+from gym_carla.envs.detector import ray_polygon_distances
+
+
+def bicycle_step(state, u, L, dt, M=4):
+  """Integrate the kinematic bicycle model of High_MPC.f with M RK4 steps.
+
+  Args:
+    state: array (..., 4) of (x, y, phi, v).
+    u: array (..., 2) of (a, delta).
+    L: inter-axle distance, scalar or array broadcastable to state[..., 0].
+    dt: integration time.
+
+  Returns:
+    the state after dt, same shape as state.
+  """
+  a = u[..., 0]
+  delta = u[..., 1]
+  # the state components are integrated separately, stacking them on every
+  # stage costs more than the model itself for a single vehicle
+  yaw_rate = 2*np.sin(delta)/L
+  x, y, phi, v = np.moveaxis(np.asarray(state, dtype=float), -1, 0)
+
+  DT = dt/M
+  for _ in range(M):
+    k1_x, k1_y, k1_phi, k1_v = v*np.cos(phi+delta), v*np.sin(phi+delta), v*yaw_rate, a
+    phi_2, v_2 = phi + 0.5*DT*k1_phi, v + 0.5*DT*k1_v
+    k2_x, k2_y, k2_phi = v_2*np.cos(phi_2+delta), v_2*np.sin(phi_2+delta), v_2*yaw_rate
+    phi_3 = phi + 0.5*DT*k2_phi
+    k3_x, k3_y, k3_phi = v_2*np.cos(phi_3+delta), v_2*np.sin(phi_3+delta), v_2*yaw_rate
+    phi_4, v_4 = phi + DT*k3_phi, v + DT*a
+    k4_x, k4_y, k4_phi = v_4*np.cos(phi_4+delta), v_4*np.sin(phi_4+delta), v_4*yaw_rate
+    x = x + DT*(k1_x + 2*k2_x + 2*k3_x + k4_x)/6
+    y = y + DT*(k1_y + 2*k2_y + 2*k3_y + k4_y)/6
+    phi = phi + DT*(k1_phi + 2*k2_phi + 2*k3_phi + k4_phi)/6
+    v = v + DT*a
+  return np.stack(np.broadcast_arrays(x, y, phi, v), axis=-1)
+
+
+def get_box_polygons(x, y, yaw, l, w):
+  """Get the bounding box polygons of vehicles, as in CarlaEnv._get_actor_polygons.
+
+  Args:
+    x, y, yaw: arrays of the vehicle poses (yaw in rad).
+    l, w: half length and half width of the boxes.
+
+  Returns:
+    array (..., 4, 2) of the box corners.
+  """
+  x, y, yaw = np.broadcast_arrays(x, y, yaw)
+  poly_local = np.array([[l, w], [l, -w], [-l, -w], [-l, w]])
+  cos, sin = np.cos(yaw)[..., None], np.sin(yaw)[..., None]
+  px = cos*poly_local[:, 0] - sin*poly_local[:, 1] + x[..., None]
+  py = sin*poly_local[:, 0] + cos*poly_local[:, 1] + y[..., None]
+  return np.stack([px, py], axis=-1)
+
+
+def polygons_overlap(poly, polys):
+  """Check whether convex polygons overlap with the separating axis theorem.
+
+  Args:
+    poly: array (..., 4, 2), one rectangle per batch entry.
+    polys: array (..., K, 4, 2), K rectangles per batch entry.
+
+  Returns:
+    bool array (..., K).
+  """
+  poly = np.broadcast_to(poly[..., None, :, :], polys.shape)
+  # edge normals of both rectangles, two per rectangle are enough
+  axes = np.concatenate([poly[..., 1:3, :] - poly[..., 0:2, :],
+                         polys[..., 1:3, :] - polys[..., 0:2, :]], axis=-2)
+  axes = np.stack([-axes[..., 1], axes[..., 0]], axis=-1)
+  proj_a = np.einsum('...ad,...cd->...ac', axes, poly)
+  proj_b = np.einsum('...ad,...cd->...ac', axes, polys)
+  separated = (proj_a.max(-1) < proj_b.min(-1)) | (proj_b.max(-1) < proj_a.min(-1))
+  return ~separated.any(-1)
+
+
+class KinematicRoadEnv(gym.Env):
+  """Road, vehicles, spaces, rewards and terminations shared by the kinematic envs.
+
+  The methods work on the state arrays with any leading batch shape:
+  CarlaKinematicEnv holds one scenario, VectorCarlaEnv N of them.
+  """
+
+  def __init__(self, params):
+    # parameters
+    self.max_past_step = params['max_past_step']
+    self.dt = params['dt']
+    self.max_time_episode = params['max_time_episode']
+    self.detect_range = params['detect_range']
+    self.detector_num = params['detector_num']
+    self.detect_angle = params['detect_angle']
+
+    # road and vehicle geometry, as measured in Town05 with the Tesla Model 3
+    self.lane_width = params.get('lane_width', 3.5)
+    self.vehicle_length = params.get('vehicle_length', 4.79)
+    self.vehicle_width = params.get('vehicle_width', 2.16)
+    self.inter_axle_distance = self.vehicle_length
+    self.agent_speed = params.get('agent_speed', (4.0, 7.0))
+    self.ego_init_s = params.get('ego_init_s', 0.0)
+
+    # MPC solver options, see CarlaEnv
+    self.mpc_codegen = params.get('mpc_codegen', False)
+    self.mpc_solver = params.get('mpc_solver', 'ipopt')
+
+    # action and observation spaces of a single scenario
+    self.act_high = np.array([20.0, 15.0, np.pi/2, 20.0, 50.0, 50.0, 50.0, 50.0], dtype=np.float32)
+    self.act_low = np.array([-40.0, -15.0, -np.pi/2, -20.0, 0.0, 0.0, 0.0, 0.0], dtype=np.float32)
+    self.obs_high, self.obs_low = [275.0, 10.0, np.pi/2, 20.0], [0.0, -10, -np.pi/2, -5.0]
+    for i in range(self.detector_num):
+      self.obs_high.append(50.0)
+      self.obs_low.append(0.0)
+    self.obs_high = np.array(self.obs_high, dtype=np.float32)
+    self.single_action_space = spaces.Box(
+      low=self.act_low, high=self.act_high, dtype=np.float32
+      )
+    self.single_observation_space = spaces.Box(low=np.array(self.obs_low), high=np.array(self.obs_high), dtype=np.float32)
+    self.action_space = self.single_action_space
+    self.observation_space = self.single_observation_space
+
+    self.plan_T = 5.0 # Prediction horizon for MPC
+    self.plan_dt = 0.1 # Sampling time step for MPC
+
+    # simulation parameters ....
+    self.sim_T = 50          # Episode length, seconds
+    self.sim_dt = 0.1       # simulation time step
+    self.max_episode_steps = int(self.sim_T/self.sim_dt)
+
+    # beam directions relative to the ego heading, CARLA yaw is clockwise
+    self.detector_angles = -np.deg2rad(-self.detect_angle/2 + \
+      (self.detect_angle/(self.detector_num-1))*np.arange(self.detector_num))
+
+    self.road_bound_abs = 1.5 * self.lane_width
+    self.center_lane_id = -2
+    self.noise_bound = 5
+    self.num_agents = 9
+    self.max_vehicle_distance = 8
+
+    # Destination
+    self.goal_state = np.array([275, 0, 0, 8]).tolist() # 275
+    self.dests = self.goal_state
+    self.road_len = self.goal_state[0]
+
+    # Record the time of total steps and resetting steps
+    self.reset_step = 0
+    self.total_step = 0
+
+    # the scenarios are drawn from np_random, see seed()
+    self.seed()
+
+  def seed(self, seed=None):
+    self.np_random, seed = seeding.np_random(seed)
+    return [seed]
+
+  def _spawn_agent_s(self, noise):
+    """Stations of the agents, 15 m apart plus noise (..., num_agents), pushed apart where too close."""
+    s = 15.0*np.arange(1, self.num_agents+1) + noise
+    for i in range(1, self.num_agents):
+      distance_refinement = np.maximum(self.max_vehicle_distance - (s[..., i] - s[..., i-1]), 0)
+      s[..., i-1] -= distance_refinement / 2
+      s[..., i] += distance_refinement / 2
+    return s
+
+  def _move_agents(self):
+    """Advance the agents along their lane, keeping a gap to the vehicle ahead."""
+    K = self.num_agents
+    s = np.concatenate([self.agent_s, self.ego_array[..., 0:1]], axis=-1)
+    d = np.concatenate([self.agent_d, self.ego_array[..., 1:2]], axis=-1)
+    gap = s[..., None, :] - self.agent_s[..., :, None] - self.vehicle_length
+    ahead = (gap > -self.vehicle_length) & (np.abs(d[..., None, :] - self.agent_d[..., :, None]) < self.lane_width/2)
+    ahead[..., np.arange(K), np.arange(K)] = False
+    min_gap = np.where(ahead, gap, np.inf).min(axis=-1)
+    self.agent_v = np.clip((min_gap - 2.0) / 1.5, 0, self.agent_speed_des)
+    self.agent_s = self.agent_s + self.agent_v * self.sim_dt
+
+  def _collisions(self):
+    """Whether the ego box overlaps an agent box, checked for the agents closer than a box diagonal."""
+    near = np.hypot(self.agent_s - self.ego_array[..., 0:1], self.agent_d - self.ego_array[..., 1:2]) < \
+      np.hypot(self.vehicle_length, self.vehicle_width)
+    if not near.any():
+      return np.zeros(near.shape[:-1], dtype=bool)
+    ego_poly = get_box_polygons(self.ego_array[..., 0], self.ego_array[..., 1], self.ego_array[..., 2], \
+                                self.vehicle_length/2, self.vehicle_width/2)
+    agent_poly = get_box_polygons(self.agent_s, self.agent_d, 0.0, self.vehicle_length/2, self.vehicle_width/2)
+    return (polygons_overlap(ego_poly, agent_poly) & near).any(axis=-1)
+
+  def _detector_distances(self):
+    """Obstacle distances of the detector beams."""
+    agent_poly = get_box_polygons(self.agent_s, self.agent_d, 0.0, self.vehicle_length/2, self.vehicle_width/2)
+    return ray_polygon_distances(self.ego_array[..., :2], self.ego_array[..., 2:3] + self.detector_angles, \
+                                 agent_poly, self.detect_range)
+
+  def _rewards(self, collided):
+    """Calculate the reward, as CarlaEnv._get_reward."""
+    # reward for collision
+    r_collision = np.where(collided, -100.0, 0.0)
+
+    # reward for steering, CARLA steer is normalized to [-1, 1]
+    r_steer = -np.abs(np.clip(self.steer, -1, 1))
+
+    r_speed_ep = np.where(self.arrived, self.road_len / np.maximum(self.t, self.sim_dt), 0.0)
+
+    r_time = np.where(self.out_of_time, -100.0, 0.0)
+
+    # r_forward is always zero in CarlaEnv, travelled_dist is never set
+
+    # cost for out of road, the last corner off the road counts as in CarlaEnv
+    r_road = np.zeros(np.shape(self.steer))
+    yaw = self.ego_array[..., 2]
+    cos, sin = np.cos(yaw), np.sin(yaw)
+    for alpha_x, alpha_y in [(1, 1), (1, -1), (-1, -1), (-1, 1)]:
+      alpha_x, alpha_y = alpha_x*self.vehicle_width/2, alpha_y*self.vehicle_length/2
+      corner_y = self.ego_array[..., 1] + (sin*alpha_x + cos*alpha_y)
+      dist_road = np.abs(np.abs(corner_y) - self.road_bound_abs)
+      r_road = np.where(np.abs(corner_y) >= self.road_bound_abs, -dist_road, r_road)
+
+    return r_collision + r_time + r_steer + r_speed_ep + r_road
+
+  def _terminal_flags(self, collided):
+    """Set out_of_time and arrived in the order of CarlaEnv._terminal, and return whether the episodes end."""
+    collided = np.asarray(collided)
+    self.out_of_time = ~collided & (self.time_step > self.max_time_episode)
+    self.arrived = ~collided & ~self.out_of_time & (self.ego_array[..., 0] >= self.goal_state[0])
+    return collided | self.out_of_time | self.arrived
+
+
+class CarlaKinematicEnv(KinematicRoadEnv):
+  """A CARLA-free version of CarlaEnv on a straight 3-lane road.
+
+  The ego vehicle is integrated with the kinematic bicycle model of High_MPC,
+  the agents keep their lane at a constant desired speed and slow down behind
+  the vehicle ahead. Observations, rewards and terminations follow CarlaEnv.
+  """
+
+  def __init__(self, params):
+    super().__init__(params)
+    self.high_mpc = None
+
+  def reset(self):
+    # reset time
+    self.t = 0
+    # reset reward
+    self.reward = 0
+    # reset done
+    self.done = False
+    self.arrived = False
+    self.out_of_time = False
+    self.collided = False
+    self.collision_hist = []
+
+    # the ego state is (s, d, yaw, speed) in the Frenet frame of the road
+    self.ego_array = np.array([self.ego_init_s, 0.0, 0.0, 0.0])
+    self.steer = 0.0
+
+    # spawn the moving obstacles (agents)
+    noise = self.np_random.uniform(-self.noise_bound, self.noise_bound, size=self.num_agents)
+    self.s_list = self._spawn_agent_s(noise).tolist()
+    lane_ids = -self.np_random.integers(1, 4, size=self.num_agents)
+    self.agent_s = np.array(self.s_list)
+    self.agent_d = (lane_ids - self.center_lane_id) * self.lane_width
+    self.agent_speed_des = self.np_random.uniform(*self.agent_speed, size=self.num_agents)
+    self.agent_v = self.agent_speed_des.copy()
+
+    # Update timesteps
+    self.time_step=0
+    self.reset_step+=1
+
+    self.travelled_dist = None
+
+    obs = self._get_obs()
+
+    # the NLP solver is cached by High_MPC, so only the warm start is rebuilt here
+    self.high_mpc = High_MPC(T=self.plan_T, dt=self.plan_dt, L=self.inter_axle_distance, vehicle_length=self.vehicle_length,\
+                            vehicle_width = self.vehicle_width, lane_width = self.lane_width,  init_state=self.ego_state,\
+                            codegen=self.mpc_codegen, solver_mode=self.mpc_solver)
+
+    return obs
+
+  def step(self, action):
+    # Same acceleration saturation as the throttle and brake of CarlaEnv
+    acc = np.clip(float(action[0]), -8.0, 3.0)
+    self.steer = float(action[1])
+
+    self.ego_array = bicycle_step(self.ego_array, np.array([acc, self.steer]), self.inter_axle_distance, self.sim_dt)
+    self.ego_array[3] = max(self.ego_array[3], 0.0)
+    self._move_agents()
+
+    # Update timesteps
+    self.t += self.sim_dt
+    self.time_step += 1
+    self.total_step += 1
+
+    obs = self._get_obs()
+    # state information
+    info = {
+      'ego_state': self.ego_state
+    }
+
+    self.done = self._terminal()
+    r = self._get_reward()
+
+    return obs,  r, self.done, copy.deepcopy(info)
+
+  def render(self):
+    return None
+
+  def _get_agent_polygons(self):
+    return get_box_polygons(self.agent_s, self.agent_d, 0.0, self.vehicle_length/2, self.vehicle_width/2)
+
+  def _get_obs(self):
+    """Get the observations."""
+    self.ego_state = self.ego_array.tolist()
+
+    if self._collisions():
+      self.collision_hist.append(1.0)
+
+    self.distance_measurements = self._detector_distances().tolist()
+
+    obs = []
+    obs += self.ego_state
+    obs += self.distance_measurements
+
+    obs = np.array(obs)
+
+    return obs
+
+  def _get_reward(self):
+    """Calculate the reward."""
+    return float(self._rewards(len(self.collision_hist) > 0))
+
+  def _terminal(self):
+    """Calculate whether to terminate the current episode."""
+    self.collided = len(self.collision_hist) > 0
+    done = bool(self._terminal_flags(self.collided))
+    self.out_of_time, self.arrived = bool(self.out_of_time), bool(self.arrived)
+    if self.collided:
+      print('end with collision')
+    elif self.out_of_time:
+      print('end with time')
+    return done
@@ -10,9 +10,14 @@
 # For a copy, see <https://opensource.org/licenses/MIT>.
 
 import carla
+import hashlib
 import math
+import numpy as np
+import os
 import pygame
+import tempfile
 import weakref
+import zipfile
 
 # Colors
 COLOR_BUTTER_0 = pygame.Color(252, 233, 79)
@@ -55,6 +60,13 @@ COLOR_ALUMINIUM_5 = pygame.Color(46, 52, 54)
 COLOR_WHITE = pygame.Color(255, 255, 255)
 COLOR_BLACK = pygame.Color(0, 0, 0)
 
+# Directory of the rendered road maps, see MapImage
+DEFAULT_MAP_CACHE_DIR = os.environ.get('GYM_CARLA_MAP_CACHE', \
+  os.path.join(os.path.expanduser('~'), '.cache', 'gym_carla', 'maps'))
+
+# Bump when draw_road_map changes, so the old cached maps are not reused
+MAP_CACHE_VERSION = 1
+
 
 class Util(object):
 
@@ -83,10 +95,19 @@ class Util(object):
 
 class MapImage(object):
 
-  def __init__(self, carla_world, carla_map, pixels_per_meter):
+  def __init__(self, carla_world, carla_map, pixels_per_meter, cache_dir=None):
     self._pixels_per_meter = pixels_per_meter
     self.scale = 1.0
 
+    # The road raster is reloaded from disk when this town was already drawn at this scale,
+    # an empty cache_dir disables the cache
+    if cache_dir is None:
+      cache_dir = DEFAULT_MAP_CACHE_DIR
+    self.cache_path = self._get_cache_path(carla_map, cache_dir) if cache_dir else None
+    if self.cache_path is not None and self._load(self.cache_path):
+      self.surface = self.big_map_surface
+      return
+
     waypoints = carla_map.generate_waypoints(2)
     margin = 50
     max_x = max(waypoints, key=lambda x: x.transform.location.x).transform.location.x + margin
@@ -109,6 +130,46 @@ class MapImage(object):
 
     self.surface = self.big_map_surface
 
+    if self.cache_path is not None:
+      self._save(self.cache_path)
+
+  def _get_cache_path(self, carla_map, cache_dir):
+    """Get the cache file of the map, keyed by the town, its OpenDRIVE content and the scale."""
+    key = hashlib.sha1()
+    key.update(carla_map.to_opendrive().encode())
+    key.update(repr((MAP_CACHE_VERSION, float(self._pixels_per_meter), self.scale)).encode())
+    town = os.path.basename(carla_map.name)
+    return os.path.join(cache_dir, '{}_{}.npz'.format(town, key.hexdigest()[:16]))
+
+  def _load(self, path):
+    """Load the map surface and its geometry, return whether it succeeded."""
+    try:
+      with np.load(path) as data:
+        surface = data['surface']
+        self._world_offset = tuple(data['world_offset'])
+        self.width = float(data['width'])
+        self._pixels_per_meter = float(data['pixels_per_meter'])
+    except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+      return False
+    self.big_map_surface = pygame.surfarray.make_surface(surface).convert()
+    return True
+
+  def _save(self, path):
+    """Save the map surface and its geometry, atomically so readers never see a partial file."""
+    tmp_path = None
+    try:
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      fd, tmp_path = tempfile.mkstemp(suffix='.npz', dir=os.path.dirname(path))
+      with os.fdopen(fd, 'wb') as f:
+        np.savez_compressed(f, surface=pygame.surfarray.array3d(self.big_map_surface), \
+          world_offset=np.array(self._world_offset), width=self.width, \
+          pixels_per_meter=self._pixels_per_meter)
+      os.replace(tmp_path, path)
+    except OSError as e:
+      print('Could not cache the map image: {}'.format(e))
+      if tmp_path is not None and os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
   def draw_road_map(self, map_surface, carla_world, carla_map, world_to_pixel, world_to_pixel_width):
     # Set background black
     map_surface.fill(COLOR_BLACK)
@@ -407,7 +468,8 @@ class BirdeyeRender(object):
     self.map_image = MapImage(
       carla_world=self.world,
       carla_map=self.town_map,
-      pixels_per_meter=self.params['pixels_per_meter'])
+      pixels_per_meter=self.params['pixels_per_meter'],
+      cache_dir=self.params.get('map_cache_dir'))
 
     self.original_surface_size = min(self.params['screen_size'][0], self.params['screen_size'][1])
     self.surface_size = self.map_image.big_map_surface.get_width()
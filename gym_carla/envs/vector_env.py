@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+# This work is licensed under the terms of the MIT license.
+# For a copy, see <https://opensource.org/licenses/MIT>.
+
+from __future__ import division
+
+import numpy as np
+
+from gym.vector.utils import batch_space
+
+from high_mpc import High_MPC
+from gym_carla.envs.kinematic_env import KinematicRoadEnv, bicycle_step
+
+
+class VectorCarlaEnv(KinematicRoadEnv):
+  """N scenarios of CarlaKinematicEnv advanced by one vectorized update.
+
+  The scenarios are held as structure-of-arrays, every step(controls) moves
+  all egos and agents at once and computes the stacked observations, rewards
+  and terminations. Finished scenarios are reset automatically, their last
+  observation is returned in info['terminal_obs'].
+  """
+
+  def __init__(self, params):
+    super().__init__(params)
+    self.num_envs = params.get('num_envs', 8)
+
+    # action and observation spaces of the batch
+    self.action_space = batch_space(self.single_action_space, self.num_envs)
+    self.observation_space = batch_space(self.single_observation_space, self.num_envs)
+
+    # structure-of-arrays state of the N scenarios
+    N, K = self.num_envs, self.num_agents
+    self.ego_array = np.zeros((N, 4))
+    self.steer = np.zeros(N)
+    self.t = np.zeros(N)
+    self.time_step = np.zeros(N, dtype=int)
+    self.agent_s = np.zeros((N, K))
+    self.agent_d = np.zeros((N, K))
+    self.agent_v = np.zeros((N, K))
+    self.agent_speed_des = np.zeros((N, K))
+    self.collided = np.zeros(N, dtype=bool)
+    self.arrived = np.zeros(N, dtype=bool)
+    self.out_of_time = np.zeros(N, dtype=bool)
+
+    self.high_mpcs = None
+
+  @property
+  def ego_state(self):
+    return self.ego_array.tolist()
+
+  def reset(self):
+    self._reset_envs(np.ones(self.num_envs, dtype=bool))
+    return self._get_obs()
+
+  def step(self, controls):
+    """Advance all scenarios by one step.
+
+    Args:
+      controls: array (N, 2) of the MPC outputs (acceleration, steer).
+
+    Returns:
+      obs (N, obs_dim), rewards (N,), dones (N,) and an info dict of arrays.
+    """
+    controls = np.asarray(controls, dtype=float)
+    # Same acceleration saturation as the throttle and brake of CarlaEnv
+    acc = np.clip(controls[:, 0], -8.0, 3.0)
+    self.steer = controls[:, 1]
+
+    self.ego_array = bicycle_step(self.ego_array, np.stack([acc, self.steer], axis=-1), \
+                                  self.inter_axle_distance, self.sim_dt)
+    self.ego_array[:, 3] = np.maximum(self.ego_array[:, 3], 0.0)
+    self._move_agents()
+
+    # Update timesteps
+    self.t += self.sim_dt
+    self.time_step += 1
+    self.total_step += self.num_envs
+
+    obs = self._get_obs()
+    dones = self._terminal()
+    r = self._get_reward()
+    info = {
+      'ego_state': self.ego_array.copy(),
+      'collided': self.collided.copy(),
+      'arrived': self.arrived.copy(),
+      'out_of_time': self.out_of_time.copy(),
+      'terminal_obs': obs.copy()
+    }
+
+    # auto-reset the finished scenarios
+    if dones.any():
+      self._reset_envs(dones)
+      obs[dones] = self._get_obs()[dones]
+
+    return obs, r, dones, info
+
+  def solve_mpc(self, ref_trajs):
+    """Run the MPC of all scenarios in one batched solver call.
+
+    Args:
+      ref_trajs: N references laid out as for High_MPC.solve.
+
+    Returns:
+      the controls (N, 2) to pass to step, and the predicted trajectories.
+    """
+    w0 = [high_mpc.warm_start.w0 for high_mpc in self.high_mpcs]
+    opt_u, x_array, x_N = self.high_mpcs[0].solve_batch(ref_trajs, x0_list=w0)
+    w = np.concatenate([x_array.reshape(self.num_envs, -1), x_N], axis=1)
+    for i, high_mpc in enumerate(self.high_mpcs):
+      high_mpc.warm_start.update(w[i])
+    return opt_u, x_array
+
+  def render(self):
+    return None
+
+  def _reset_envs(self, mask):
+    """Reset the scenarios selected by the bool array mask."""
+    n, K = int(mask.sum()), self.num_agents
+
+    self.t[mask] = 0
+    self.time_step[mask] = 0
+    self.collided[mask] = False
+    self.arrived[mask] = False
+    self.out_of_time[mask] = False
+    self.ego_array[mask] = [self.ego_init_s, 0.0, 0.0, 0.0]
+    self.steer[mask] = 0.0
+
+    # spawn the agents 15 m apart with noise, then push apart the ones too close
+    s = self._spawn_agent_s(self.np_random.uniform(-self.noise_bound, self.noise_bound, size=(n, K)))
+    lane_ids = -self.np_random.integers(1, 4, size=(n, K))
+    self.agent_s[mask] = s
+    self.agent_d[mask] = (lane_ids - self.center_lane_id) * self.lane_width
+    self.agent_speed_des[mask] = self.np_random.uniform(*self.agent_speed, size=(n, K))
+    self.agent_v[mask] = self.agent_speed_des[mask]
+
+    self.reset_step += n
+
+    # the NLP solver is shared by all High_MPC instances, each keeps its warm start
+    if self.high_mpcs is None:
+      self.high_mpcs = [High_MPC(T=self.plan_T, dt=self.plan_dt, L=self.inter_axle_distance, \
+                                 vehicle_length=self.vehicle_length, vehicle_width=self.vehicle_width, \
+                                 lane_width=self.lane_width, init_state=self.ego_array[i].tolist(), \
+                                 codegen=self.mpc_codegen, solver_mode=self.mpc_solver)
+                        for i in range(self.num_envs)]
+    else:
+      for i in np.flatnonzero(mask):
+        self.high_mpcs[i].reset(self.ego_array[i].tolist())
+
+  def _get_obs(self):
+    """Get the stacked observations, and record the collisions."""
+    self.collided |= self._collisions()
+    return np.concatenate([self.ego_array, self._detector_distances()], axis=1)
+
+  def _get_reward(self):
+    """Calculate the rewards, as CarlaEnv._get_reward for every scenario."""
+    return self._rewards(self.collided)
+
+  def _terminal(self):
+    """Calculate which scenarios terminate, in the order of CarlaEnv._terminal."""
+    return self._terminal_flags(self.collided)
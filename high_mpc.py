@@ -4,17 +4,110 @@ Standard MPC for Vehicle Control
 import casadi as ca
 import numpy as np
 import time
+import os
+import hashlib
+import shutil
+import subprocess
+import tempfile
 from os import system
 
+# built solvers shared by every High_MPC with the same problem parameters, keyed by
+# (T, dt, L, vehicle_length, vehicle_width, lane_width, codegen, solver_mode, qpsol, max_qp_iter)
+_SOLVER_CACHE = {}
+
+# members built by _initDynamics and shared through the cache
+_SHARED = ("f", "_F", "solver", "_warm_solver", "lbw", "ubw", "lbg", "ubg", "so_path", "_cost", \
+           "_constraints", "_full_solver", "_rti_lin", "_qp", "_sqp_curv", "_sqp_hess", "_batch_solvers")
+
+# full IPOPT, SQP to convergence with a QP solver, or a single Gauss-Newton SQP step per tick
+SOLVER_MODES = ("ipopt", "sqp", "rti")
+
+# default location of the compiled solvers, override with $HIGH_MPC_CACHE
+DEFAULT_CACHE_DIR = os.environ.get("HIGH_MPC_CACHE", \
+    os.path.join(os.path.expanduser("~"), ".cache", "high_mpc"))
+
+# flags used to compile the generated C code of the NLP
+CFLAGS = ["-fPIC", "-shared", "-O3"]
+
+def clear_solver_cache():
+    """
+    Drop every cached solver, forcing the next High_MPC to rebuild its NLP
+    """
+    _SOLVER_CACHE.clear()
+
+class WarmStart(object):
+    """
+    Primal and dual initial guess of the MPC, shifted by one stage between ticks
+    """
+    def __init__(self, s_dim, u_dim, N, F):
+        self._s_dim = s_dim
+        self._u_dim = u_dim
+        self._N = N
+        # discrete dynamics used to extend the shifted trajectory by one stage
+        self._F = F
+
+        self.w0 = None       # nlp variables, [x_0, u_0, x_1, ..., u_N-1, x_N]
+        self.lam_x0 = None   # multipliers of the variable bounds
+        self.lam_g0 = None   # multipliers of the constraints, [x_0 - P, x_1 - F(x_0, u_0), ...]
+        self.warm = False    # True once w0 and the multipliers come from a shifted solution
+
+    def reset(self, s0, u0):
+        """
+        Cold start: constant state and control, zero multipliers
+        """
+        self.w0 = np.array(list(s0) + (list(u0) + list(s0)) * self._N, dtype=float)
+        self.lam_x0 = np.zeros_like(self.w0)
+        self.lam_g0 = np.zeros(self._s_dim * (self._N+1))
+        self.warm = False
+
+    def update(self, w, lam_x=None, lam_g=None):
+        """
+        Shift a solution by one stage. The tail is padded with the last control
+        and the last state simulated forward with it; the multipliers are
+        shifted the same way and repeat their last stage.
+        """
+        n = self._s_dim + self._u_dim
+        w = np.asarray(w, dtype=float).reshape(-1)
+        u_last = w[-n:-self._s_dim]
+        x_next = self._F(w[-self._s_dim:], u_last).full().reshape(-1)
+        self.w0 = np.concatenate([w[n:], u_last, x_next])
+
+        if lam_x is not None:
+            lam_x = np.asarray(lam_x, dtype=float).reshape(-1)
+            self.lam_x0 = np.concatenate([lam_x[n:], lam_x[-n:]])
+        if lam_g is not None:
+            lam_g = np.asarray(lam_g, dtype=float).reshape(-1)
+            self.lam_g0 = np.concatenate([lam_g[self._s_dim:], lam_g[-self._s_dim:]])
+        self.warm = lam_x is not None and lam_g is not None
+
 #
 class High_MPC(object):
     """
     Nonlinear MPC
     """
-    def __init__(self, T, dt, L, vehicle_length, vehicle_width, lane_width = 4, init_state=None, init_u=None):
+    def __init__(self, T, dt, L, vehicle_length, vehicle_width, lane_width = 4, init_state=None, init_u=None, \
+                codegen=False, cache_dir=None, solver_mode="ipopt", qpsol="osqp", max_qp_iter=4000, \
+                rti_max_du=(1.0, 0.1), max_sqp_iter=50):
         """
         Nonlinear MPC for vehicle control        
+
+        With codegen=True the NLP is generated as C code, compiled once into a
+        shared library under cache_dir and reloaded from there on later runs.
+        The first build takes minutes, later runs with the same problem
+        parameters skip the code generation and only load the library.
+        Without a working C compiler the interpreted solver is used instead.
+
+        solver_mode selects IPOPT run to convergence ("ipopt"), an SQP method
+        run to convergence in at most max_sqp_iter iterations, whose QPs are
+        solved with qpsol ("sqp", qpoases or osqp), or the real-time iteration
+        ("rti"): one Gauss-Newton SQP step per call, warm started from the
+        shifted previous solution, whose QP is capped at max_qp_iter
+        iterations to bound the latency of every tick. The first tick after
+        reset() is solved to convergence, and every later step may change the
+        controls by at most rti_max_du (a, delta).
         """
+        if solver_mode not in SOLVER_MODES:
+            raise ValueError("solver_mode must be one of {}, got {}".format(SOLVER_MODES, solver_mode))
 
         # Time constant
         self._T = T
@@ -35,6 +128,16 @@ class High_MPC(object):
         self.v_min = 0
         self.v_max = 10
 
+        self.codegen = codegen
+        self.cache_dir = DEFAULT_CACHE_DIR if cache_dir is None else cache_dir
+        self.so_path = None
+
+        self.solver_mode = solver_mode
+        self.qpsol = qpsol
+        self.max_qp_iter = max_qp_iter
+        self.rti_max_du = rti_max_du
+        self.max_sqp_iter = max_sqp_iter
+
         #
         # state dimension (x, y,           # vehicle position
         #                  v,                    # linear velocity
@@ -52,18 +155,63 @@ class High_MPC(object):
         self._Q_u = np.diag([0.1, 0.1]) # a, delta self._Q_u = np.diag([0.1, 0.1]) # a, delta
         self._Q_delta_u = np.diag([1, 1]) # delta_a, delta_steer
 
+        # The NLP only depends on these parameters, so the CasADi graph and
+        # the IPOPT instance are built once per key and shared afterwards.
+        self.key = (float(T), float(dt), float(L), float(vehicle_length), \
+                    float(vehicle_width), float(lane_width), bool(codegen), solver_mode, qpsol, max_qp_iter)
+        cached = _SOLVER_CACHE.get(self.key)
+        if cached is None:
+            self._initDynamics()
+            self._batch_solvers = {}
+            _SOLVER_CACHE[self.key] = {name: getattr(self, name) for name in _SHARED}
+        else:
+            for name, value in cached.items():
+                setattr(self, name, value)
+
+        # statistics of the last call of solve()
+        self.solve_time = None
+        self.last_cost = None
+        self.iter_count = None
+
+        self.warm_start = WarmStart(self._s_dim, self._u_dim, self._N, self._F)
+
+        # trust region of the real-time iteration, only the controls are bounded
+        n = self._s_dim + self._u_dim
+        self._rti_step = np.full(self._s_dim + n*self._N, np.inf)
+        for k in range(self._N):
+            self._rti_step[self._s_dim+k*n : self._s_dim+k*n+self._u_dim] = rti_max_du
+
+        #print(init_state)
+        self.reset(init_state, init_u)
+
+    @property
+    def nlp_w0(self):
+        """
+        Initial guess of the nlp variables for the next solve
+        """
+        return self.warm_start.w0
+
+    def reset(self, init_state=None, init_u=None):
+        """
+        Reset the initial state, control action and the warm start of the NLP
+        """
         # initial state and control action
         if init_state is None:
             self._vehicle_s0 = [0.0, 0.0, 0.0, 0.0]
         else:
-            self._vehicle_s0 = init_state
+            self._vehicle_s0 = list(init_state)
         if init_u is None:
             self._vehicle_u0 = [0.0, 0.0]
         else:
-            self._vehicle_u0 = init_u
+            self._vehicle_u0 = list(init_u)
 
-        #print(init_state)
-        self._initDynamics()
+        # initial guess of nlp variables, ordered as [x_0, u_0, x_1, ..., u_N-1, x_N]
+        self.warm_start.reset(self._vehicle_s0, self._vehicle_u0)
+
+        # problem and solution of the last solve, kept for convergence_gap()
+        self._last_w0 = None
+        self._last_p = None
+        self._last_x = None
 
     def _initDynamics(self,):
         # # # # # # # # # # # # # # # # # # # 
@@ -101,6 +249,7 @@ class High_MPC(object):
                 
         # # Fold
         F = self.sys_dynamics(self._dt)
+        self._F = F
         fMap = F.map(self._N, "openmp") # parallel
         
         # # # # # # # # # # # # # # # 
@@ -124,16 +273,25 @@ class High_MPC(object):
         f_cost_u = ca.Function('cost_u', [Delta_u], [cost_u])
         f_cost_delta_u = ca.Function('cost_delta_u', [Delta_delta_u], [cost_delta_u])
 
+        # the tracking weights are parameters of the NLP, so they are an input of the cost
+        Weight = ca.SX.sym("Weight", self._s_dim)
+        self._Q_tra = ca.diag(ca.vertcat(
+            100*Weight[0], 100*Weight[1],  # delta_x, delta_y 100 100
+            10*Weight[2], # delta_phi
+            10*Weight[3])) #  delta_v
+        cost_tra = Delta_p.T @ self._Q_tra @ Delta_p
+        f_cost_tra = ca.Function('cost_tra', [Delta_p, Weight], [cost_tra])
+
         #
         # # # # # # # # # # # # # # # # # # # # 
         # # ---- Non-linear Optimization -----
         # # # # # # # # # # # # # # # # # # # #
         self.nlp_w = []       # nlp variables
-        self.nlp_w0 = []      # initial guess of nlp variables
         self.lbw = []         # lower bound of the variables, lbw <= nlp_x
         self.ubw = []         # upper bound of the variables, nlp_x <= ubw
         #
         self.mpc_obj = 0      # objective 
+        self.nlp_res = []     # weighted residuals, mpc_obj = sum of their squares
         self.nlp_g = []       # constraint functions
         self.lbg = []         # lower bound of constrait functions, lbg < g
         self.ubg = []         # upper bound of constrait functions, g < ubg
@@ -160,7 +318,6 @@ class High_MPC(object):
         
         # "Lift" initial conditions
         self.nlp_w += [X[:, 0]]
-        self.nlp_w0 += self._vehicle_s0
         self.lbw += x_min
         self.ubw += x_max
         
@@ -172,7 +329,6 @@ class High_MPC(object):
         for k in range(self._N):
             #
             self.nlp_w += [U[:, k]]
-            self.nlp_w0 += self._vehicle_u0
             self.lbw += u_min
             self.ubw += u_max
             
@@ -181,14 +337,9 @@ class High_MPC(object):
 
             weight_k = P[ idx_k : idx_k_end]
             
-            self._Q_tra = np.diag([
-            100*weight_k[0], 100*weight_k[1],  # delta_x, delta_y 100 100
-            10*weight_k[2], # delta_phi
-            10*weight_k[3]]) #  delta_v
+            # square roots of the weights, for the Gauss-Newton residuals
+            sqrt_Q_tra = ca.sqrt(ca.vertcat(100*weight_k[0], 100*weight_k[1], 10*weight_k[2], 10*weight_k[3]))
 
-            cost_tra = Delta_p.T @ self._Q_tra @ Delta_p 
-            f_cost_tra = ca.Function('cost_tra', [Delta_p], [cost_tra])
-            
             # cost for tracking the goal position
             cost_goal_k, cost_tra_k = 0, 0
 
@@ -197,19 +348,23 @@ class High_MPC(object):
 
                 delta_s_k = (X[:, k+1] - P[self._s_dim+(self._s_dim*2)*1:])
                 cost_goal_k = f_cost_goal(delta_s_k)
+                self.nlp_res += [ca.DM(np.sqrt(np.diag(self._Q_goal))) * delta_s_k]
 
             else:
 
                 delta_s_k = (X[:, k+1] - P[self._s_dim+(self._s_dim*2)*1:])
                 cost_goal_k = f_cost_goal(delta_s_k)
+                self.nlp_res += [ca.DM(np.sqrt(np.diag(self._Q_goal))) * delta_s_k]
                                     
                 # cost for tracking the references
                 delta_p_k = (X[0:self._s_dim, k+1] - P[self._s_dim+(self._s_dim*2)*0 : \
                     self._s_dim+(self._s_dim*2)*(0+1)-self._s_dim]) 
-                cost_tra_k = f_cost_tra(delta_p_k) #* weight
+                cost_tra_k = f_cost_tra(delta_p_k, weight_k)
+                self.nlp_res += [sqrt_Q_tra * delta_p_k]
             
             delta_u_k = U[:, k]-[0, 0] #delta_u_k = U[:, k]-[self._gz, 0, 0, 0]
             cost_u_k = f_cost_u(delta_u_k)
+            self.nlp_res += [ca.DM(np.sqrt(np.diag(self._Q_u))) * delta_u_k]
 
             if k > 0:
                 delta_delta_u_k = U[:, k]-U[:, k-1]
@@ -217,12 +372,12 @@ class High_MPC(object):
                 delta_delta_u_k = U[:, k]-[0, 0]
             
             cost_delta_u_k = f_cost_delta_u(delta_delta_u_k)
+            self.nlp_res += [ca.DM(np.sqrt(np.diag(self._Q_delta_u))) * delta_delta_u_k]
 
             self.mpc_obj = self.mpc_obj + cost_goal_k + cost_u_k + cost_delta_u_k  +  cost_tra_k 
 
             # New NLP variable for state at end of interval
             self.nlp_w += [X[:, k+1]]
-            self.nlp_w0 += self._vehicle_s0
             self.lbw += x_min
             self.ubw += x_max
 
@@ -236,6 +391,19 @@ class High_MPC(object):
             'x': ca.vertcat(*self.nlp_w), 
             'p': P,               
             'g': ca.vertcat(*self.nlp_g)}        
+        self._cost = ca.Function('cost', [nlp_dict['x'], P], [self.mpc_obj])
+        self._constraints = ca.Function('constraints', [nlp_dict['x'], P], [nlp_dict['g']])
+
+        # options of the QP solver, the iteration cap bounds the time of one QP
+        if self.qpsol == "qpoases":
+            qpsol_options = {"sparse": True, "printLevel": "none"}
+            qp_iter_options = {"nWSR": self.max_qp_iter}
+        elif self.qpsol == "osqp":
+            # the SQP mode needs accurate steps to converge
+            qpsol_options = {"osqp": {"verbose": False, "eps_abs": 1e-6, "eps_rel": 1e-6}}
+            qp_iter_options = {"osqp": {"verbose": False, "max_iter": self.max_qp_iter}}
+        else:
+            qpsol_options, qp_iter_options = {}, {}
         
         # # # # # # # # # # # # # # # # # # # 
         # -- qpoases            
@@ -268,16 +436,150 @@ class High_MPC(object):
             "ipopt.print_level": 0, 
             "print_time": False
         }
+        # used only when the guess is a shifted primal and dual solution, a cold
+        # start with these runs into the iteration limit
+        warm_ipopt_options = dict(ipopt_options, **{
+            # keep the shifted guess instead of pushing it into the interior
+            "ipopt.warm_start_bound_push": 1e-6,
+            "ipopt.warm_start_mult_bound_push": 1e-6,
+            "ipopt.warm_start_slack_bound_push": 1e-6,
+            "ipopt.mu_init": 1e-3
+        })
         
-        # self.solver = ca.nlpsol("solver", "ipopt", nlp_dict, ipopt_options)
-        # # jit (just-in-time compilation)
-        # print("Generating shared library........")
-        # cname = self.solver.generate_dependencies("mpc_v1.c")  
-        # system('gcc -fPIC -shared -O3 ' + cname + ' -o ' + self.so_path) # -O3
-        
-        # # reload compiled mpc
-        #print(self.so_path)
-        self.solver = ca.nlpsol("solver", "ipopt", nlp_dict, ipopt_options)
+        self._rti_lin, self._qp, self._warm_solver = None, None, None
+        self._sqp_curv, self._sqp_hess = None, None
+        if self.solver_mode == "ipopt":
+            self.solver = ca.nlpsol("solver", "ipopt", nlp_dict, ipopt_options)
+            self._warm_solver = ca.nlpsol("warm_solver", "ipopt", nlp_dict, warm_ipopt_options)
+        elif self.solver_mode == "sqp":
+            self.solver = None
+            self._initSQP(nlp_dict, qpsol_options)
+        else:
+            self.solver = None
+            self._initRTI(nlp_dict, qpsol_options, qp_iter_options)
+
+        if self.codegen:
+            # ahead-of-time compilation, keeps the interpreted solver if it fails
+            if self.solver is not None:
+                self.so_path = self._compile(self.solver)
+                if self.so_path is not None:
+                    self.solver = ca.nlpsol("solver", "ipopt", self.so_path, ipopt_options)
+                    self._warm_solver = ca.nlpsol("warm_solver", "ipopt", self.so_path, warm_ipopt_options)
+            else:
+                self.so_path = self._compile(self._rti_lin, dependencies=False)
+                if self.so_path is not None:
+                    self._rti_lin = ca.external("rti_lin", self.so_path)
+
+        # reference solver run to convergence, used by convergence_gap() and solve_batch()
+        if self.solver_mode == "ipopt":
+            self._full_solver = self.solver
+        else:
+            self._full_solver = ca.nlpsol("full_solver", "ipopt", nlp_dict, ipopt_options)
+
+    def _initRTI(self, nlp_dict, qpsol_options, qp_iter_options):
+        """
+        Build the linearization of the NLP and the QP of the real-time iteration.
+        The objective is the sum of squares of the residuals R, so the
+        Gauss-Newton Hessian is 2 J_R^T J_R and needs no second derivatives.
+        """
+        w, p = nlp_dict['x'], nlp_dict['p']
+        R = ca.vertcat(*self.nlp_res)
+        G = nlp_dict['g']
+        J_R = ca.jacobian(R, w)
+        J_G = ca.jacobian(G, w)
+        # the initial state only enters the constraints, regularize its block
+        H = 2 * ca.mtimes(J_R.T, J_R) + 1e-6 * ca.SX.eye(w.shape[0])
+        g = 2 * ca.mtimes(J_R.T, R)
+        self._rti_lin = ca.Function('rti_lin', [w, p], [H, g, J_G, G], ['w', 'p'], ['H', 'g', 'A', 'G'])
+
+        # a QP stopped by the iteration cap still returns its last iterate
+        qp_options = dict(qpsol_options, error_on_fail=False)
+        qp_options.update(qp_iter_options)
+        self._qp = ca.conic("qp", self.qpsol, {'h': H.sparsity(), 'a': J_G.sparsity()}, qp_options)
+
+    def _initSQP(self, nlp_dict, qpsol_options):
+        """
+        Build the Hessian and the QP of the SQP mode, on the linearization of
+        the real-time iteration. The residuals are linear in the nlp variables,
+        so 2 J_R^T J_R is the exact Hessian of the objective; the curvature of
+        the dynamics is added stage by stage, each block clipped to its
+        nonnegative eigenvalues in _solve_sqp so that every QP is convex.
+        """
+        self._initRTI(nlp_dict, qpsol_options, {})
+        w, p = nlp_dict['x'], nlp_dict['p']
+        n = self._s_dim + self._u_dim
+
+        # Hessian of lam^T F(x_k, u_k) for the multipliers lam of x_k+1 = F(x_k, u_k)
+        xu = ca.SX.sym("xu", n)
+        lam = ca.SX.sym("lam", self._s_dim)
+        curv = ca.hessian(ca.dot(lam, self._F(xu[:self._s_dim], xu[self._s_dim:])), xu)[0]
+        self._sqp_curv = ca.Function('sqp_curv', [xu, lam], [curv]).map(self._N)
+
+        # Hessian of the objective plus the convexified blocks of the N stages
+        C = ca.SX.sym("C", n, n*self._N)
+        J_R = ca.jacobian(ca.vertcat(*self.nlp_res), w)
+        H = 2 * ca.mtimes(J_R.T, J_R) + 1e-6 * ca.SX.eye(w.shape[0]) + \
+            ca.diagcat(*[C[:, k*n:(k+1)*n] for k in range(self._N)], ca.SX(self._s_dim, self._s_dim))
+        self._sqp_hess = ca.Function('sqp_hess', [p, C], [H], ['p', 'C'], ['H'])
+
+        qp_options = dict(qpsol_options, error_on_fail=False)
+        if self.qpsol == "osqp":
+            # start every QP from the multipliers of the previous iterate
+            qp_options.update(warm_start_dual=True)
+        self._qp = ca.conic("qp", self.qpsol, {'h': H.sparsity(), 'a': self._rti_lin.sparsity_out('A')}, qp_options)
+
+    def _compile(self, solver, dependencies=True):
+        """
+        Generate the C code of the solver and compile it into a shared library
+        named after the problem parameters, so every distinct NLP is generated
+        and compiled only once. Returns the path of the library, or None
+        without a compiler. With dependencies=False a plain Function is
+        generated instead of the functions an nlpsol relies on.
+        """
+        so_path = self._library_path(solver.name())
+        if os.path.exists(so_path):
+            return so_path
+
+        cc = shutil.which(os.environ.get("CC", "gcc"))
+        if cc is None:
+            print("No C compiler found, using the interpreted MPC solver")
+            return None
+
+        print("Generating shared library........")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # CasADi writes the generated file to the working directory
+        cwd = os.getcwd()
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            os.chdir(tmp_dir)
+            if dependencies:
+                cname = solver.generate_dependencies("high_mpc_nlp.c")
+            else:
+                cname = solver.generate("high_mpc_nlp.c")
+            # compile next to the target and rename, concurrent builds never see a partial file
+            tmp_path = "{}.{}.tmp".format(so_path, os.getpid())
+            if subprocess.call([cc] + CFLAGS + [os.path.join(tmp_dir, cname), "-o", tmp_path]) != 0:
+                print("Compiling the MPC solver failed, using the interpreted MPC solver")
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                return None
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.replace(tmp_path, so_path)
+        return so_path
+
+    def _library_path(self, name):
+        """
+        Path of the compiled function name for the problem parameters of
+        self.key. The hash also covers this file, the compiler flags and the
+        CasADi version, which change the generated code for the same key.
+        """
+        with open(os.path.abspath(__file__), "rb") as f:
+            source = f.read()
+        key = repr((self.key, name, CFLAGS, ca.__version__)).encode()
+        digest = hashlib.sha1(key + source).hexdigest()[:16]
+        return os.path.join(self.cache_dir, "high_mpc_{}.so".format(digest))
 
     def solve(self, ref_states):
 
@@ -285,20 +587,37 @@ class High_MPC(object):
         # -------- solve NLP ---------
         # # # # # # # # # # # # # # # #
         #
-        self.sol = self.solver(
-            x0=self.nlp_w0, 
+        if self.solver_mode == "rti":
+            return self._solve_rti(ref_states)
+        if self.solver_mode == "sqp":
+            return self._solve_sqp(ref_states)
+
+        # IPOPT keeps a shifted primal and dual guess close to the boundary
+        solver = self.solver
+        if self._warm_solver is not None and self.warm_start.warm:
+            solver = self._warm_solver
+
+        start_time = time.perf_counter()
+        self._last_w0, self._last_p = self.warm_start.w0, ref_states
+        self.sol = solver(
+            x0=self.warm_start.w0, 
+            lam_x0=self.warm_start.lam_x0, 
+            lam_g0=self.warm_start.lam_g0, 
             lbx=self.lbw, 
             ubx=self.ubw, 
             p=ref_states, 
             lbg=self.lbg, 
             ubg=self.ubg)
+        self.solve_time = time.perf_counter() - start_time
+        self.last_cost = float(self.sol['f'])
+        self.iter_count = solver.stats()['iter_count']
         #
         sol_x0 = self.sol['x'].full()
+        self._last_x = sol_x0
         opt_u = sol_x0[self._s_dim:self._s_dim+self._u_dim]
 
         # Warm initialization
-        self.nlp_w0 = list(sol_x0[self._s_dim+self._u_dim:2*(self._s_dim+self._u_dim)]) + list(sol_x0[self._s_dim+self._u_dim:])
-        #print(self.nlp_w0)
+        self.warm_start.update(sol_x0, self.sol['lam_x'].full(), self.sol['lam_g'].full())
         #
         x0_array = np.reshape(sol_x0[:-self._s_dim], newshape=(-1, self._s_dim+self._u_dim))
         
@@ -306,6 +625,188 @@ class High_MPC(object):
         return opt_u, x0_array
     
     
+    def _solve_rti(self, ref_states):
+        """
+        One real-time iteration: linearize at the warm start, solve a single
+        Gauss-Newton QP for the step and shift the result for the next tick
+        """
+        start_time = time.perf_counter()
+        w = self.warm_start.w0
+        p = np.asarray(ref_states, dtype=float).reshape(-1)
+        self.iter_count = 1
+        if self._last_p is None:
+            # the first tick after reset is solved to convergence,
+            # the real-time iteration then tracks that solution
+            sol = self._full_solver(x0=w, lbx=self.lbw, ubx=self.ubw, p=p, lbg=self.lbg, ubg=self.ubg)
+            w = sol['x'].full().reshape(-1)
+            self.iter_count += self._full_solver.stats()['iter_count']
+        self._last_w0, self._last_p = w, p
+
+        lin = self._rti_lin(w=w, p=p)
+        G = lin['G'].full().reshape(-1)
+        lbx = np.maximum(np.asarray(self.lbw) - w, -self._rti_step)
+        ubx = np.minimum(np.asarray(self.ubw) - w, self._rti_step)
+        qp_sol = self._qp(
+            h=lin['H'], 
+            g=lin['g'], 
+            a=lin['A'], 
+            lbx=lbx, 
+            ubx=ubx, 
+            lba=np.asarray(self.lbg) - G, 
+            uba=np.asarray(self.ubg) - G)
+        dw = qp_sol['x'].full().reshape(-1)
+        # a failed QP can return anything, keep the shifted solution then
+        if not np.all(np.isfinite(dw)):
+            dw = np.zeros_like(w)
+        dw = np.clip(dw, lbx, ubx)
+        sol_x0 = (w + dw).reshape(-1, 1)
+        self._last_x = sol_x0
+        self.solve_time = time.perf_counter() - start_time
+        self.last_cost = float(self._cost(sol_x0, p))
+
+        opt_u = sol_x0[self._s_dim:self._s_dim+self._u_dim]
+
+        # Warm initialization, the Gauss-Newton step does not use the multipliers
+        self.warm_start.update(sol_x0)
+        #
+        x0_array = np.reshape(sol_x0[:-self._s_dim], newshape=(-1, self._s_dim+self._u_dim))
+
+        # return optimal action, and a sequence of predicted optimal trajectory.  
+        return opt_u, x0_array
+
+    def _solve_sqp(self, ref_states):
+        """
+        SQP run to convergence: every iteration linearizes the constraints at
+        the current iterate, adds the convexified curvature of the dynamics
+        for the current multipliers and takes the full step of the QP
+        """
+        start_time = time.perf_counter()
+        w = self.warm_start.w0
+        lam_g = self.warm_start.lam_g0
+        lam_x = self.warm_start.lam_x0
+        p = np.asarray(ref_states, dtype=float).reshape(-1)
+        self._last_w0, self._last_p = w, p
+        n, N = self._s_dim + self._u_dim, self._N
+        lbw, ubw = np.asarray(self.lbw), np.asarray(self.ubw)
+        lbg, ubg = np.asarray(self.lbg), np.asarray(self.ubg)
+
+        for self.iter_count in range(1, self.max_sqp_iter+1):
+            lin = self._rti_lin(w=w, p=p)
+            G = lin['G'].full().reshape(-1)
+            # stage blocks (N, n, n) of the curvature, clipped to be positive semidefinite
+            curv = self._sqp_curv(w[:n*N].reshape(N, n).T, lam_g[self._s_dim:].reshape(N, self._s_dim).T)
+            curv = curv.full().reshape(n, N, n).transpose(1, 0, 2)
+            e, V = np.linalg.eigh(curv)
+            curv = np.matmul(V * np.maximum(e, 0)[:, None, :], V.transpose(0, 2, 1))
+            qp_sol = self._qp(
+                h=self._sqp_hess(p, curv.transpose(1, 0, 2).reshape(n, N*n)), 
+                g=lin['g'], 
+                a=lin['A'], 
+                lbx=lbw - w, 
+                ubx=ubw - w, 
+                lba=lbg - G, 
+                uba=ubg - G, 
+                lam_x0=lam_x, 
+                lam_a0=lam_g)
+            dw = qp_sol['x'].full().reshape(-1)
+            # the QP multipliers are those of the NLP at the new iterate
+            lam_x, lam_g = qp_sol['lam_x'].full().reshape(-1), qp_sol['lam_a'].full().reshape(-1)
+            w = w + dw
+            # converged once the iterate is feasible and the step no longer changes the
+            # cost, relative to its scale; the step itself stays at the accuracy of the QP
+            if np.abs(G).max() <= 1e-6 and \
+                    abs(float(lin['g'].T @ dw)) <= 1e-9 * abs(float(self._cost(w, p))):
+                break
+        sol_x0 = w.reshape(-1, 1)
+        self._last_x = sol_x0
+        self.solve_time = time.perf_counter() - start_time
+        self.last_cost = float(self._cost(sol_x0, p))
+
+        opt_u = sol_x0[self._s_dim:self._s_dim+self._u_dim]
+
+        # Warm initialization
+        self.warm_start.update(sol_x0, lam_x, lam_g)
+        #
+        x0_array = np.reshape(sol_x0[:-self._s_dim], newshape=(-1, self._s_dim+self._u_dim))
+
+        # return optimal action, and a sequence of predicted optimal trajectory.  
+        return opt_u, x0_array
+
+    def convergence_gap(self):
+        """
+        Solve the problem of the last tick again with IPOPT to convergence,
+        from the same initial guess, and return the cost found by the last
+        solve(), the converged cost and the constraint violation of the last
+        solution, max |g - bounds| over the dynamics and variable bounds. An
+        iterate that violates the dynamics can cost less than the optimum.
+        """
+        if self._last_p is None:
+            raise RuntimeError("convergence_gap() needs a previous call of solve()")
+        sol = self._full_solver(
+            x0=self._last_w0, 
+            lbx=self.lbw, 
+            ubx=self.ubw, 
+            p=self._last_p, 
+            lbg=self.lbg, 
+            ubg=self.ubg)
+        w = self._last_x.reshape(-1)
+        g = self._constraints(w, self._last_p).full().reshape(-1)
+        violation = max(np.max(np.asarray(self.lbg) - g), np.max(g - np.asarray(self.ubg)), \
+                        np.max(np.asarray(self.lbw) - w), np.max(w - np.asarray(self.ubw)), 0.0)
+        return self.last_cost, float(sol['f']), float(violation)
+
+    def solve_batch(self, ref_states_list, x0_list=None, parallelization="thread", n_threads=None):
+        """
+        Solve K independent NLPs, one per reference in ref_states_list, in a
+        single call of the solver mapped K times with CasADi's Function.map.
+        Every problem starts from x0_list[k], or from the current warm start
+        if no initial guesses are given; the warm start itself is untouched.
+        n_threads defaults to the number of CPUs; with a single thread the
+        problems are solved one after the other, the map only adds overhead then.
+        """
+        K = len(ref_states_list)
+        if n_threads is None:
+            n_threads = min(K, os.cpu_count() or 1)
+        # the real-time iteration has no nlpsol, batches are solved to convergence
+        solver = self._full_solver if self.solver is None else self.solver
+
+        p = np.column_stack([np.asarray(ref, dtype=float).reshape(-1) for ref in ref_states_list])
+        if x0_list is None:
+            # bounds and a shared initial guess are broadcast over the K problems
+            x0 = np.repeat(self.warm_start.w0.reshape(-1, 1), K, axis=1)
+        else:
+            x0 = np.column_stack([np.asarray(w0, dtype=float).reshape(-1) for w0 in x0_list])
+
+        if n_threads == 1 or parallelization == "serial":
+            sol_x = np.column_stack([solver(
+                x0=x0[:, k], 
+                lbx=self.lbw, 
+                ubx=self.ubw, 
+                p=p[:, k], 
+                lbg=self.lbg, 
+                ubg=self.ubg)['x'].full() for k in range(K)])
+        else:
+            solver_K = self._batch_solvers.get((K, parallelization, n_threads))
+            if solver_K is None:
+                solver_K = solver.map(K, parallelization, n_threads)
+                self._batch_solvers[(K, parallelization, n_threads)] = solver_K
+            sol_x = solver_K(
+                x0=x0, 
+                lbx=self.lbw, 
+                ubx=self.ubw, 
+                p=p, 
+                lbg=self.lbg, 
+                ubg=self.ubg)['x'].full()
+        #
+        sol_x = sol_x.T
+        opt_u = sol_x[:, self._s_dim:self._s_dim+self._u_dim]
+        x_array = np.reshape(sol_x[:, :-self._s_dim], newshape=(K, -1, self._s_dim+self._u_dim))
+        x_N = sol_x[:, -self._s_dim:]
+
+        # return the optimal actions (K, u_dim), the predicted trajectories (K, N, s_dim+u_dim)
+        # and the terminal states (K, s_dim)
+        return opt_u, x_array, x_N
+
     def sys_dynamics(self, dt):
         M = 4       # refinement
         DT = dt/M
@@ -3,13 +3,21 @@ import torch
 import gym
 import pygame
 import pickle
+import os
 from SAC import SAC_Agent
-from ReplayBuffer import RandomBuffer, device
+from AsyncLearner import AsyncLearner
+from Checkpoint import CheckpointWriter, load_checkpoint, get_rng_state, set_rng_state
+from RunningStat import RunningStat, ZFilter
+from Evaluator import Evaluator, run_episode
+from ReplayBuffer import RandomBuffer, TensorBuffer, LinkedBuffer, PrioritizedBuffer, MemmapBuffer, SharedBuffer, BatchPrefetcher, device
+from ActorPool import ActorPool
 
 import gym_carla
-import carla
 import sys
 import traceback
+import contextlib
+import time
+import multiprocessing as mp
 
 import argparse
 from Adapter import *
@@ -31,11 +39,14 @@ parser.add_argument('--eval', type=str2bool, default=False, help='Evaluate or No
 parser.add_argument('--Loadmodel', type=str2bool, default=False, help='Load pretrained model or Not')
 parser.add_argument('--ModelIdex', type=int, default=35000, help='which model to load') # 270000
 parser.add_argument('--seed', type=int, default=1, help='random seed')
+parser.add_argument('--env', type=str, default='carla-v0', help='carla-v0, or carla-kinematic-v0 to run without a CARLA server')
 
 parser.add_argument('--total_steps', type=int, default=int(5e6), help='Max training steps')
 parser.add_argument('--save_interval', type=int, default=int(1e3), help='Model saving interval, in steps.') # 1e4
 parser.add_argument('--eval_interval', type=int, default=int(1e3), help='Model evaluating interval, in stpes.')
 parser.add_argument('--eval_turn', type=int, default=3, help='Model evaluating times, in episode.') # 3
+parser.add_argument('--eval_workers', type=int, default=0, help='Processes evaluating the policy in the background during training, 0 to evaluate on the training env')
+parser.add_argument('--eval_port', type=int, default=0, help='Port of the CARLA server of the first eval worker, the next ones at +2, required on carla-v0')
 parser.add_argument('--eval_runs', type=int, default=100, help='Model evaluating times, in episode.') # 3
 parser.add_argument('--update_every', type=int, default=50, help='Training Fraquency, in stpes')
 parser.add_argument('--gamma', type=float, default=0.99, help='Discounted Factor')
@@ -43,113 +54,39 @@ parser.add_argument('--net_width', type=int, default=256, help='Hidden net width
 parser.add_argument('--a_lr', type=float, default=3e-4, help='Learning rate of actor')
 parser.add_argument('--c_lr', type=float, default=3e-4, help='Learning rate of critic')
 parser.add_argument('--batch_size', type=int, default=256, help='Batch Size')
+parser.add_argument('--tensor_buffer', type=str2bool, default=True, help='Keep the replay buffer in float32 torch tensors or Not')
+parser.add_argument('--pin_memory', type=str2bool, default=False, help='Pin the replay buffer memory for faster copies to the GPU or Not')
+parser.add_argument('--linked_buffer', type=str2bool, default=False, help='Store every observation once in the replay buffer, next states found by index, or Not')
+parser.add_argument('--buffer_size', type=int, default=int(1e6), help='Replay buffer capacity, in transitions')
+parser.add_argument('--prioritized', type=str2bool, default=False, help='Use prioritized experience replay or Not')
+parser.add_argument('--buffer_dir', type=str, default='', help='Keep the replay buffer in memory-mapped files of this directory, resumed if present')
+parser.add_argument('--n_step', type=int, default=1, help='Store n-step returns in the replay buffer (not with --linked_buffer)')
+parser.add_argument('--prefetch', type=int, default=0, help='Minibatches sampled ahead on a background thread, 0 to sample in the training loop')
+parser.add_argument('--ensemble_critic', type=str2bool, default=False, help='Evaluate the critics as one stacked ensemble or Not')
+parser.add_argument('--num_critics', type=int, default=2, help='Critics in the ensemble critic')
+parser.add_argument('--critic_subset', type=int, default=2, help='Critics the target Q is the min of, drawn at random from the ensemble')
+parser.add_argument('--compile_update', type=str2bool, default=False, help='Compile the SAC losses with torch.compile and use foreach Adam or Not')
+parser.add_argument('--async_learner', type=str2bool, default=False, help='Train on a learner thread while interacting, instead of update_every updates every update_every steps')
+parser.add_argument('--utd_ratio', type=float, default=1.0, help='Max gradient updates per env step of the async learner')
+parser.add_argument('--publish_every', type=int, default=50, help='Updates between two actor weights published by the async learner')
+parser.add_argument('--actor_processes', type=int, default=0, help='Processes stepping their own env into a shared-memory replay buffer while this one trains, 0 to interact here')
+parser.add_argument('--actor_port', type=int, default=0, help='Port of the CARLA server of the first actor process, the next ones at +2')
+parser.add_argument('--checkpoint', type=str, default='./model/checkpoint.pt', help='Training state bundle, written at the first episode end after every save_interval steps')
+parser.add_argument('--resume', type=str2bool, default=False, help='Continue training from the checkpoint or Not')
 parser.add_argument('--alpha', type=float, default=0.12, help='Entropy coefficient')
 parser.add_argument('--adaptive_alpha', type=str2bool, default=True, help='Use adaptive_alpha or Not')
 opt = parser.parse_args()
 print(opt)
 
-class RunningStat(object):
-    def __init__(self, shape):
-        self._n = 0
-        self._M = np.zeros(shape)
-        self._S = np.zeros(shape)
-
-    def push(self, x):
-        x = np.asarray(x)
-        #print(x.shape, self._M.shape)
-        assert x.shape == self._M.shape
-        self._n += 1
-        if self._n == 1:
-            self._M[...] = x
-        else:
-            oldM = self._M.copy()
-            self._M[...] = oldM + (x - oldM) / self._n
-            self._S[...] = self._S + (x - oldM) * (x - self._M)
-
-    @property
-    def n(self):
-        return self._n
-
-    @property
-    def mean(self):
-        return self._M
-
-    @property
-    def var(self):
-        return self._S / (self._n - 1) if self._n > 1 else np.square(self._M)
-
-    @property
-    def std(self):
-        return np.sqrt(self.var)
-
-    @property
-    def shape(self):
-        return self._M.shape
-
-
-class ZFilter:
-    """
-    y = (x-mean)/std
-    using running estimates of mean,std
-    """
-
-    def __init__(self, shape, demean=True, destd=True, clip=10.0):
-        self.demean = demean
-        self.destd = destd
-        self.clip = clip
-
-        self.rs = RunningStat(shape)
-
-    def __call__(self, x, update=True):
-        if update: self.rs.push(x)
-        if self.demean:
-            x = x - self.rs.mean
-        if self.destd:
-            x = x / (self.rs.std + 1e-5) # 1e-8
-        if self.clip:
-            x = np.clip(x, -self.clip, self.clip)
-        return x
-
-    def output_shape(self, input_space):
-        return input_space.shape
-    
 def evaluate_policy(env, model, render, steps_per_epoch, act_low, act_high, running_state):
     print('start evaluating')
     scores = 0
     turns = opt.eval_turn
+    # deterministic tanh(mu) in NumPy, without the torch overhead of select_action
+    policy = model.export_policy()
 
     for j in range(turns):
-        s, done, ep_r = env.reset(), False, 0
-        
-        s = running_state(s)
-        while not done:
-            # Take deterministic actions at test time
-            
-            a = model.select_action(s, deterministic=True, with_logprob=False)
-            act = Action_adapter(a, act_low, act_high)  # [0,1] to [-max,max]
-            
-            #print(act)
-            ref = act #.tolist()
-            tra_state = np.array(env.ego_state[0]) + np.array(ref[0])
-            #tra_state = tra_state.tolist()
-            ref_obj = [tra_state] + ref[1:8]
-
-            # compute the mpc reference
-            ref_traj = env.ego_state + ref_obj + env.goal_state
-            # run  model predictive control
-            _act, pred_traj = env.high_mpc.solve(ref_traj)
-           
-            s_prime, r, done, info = env.step(_act)
-
-            s_prime = running_state(s_prime)
-            if type(r) == tuple:
-                r = np.array(list(r))
-            
-            s = s_prime
-            
-            env.render()
-    
-        scores += ep_r
+        scores += run_episode(env, policy, running_state, render)
 
     return scores/turns
 
@@ -172,16 +109,23 @@ def main():
 	'max_ego_spawn_times': 200,  # maximum times to spawn ego vehicle
 	'pixor_size': 64,  # size of the pixor labels
 	'pixor': False,  # whether to output PIXOR observation
+	'mpc_codegen': False,  # whether to compile the MPC solver into a cached shared library
+	'mpc_solver': 'ipopt',  # MPC solver, 'ipopt', 'sqp' or 'rti' (one Gauss-Newton SQP step per tick)
+	'obstacle_detector': 'analytic',  # obstacle distances, 'analytic' ray cast or 'sensor' (CARLA obstacle sensors)
+	'render_mode': 'none',  # birdeye/camera rendering, 'none', 'every_k' (every render_every steps) or 'on_demand' (in render())
+	'render_every': 1,  # rendering interval of the 'every_k' mode, in steps
+	'map_cache_dir': None,  # directory of the cached road map raster, None for ~/.cache/gym_carla/maps, '' to disable
 	}
         
     # Create environments.
     # Set gym-carla environment
-    env = gym.make('carla-v0', params=params)
+    env = gym.make(opt.env, params=params)
     env_with_Dead = True
 
     state_dim = env.observation_space.shape[0]
     action_dim = env.action_space.shape[0]
     steps_per_epoch = env.max_episode_steps
+    action_scaler = ActionScaler(env.act_low, env.act_high)
     print('Env: CarlaEnv,  state_dim:',state_dim,'  action_dim:',action_dim,
            'max_episode_steps', steps_per_epoch) # '  max_a:',max_action,'  min_a:',env.action_space.low[0],
 
@@ -209,7 +153,11 @@ def main():
         "c_lr": opt.c_lr,
         "batch_size":opt.batch_size,
         "alpha":opt.alpha,
-        "adaptive_alpha":opt.adaptive_alpha
+        "adaptive_alpha":opt.adaptive_alpha,
+        "ensemble_critic":opt.ensemble_critic,
+        "num_critics":opt.num_critics,
+        "critic_subset":opt.critic_subset,
+        "compile_update":opt.compile_update
     }
 
     running_state = ZFilter((state_dim,), clip=5.0)
@@ -217,18 +165,116 @@ def main():
 
     if opt.Loadmodel: 
         model.load(opt.ModelIdex)
-        with open("./model/mean_std_{}.txt".format(opt.ModelIdex), 'rb') as saved_mean_std:
+        if os.path.exists("./model/mean_std_{}.npz".format(opt.ModelIdex)):
+            running_state = ZFilter.load("./model/mean_std_{}.npz".format(opt.ModelIdex))
+        else:
+            # models saved before the .npz format
+            with open("./model/mean_std_{}.txt".format(opt.ModelIdex), 'rb') as saved_mean_std:
                 running_state = pickle.load(saved_mean_std)
 
-    replay_buffer = RandomBuffer(state_dim, action_dim, env_with_Dead, max_size=int(1e6))
+    n_step = {'n_step': opt.n_step, 'gamma': opt.gamma}
+    if opt.actor_processes > 0 and not opt.eval:
+        assert not (opt.buffer_dir or opt.prioritized or opt.linked_buffer or opt.async_learner), \
+            '--actor_processes uses its own shared-memory replay buffer and learner loop'
+        assert opt.actor_port or opt.env != 'carla-v0', \
+            '--actor_processes needs --actor_port on carla-v0, one CARLA server per actor besides the training one'
+        replay_buffer = SharedBuffer(state_dim, action_dim, env_with_Dead, max_size=opt.buffer_size, ctx=mp.get_context('spawn'), **n_step)
+    elif opt.buffer_dir:
+        replay_buffer = MemmapBuffer(state_dim, action_dim, env_with_Dead, max_size=opt.buffer_size, buffer_dir=opt.buffer_dir, **n_step)
+    elif opt.prioritized:
+        replay_buffer = PrioritizedBuffer(state_dim, action_dim, env_with_Dead, max_size=opt.buffer_size, pin_memory=opt.pin_memory, **n_step)
+    elif opt.linked_buffer:
+        assert opt.n_step == 1, '--linked_buffer only stores one-step transitions'
+        replay_buffer = LinkedBuffer(state_dim, action_dim, env_with_Dead, max_size=opt.buffer_size, pin_memory=opt.pin_memory)
+    elif opt.tensor_buffer:
+        replay_buffer = TensorBuffer(state_dim, action_dim, env_with_Dead, max_size=opt.buffer_size, pin_memory=opt.pin_memory, **n_step)
+    else:
+        replay_buffer = RandomBuffer(state_dim, action_dim, env_with_Dead, max_size=opt.buffer_size, **n_step)
+    shared_buffer = replay_buffer
+    if opt.prefetch > 0:
+        replay_buffer = BatchPrefetcher(replay_buffer, opt.batch_size, K=opt.prefetch)
+
+    start_t = 0
+    if opt.resume and not opt.eval:
+        bundle = load_checkpoint(opt.checkpoint)
+        model.load_state_dict(bundle['agent'])
+        replay_buffer.load_state_dict(bundle['buffer'])
+        running_state = bundle['running_state']
+        set_rng_state(bundle['rng'])
+        env.action_space.np_random = bundle['action_space_rng']
+        start_t = bundle['step']
+        print('Resumed from', opt.checkpoint, 'at step', start_t)
+    checkpointer = CheckpointWriter(opt.checkpoint)
+    evaluator = None
+    if opt.eval_workers > 0 and not opt.eval:
+        # loading the world of a worker env would reset the episode of the training env
+        assert opt.eval_port or opt.env != 'carla-v0', \
+            '--eval_workers needs --eval_port on carla-v0, one CARLA server per eval worker besides the training one'
+        ports = [opt.eval_port + 2 * i for i in range(opt.eval_workers)] if opt.eval_port else None
+        evaluator = Evaluator(opt.env, params, opt.eval_workers, opt.eval_turn, ports)
+    checkpoint_due = False
+
+    # the agent acting in the env: the model, or the published actor of the async learner
+    agent = model
+    if opt.async_learner and not opt.eval:
+        learner = AsyncLearner(model, replay_buffer, utd_ratio=opt.utd_ratio, publish_every=opt.publish_every, prefetch=max(opt.prefetch, 2))
+        agent = learner
 
     if opt.eval:
         average_reward = evaluate_policy(env, model, False, steps_per_epoch, env.act_low, env.act_high, running_state) 
         print('Average Reward:', average_reward)
+    elif opt.actor_processes > 0:
+        ports = [opt.actor_port + 2 * i for i in range(opt.actor_processes)] if opt.actor_port else None
+        pool = ActorPool(opt.env, params, shared_buffer, model.actor, running_state, opt.actor_processes, \
+                         start_steps, total_steps, ports=ports, seed=random_seed)
+        pool.start(start_t)
+        t, updates = start_t, 0
+        while t < total_steps:
+            prev_t, t = t, pool.poll()
+            if t < update_after or updates >= opt.utd_ratio * (t - start_t):
+                # the ZFilter statistics still change quickly before the training starts
+                if t < update_after:
+                    pool.publish(model.actor)
+                time.sleep(0.01)
+            else:
+                model.train(replay_buffer)
+                updates += 1
+                if updates % opt.publish_every == 0:
+                    pool.publish(model.actor)
+
+            '''save model'''
+            if t // save_interval > prev_t // save_interval:
+                step = t // save_interval * save_interval
+                running_state.save("./model/mean_std_{}.npz".format(step))
+                model.save(step)
+                # the actors are mid-episode, a resumed run starts new episodes
+                checkpointer.write({'step': t, 'agent': model.state_dict(), 'buffer': replay_buffer.state_dict(), \
+                                    'running_state': running_state, 'rng': get_rng_state(), \
+                                    'action_space_rng': env.action_space.np_random})
+
+            '''record & log'''
+            if t // eval_interval > prev_t // eval_interval:
+                step = t // eval_interval * eval_interval
+                if evaluator is not None:
+                    evaluator.submit(step, model.export_policy(), running_state)
+                else:
+                    score = evaluate_policy(env, model, False, steps_per_epoch, env.act_low, env.act_high, running_state)
+                    print('EnvName: CarlaEnv, seed:', random_seed, 'totalsteps:', step, 'score:', score)
+                print('Actor processes:', {'steps': t, 'updates': updates})
+            if evaluator is not None:
+                for step, score in evaluator.poll():
+                    print('EnvName: CarlaEnv, seed:', random_seed, 'totalsteps:', step, 'score:', score)
+        if opt.prefetch > 0:
+            replay_buffer.close()
+        pool.close()
+        if evaluator is not None:
+            for step, score in evaluator.close():
+                print('EnvName: CarlaEnv, seed:', random_seed, 'totalsteps:', step, 'score:', score)
+        checkpointer.wait()
     else:
         s, done, current_steps = env.reset(), False, 0
         s = running_state(s)
-        for t in range(total_steps):
+        for t in range(start_t, total_steps):
 
             current_steps += 1
             '''Interact & trian'''
@@ -236,18 +282,17 @@ def main():
             if t < start_steps:
                 #Random explore for start_steps
                 act = env.action_space.sample() #act∈[-max,max]
-                act = act.tolist()
-                a = Action_adapter_reverse(act,env.act_low, env.act_high) #a∈[-1,1]
+                a = action_scaler.reverse(act) #a∈[-1,1]
             else:
                 
-                a = model.select_action(s, deterministic=False, with_logprob=False) #a∈[-1,1]
+                a = agent.select_action(s, deterministic=False, with_logprob=False) #a∈[-1,1]
                 #a.tolist()
-                act = Action_adapter(a, env.act_low, env.act_high) #act∈[-max,max]
+                act = action_scaler(a) #act∈[-max,max]
 
             #print(act)
             ref = act #.tolist()
             tra_state = np.array(env.ego_state[0]) + np.array(ref[0])
-            ref_obj = [tra_state] + ref[1:8]
+            ref_obj = [tra_state] + list(ref[1:8])
 
             # compute the mpc reference
             ref_traj = env.ego_state + ref_obj + env.goal_state
@@ -264,28 +309,61 @@ def main():
 
             dead = Done_adapter(r, done, current_steps)
             r = Reward_adapter(r)
-            replay_buffer.add(s, a, r, s_prime, dead)
+            if opt.async_learner:
+                learner.add(s, a, r, s_prime, dead, done)
+            else:
+                replay_buffer.add(s, a, r, s_prime, dead, done)
             s = s_prime
 
-            if t >= update_after and t % update_every == 0:
+            if opt.async_learner:
+                if t >= update_after and not learner.started:
+                    learner.start()
+            elif t >= update_after and t % update_every == 0:
                 for j in range(update_every):
                     model.train(replay_buffer)
 
             '''save model'''
             if (t + 1) % save_interval == 0:
-                with open("./model/mean_std_{}.txt".format(t + 1), 'wb') as saved_mean_std:
-                    pickle.dump(running_state, saved_mean_std)
-                    saved_mean_std.close()
+                checkpoint_due = True
+                running_state.save("./model/mean_std_{}.npz".format(t + 1))
 
-                model.save(t + 1)
+                if opt.async_learner:
+                    learner.save(t + 1)
+                else:
+                    model.save(t + 1)
+                if opt.buffer_dir:
+                    replay_buffer.save()
 
             '''record & log'''
             if (t + 1) % eval_interval == 0:
-                score = evaluate_policy(env, model, False, steps_per_epoch, env.act_low, env.act_high, running_state)
-                print('EnvName: CarlaEnv, seed:', random_seed, 'totalsteps:', t+1, 'score:', score)
+                if evaluator is not None:
+                    evaluator.submit(t + 1, agent.export_policy(), running_state)
+                else:
+                    score = evaluate_policy(env, agent, False, steps_per_epoch, env.act_low, env.act_high, running_state)
+                    print('EnvName: CarlaEnv, seed:', random_seed, 'totalsteps:', t+1, 'score:', score)
+                if opt.prefetch > 0:
+                    print('Waiting for minibatches:', replay_buffer.stats())
+                if opt.async_learner and learner.started:
+                    print('Async learner:', learner.stats())
+            if evaluator is not None:
+                for step, score in evaluator.poll():
+                    print('EnvName: CarlaEnv, seed:', random_seed, 'totalsteps:', step, 'score:', score)
             if done:
+                if checkpoint_due:
+                    # at an episode end, so that a resumed run starts with the same reset
+                    with learner.lock if opt.async_learner else contextlib.nullcontext():
+                        checkpointer.write({'step': t + 1, 'agent': model.state_dict(), 'buffer': replay_buffer.state_dict(), \
+                                            'running_state': running_state, 'rng': get_rng_state(), \
+                                            'action_space_rng': env.action_space.np_random})
+                    checkpoint_due = False
                 s, done, current_steps = env.reset(), False, 0
                 s = running_state(s)
+        if opt.async_learner:
+            learner.close()
+        if evaluator is not None:
+            for step, score in evaluator.close():
+                print('EnvName: CarlaEnv, seed:', random_seed, 'totalsteps:', step, 'score:', score)
+        checkpointer.wait()
 
 if __name__ == '__main__':
     try:
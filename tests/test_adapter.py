@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from Adapter import ActionScaler, Action_adapter, Action_adapter_reverse
+
+
+# bounds of the CARLA envs
+ACT_HIGH = np.array([20.0, 15.0, np.pi/2, 20.0, 50.0, 50.0, 50.0, 50.0], dtype=np.float32)
+ACT_LOW = np.array([-40.0, -15.0, -np.pi/2, -20.0, 0.0, 0.0, 0.0, 0.0], dtype=np.float32)
+
+
+def random_bounds(rng, dtype):
+    dim = rng.integers(1, 10)
+    magnitude = 10.0 ** rng.integers(-3, 4, size=dim)
+    low = (rng.uniform(-1, 0, size=dim) * magnitude).astype(dtype)
+    high = (rng.uniform(0, 1, size=dim) * magnitude).astype(dtype)
+    return low, high
+
+
+@pytest.mark.parametrize('bounds_dtype', [np.float32, np.float64])
+def test_action_scaler_matches_action_adapter(bounds_dtype):
+    rng = np.random.default_rng(0)
+    for _ in range(500):
+        low, high = random_bounds(rng, bounds_dtype)
+        scaler = ActionScaler(low, high)
+        a = rng.uniform(-1, 1, size=len(low))
+        act = scaler(a)
+        assert np.array_equal(act, Action_adapter(a, low, high))
+        assert np.array_equal(scaler.reverse(act), Action_adapter_reverse(act, low, high))
+
+
+def test_action_scaler_float32_actions():
+    # float32 policy output, as returned by SAC_Agent.select_action
+    rng = np.random.default_rng(1)
+    scaler = ActionScaler(ACT_LOW, ACT_HIGH)
+    a = rng.uniform(-1, 1, size=(2000, 8)).astype(np.float32)
+    act = scaler(a)
+    assert act.dtype == np.float64
+    expected = np.array([Action_adapter(x, ACT_LOW, ACT_HIGH) for x in a])
+    # Action_adapter may round act * |high - low| to float32
+    assert np.all(np.abs(act - expected) <= np.finfo(np.float32).eps * scaler.scale)
+
+    sampled = rng.uniform(ACT_LOW, ACT_HIGH, size=(2000, 8)).astype(np.float32)
+    expected = np.array([Action_adapter_reverse(x, ACT_LOW, ACT_HIGH) for x in sampled])
+    np.testing.assert_allclose(scaler.reverse(sampled), expected, rtol=0, atol=1e-6)
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_action_scaler_round_trip(dtype):
+    rng = np.random.default_rng(2)
+    scaler = ActionScaler(ACT_LOW, ACT_HIGH)
+    a = rng.uniform(-1, 1, size=(1000, 8)).astype(dtype)
+    act = scaler(a)
+    assert np.all(act >= ACT_LOW) and np.all(act <= ACT_HIGH)
+    np.testing.assert_allclose(scaler.reverse(act), a, rtol=0, atol=1e-12)
+    np.testing.assert_allclose(scaler(scaler.reverse(act)), act, rtol=0, atol=1e-12)
+
+
+def test_action_scaler_out():
+    scaler = ActionScaler(ACT_LOW, ACT_HIGH)
+    a = np.linspace(-1, 1, 8)
+    expected = scaler(a)
+    assert scaler(a, out=a) is a
+    assert np.array_equal(a, expected)
+    scaler.reverse(a, out=a)
+    np.testing.assert_allclose(a, np.linspace(-1, 1, 8), rtol=0, atol=1e-12)
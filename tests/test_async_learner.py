@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+import torch
+
+from AsyncLearner import AsyncLearner
+from ReplayBuffer import RandomBuffer
+
+
+class FailingModel(object):
+	batch_size = 4
+
+	def __init__(self):
+		self.actor = torch.nn.Linear(3, 2)
+		self.updates = 0
+
+	def train(self, replay_buffer):
+		replay_buffer.sample(self.batch_size)
+		self.updates += 1
+		if self.updates == 3:
+			raise RuntimeError('update failed')
+
+
+def test_learner_error_is_raised_by_add_and_sync():
+	learner = AsyncLearner(FailingModel(), RandomBuffer(3, 2, True, max_size=64), publish_every=1)
+	for _ in range(4):
+		learner.add(np.zeros(3), np.zeros(2), 0.0, np.zeros(3), False)
+	learner.start()
+	learner.add(np.zeros(3), np.zeros(2), 0.0, np.zeros(3), False)
+	learner.add(np.zeros(3), np.zeros(2), 0.0, np.zeros(3), False)
+	learner.add(np.zeros(3), np.zeros(2), 0.0, np.zeros(3), False)
+	learner.thread.join(timeout=10)
+	assert not learner.thread.is_alive()
+	assert learner.updates == 2
+	with pytest.raises(RuntimeError, match='update failed'):
+		learner.add(np.zeros(3), np.zeros(2), 0.0, np.zeros(3), False)
+	with pytest.raises(RuntimeError, match='update failed'):
+		learner.sync()
+	learner.close()
@@ -0,0 +1,65 @@
+import time
+
+import pytest
+
+# CarlaEnv needs the CARLA client, pygame and scikit-image, but no server for these tests
+carla_env = pytest.importorskip('gym_carla.envs.carla_env')
+pygame = pytest.importorskip('pygame')
+
+RENDER_TIME = 0.05
+
+
+def make_env(render_mode, render_every=1):
+  """CarlaEnv with the state the observation needs after reset(), and a slow renderer that counts frames"""
+  env = carla_env.CarlaEnv.__new__(carla_env.CarlaEnv)
+  env.render_mode = render_mode
+  env.render_every = render_every
+  env.birdeye_render = None
+  env.time_step = 0
+  env.ego, env.map = None, None
+  env.distance_measurements = [50.0] * 73
+  env.display = pygame.Surface((8, 4))
+  env.get_state_frenet = lambda ego, carla_map: [0.0, 0.0, 0.0, 0.0]
+  env.frames = 0
+
+  def render_frame():
+    time.sleep(RENDER_TIME)
+    env.frames += 1
+  env._render_frame = render_frame
+  return env
+
+
+@pytest.mark.parametrize('render_mode', ['none', 'on_demand'])
+def test_reset_observation_does_not_render(render_mode):
+  env = make_env(render_mode)
+  start_time = time.perf_counter()
+  obs = env._get_obs()
+  assert time.perf_counter() - start_time < RENDER_TIME
+  assert env.frames == 0 and env.render_time == 0.0
+  assert len(obs) == 4 + 73
+
+
+def test_on_demand_renders_in_render():
+  env = make_env('on_demand')
+  env._get_obs()
+  env.render()
+  assert env.frames == 1
+
+
+def test_none_never_renders():
+  env = make_env('none')
+  env._get_obs()
+  assert env.render() is None
+  assert env.frames == 0
+
+
+def test_every_k_renders_every_k_steps():
+  env = make_env('every_k', render_every=5)
+  for time_step in range(10):
+    env.time_step = time_step
+    env._get_obs()
+  assert env.frames == 2
+  # the rendering time is reported apart from the rest of the step
+  env.time_step = 10
+  env._get_obs()
+  assert env.render_time >= RENDER_TIME
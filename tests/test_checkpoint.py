@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+import torch
+
+from Checkpoint import CheckpointWriter, load_checkpoint, get_rng_state, set_rng_state
+from ReplayBuffer import TensorBuffer, PrioritizedBuffer
+from SAC import SAC_Agent
+
+
+def add_transitions(buffer, count, rng):
+	for i in range(count):
+		buffer.add(rng.standard_normal(5), rng.uniform(-1, 1, 2), rng.standard_normal(), rng.standard_normal(5), \
+				   False, done=i % 7 == 6)
+
+
+def continue_training(agent, buffer, rng):
+	'''add, sample and train steps after the checkpoint, returning what they produced'''
+	add_transitions(buffer, 3, rng)
+	batch = [x.clone() if torch.is_tensor(x) else np.copy(x) for x in buffer.sample(32)]
+	for _ in range(3):
+		agent.train(buffer)
+	return batch, [p.detach().clone() for p in agent.actor.parameters()] + \
+				  [p.detach().clone() for p in agent.q_critic.parameters()] + [torch.as_tensor(agent.alpha)]
+
+
+@pytest.mark.parametrize('buffer_class', [TensorBuffer, PrioritizedBuffer])
+@pytest.mark.parametrize('n_step', [1, 3])
+def test_resumed_training_is_bit_identical(tmp_path, buffer_class, n_step):
+	torch.manual_seed(0)
+	np.random.seed(0)
+	rng = np.random.default_rng(0)
+	agent = SAC_Agent(5, 2, hid_shape=(16, 16), batch_size=32)
+	buffer = buffer_class(5, 2, True, max_size=200, n_step=n_step)
+	add_transitions(buffer, 100, rng)
+	for _ in range(5):
+		agent.train(buffer)
+
+	# rng stands for the env, its state is checkpointed as main.py does with the action space
+	writer = CheckpointWriter(str(tmp_path / 'checkpoint.pt'))
+	writer.write({'agent': agent.state_dict(), 'buffer': buffer.state_dict(), 'rng': get_rng_state(), 'env_rng': rng})
+	writer.wait()
+	expected_batch, expected_params = continue_training(agent, buffer, rng)
+
+	# a new process would build the agent and buffer from other random draws
+	torch.manual_seed(1)
+	bundle = load_checkpoint(str(tmp_path / 'checkpoint.pt'))
+	resumed_agent = SAC_Agent(5, 2, hid_shape=(16, 16), batch_size=32)
+	resumed_buffer = buffer_class(5, 2, True, max_size=200, n_step=n_step)
+	resumed_agent.load_state_dict(bundle['agent'])
+	resumed_buffer.load_state_dict(bundle['buffer'])
+	set_rng_state(bundle['rng'])
+	batch, params = continue_training(resumed_agent, resumed_buffer, bundle['env_rng'])
+
+	for x, y in zip(batch, expected_batch):
+		np.testing.assert_array_equal(np.asarray(x), np.asarray(y))
+	for p, q in zip(params, expected_params):
+		assert torch.equal(p, q)
+
+
+def test_load_checkpoint_rejects_other_versions(tmp_path):
+	path = str(tmp_path / 'checkpoint.pt')
+	torch.save({'version': 0}, path)
+	with pytest.raises(ValueError, match='version 0'):
+		load_checkpoint(path)
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+from gym_carla.envs.detector import get_detector_yaws, ray_polygon_distances
+
+
+def boundary_distances(points, polygons):
+  """Distance of each point (S, 2) to the closest edge of the polygons (K, P, 2)."""
+  a = polygons[None]
+  e = np.roll(polygons, -1, axis=-2)[None] - a
+  ap = points[:, None, None, :] - a
+  u = np.clip((ap*e).sum(-1)/(e*e).sum(-1), 0, 1)
+  return np.hypot(*np.moveaxis(ap - u[..., None]*e, -1, 0)).min(axis=(-2, -1))
+
+
+def ray_polygon_distances_reference(origin, angles, polygons, detect_range, tol=1e-12):
+  """Sphere tracing for a single origin, independent of the edge intersections of
+  ray_polygon_distances: every ray advances by the distance to the closest edge, which cannot
+  step over any polygon, until it reaches an edge or detect_range."""
+  origin, polygons = np.asarray(origin, dtype=float), np.asarray(polygons, dtype=float)
+  d = np.stack([np.cos(angles), np.sin(angles)], axis=-1)
+  t = np.zeros(len(angles))
+  if len(polygons) == 0:
+    return np.full(len(angles), float(detect_range))
+  active = np.ones(len(angles), dtype=bool)
+  while active.any():
+    dist = boundary_distances(origin + t[active, None]*d[active], polygons)
+    t[active] += dist
+    active[active] = (dist > tol) & (t[active] < detect_range)
+  return np.minimum(t, detect_range)
+
+
+def random_boxes(rng, num):
+  """Rotated vehicle-sized boxes around the origin, corners as in CarlaEnv._get_actor_polygons.
+
+  The boxes stay clear of the ray origins, the reference only traces rays from outside them."""
+  radius, direction = rng.uniform(14, 45, size=(num, 1)), rng.uniform(-np.pi, np.pi, size=(num, 1))
+  centers = np.stack([radius*np.cos(direction), radius*np.sin(direction)], axis=-1)
+  yaws = rng.uniform(-np.pi, np.pi, size=(num, 1))
+  half = rng.uniform(0.5, 3.0, size=(num, 1, 2))
+  corners = np.array([[1, 1], [1, -1], [-1, -1], [-1, 1]]) * half
+  rot_x = corners[..., 0]*np.cos(yaws) - corners[..., 1]*np.sin(yaws)
+  rot_y = corners[..., 0]*np.sin(yaws) + corners[..., 1]*np.cos(yaws)
+  return centers + np.stack([rot_x, rot_y], axis=-1)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_ray_polygon_distances_matches_reference(seed):
+  rng = np.random.default_rng(seed)
+  origin = rng.uniform(-5, 5, size=2)
+  heading = rng.uniform(-np.pi, np.pi)
+  angles = heading + np.deg2rad(get_detector_yaws(180, 73))
+  polygons = random_boxes(rng, rng.integers(0, 30))
+  expected = ray_polygon_distances_reference(origin, angles, polygons, 50)
+  np.testing.assert_allclose(ray_polygon_distances(origin, angles, polygons, 50), expected, rtol=0, atol=1e-6)
+
+
+def test_ray_polygon_distances_batched():
+  rng = np.random.default_rng(0)
+  origins = rng.uniform(-5, 5, size=(6, 2))
+  angles = rng.uniform(-np.pi, np.pi, size=(6, 73))
+  polygons = np.stack([random_boxes(rng, 10) for _ in range(6)])
+  distances = ray_polygon_distances(origins, angles, polygons, 50)
+  assert distances.shape == (6, 73)
+  for i in range(6):
+    np.testing.assert_allclose(distances[i], ray_polygon_distances_reference(origins[i], angles[i], polygons[i], 50), \
+                               rtol=0, atol=1e-6)
+
+
+def test_ray_polygon_distances_without_polygons():
+  angles = np.deg2rad(get_detector_yaws(180, 73))
+  distances = ray_polygon_distances(np.zeros(2), angles, np.zeros((0, 4, 2)), 50)
+  assert np.array_equal(distances, np.full(73, 50.0))
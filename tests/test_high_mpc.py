@@ -0,0 +1,147 @@
+import os
+import time
+
+import casadi as ca
+import gym
+import numpy as np
+
+import gym_carla
+from high_mpc import High_MPC, WarmStart, clear_solver_cache
+
+
+# the options of main.py the kinematic env reads
+PARAMS = {'display_size': 512, 'max_past_step': 1, 'dt': 0.1, 'ego_vehicle_filter': 'vehicle.tesla.model3*', \
+          'port': 2000, 'max_time_episode': 500, 'detect_range': 50, 'detector_num': 73, 'detect_angle': 180, \
+          'obs_range': 32, 'lidar_bin': 0.125, 'd_behind': 12, 'max_ego_spawn_times': 200, 'pixor_size': 64, \
+          'pixor': False}
+
+
+def build(init_state=None, **kwargs):
+    start_time = time.perf_counter()
+    mpc = High_MPC(T=5.0, dt=0.1, L=4.79, vehicle_length=4.79, vehicle_width=2.16, lane_width=3.5, \
+                   init_state=init_state, **kwargs)
+    return mpc, time.perf_counter() - start_time
+
+
+def lane_change(state):
+    """Reference of a lane change 10 m ahead of state, with the goal of the envs"""
+    return list(state) + [state[0] + 10, 3.5, 0, 6, 10, 10, 10, 10] + [275, 0, 0, 8]
+
+
+def test_solver_is_reused_when_the_key_is_unchanged():
+    clear_solver_cache()
+    first, build_time = build()
+    second, reuse_time = build(init_state=[1.0, 0.5, 0.0, 5.0])
+    assert second.solver is first.solver
+    assert reuse_time < build_time / 10
+    # only the warm start follows the new initial state
+    assert np.array_equal(second.nlp_w0[:4], [1.0, 0.5, 0.0, 5.0])
+    assert np.array_equal(first.nlp_w0[:4], [0.0, 0.0, 0.0, 0.0])
+
+
+def test_solver_is_rebuilt_when_the_key_changes():
+    clear_solver_cache()
+    first, _ = build()
+    other = High_MPC(T=5.0, dt=0.1, L=4.79, vehicle_length=4.79, vehicle_width=2.16, lane_width=4.0)
+    assert other.solver is not first.solver
+
+
+def test_compiled_library_is_keyed_on_the_problem_and_reused(tmp_path):
+    mpc, _ = build(cache_dir=str(tmp_path))
+    x = ca.SX.sym("x", 2)
+    square = ca.Function("square", [x], [x**2])
+    so_path = mpc._compile(square, dependencies=False)
+    # only the library is kept, the generated C code is removed
+    assert os.listdir(str(tmp_path)) == [os.path.basename(so_path)]
+    assert ca.external("square", so_path)([1.0, 3.0]).full().ravel().tolist() == [1.0, 9.0]
+
+    class NoCodegen(object):
+        def name(self):
+            return "square"
+
+        def generate(self, cname):
+            raise AssertionError("a cache hit must not generate code")
+    assert mpc._compile(NoCodegen(), dependencies=False) == so_path
+    other = High_MPC(T=5.0, dt=0.1, L=4.79, vehicle_length=4.79, vehicle_width=2.16, lane_width=4.0, \
+                     cache_dir=str(tmp_path))
+    assert other._library_path("square") != so_path
+
+
+def test_env_reset_time_drops_after_the_first_episode():
+    clear_solver_cache()
+    env = gym.make('carla-kinematic-v0', params=PARAMS).unwrapped
+    env.seed(0)
+    start_time = time.perf_counter()
+    env.reset()
+    first_reset = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    env.reset()
+    second_reset = time.perf_counter() - start_time
+    assert second_reset < first_reset / 10
+
+
+def test_warm_start_shifts_primal_and_dual_by_one_stage():
+    s_dim, u_dim, N = 4, 2, 3
+    mpc, _ = build()
+    warm_start = WarmStart(s_dim, u_dim, N, mpc._F)
+    warm_start.reset([1.0, 2.0, 0.0, 5.0], [0.5, 0.1])
+    assert not warm_start.warm
+    n = s_dim + u_dim
+    w = np.arange(s_dim + n*N, dtype=float)
+    lam_x = -np.arange(len(w), dtype=float)
+    lam_g = np.arange(s_dim*(N+1), dtype=float) + 100
+    warm_start.update(w, lam_x, lam_g)
+    assert warm_start.warm
+    assert np.array_equal(warm_start.w0[:-n], w[n:])
+    # the tail repeats the last control and simulates the last state with it
+    u_last = w[-n:-s_dim]
+    assert np.array_equal(warm_start.w0[-n:-s_dim], u_last)
+    assert np.allclose(warm_start.w0[-s_dim:], mpc._F(w[-s_dim:], u_last).full().reshape(-1))
+    assert np.array_equal(warm_start.lam_x0, np.concatenate([lam_x[n:], lam_x[-n:]]))
+    assert np.array_equal(warm_start.lam_g0, np.concatenate([lam_g[s_dim:], lam_g[-s_dim:]]))
+
+
+def test_sqp_converges_to_the_ipopt_solution():
+    ipopt, _ = build(init_state=[0.0, 0.0, 0.0, 5.0])
+    sqp, _ = build(init_state=[0.0, 0.0, 0.0, 5.0], solver_mode='sqp')
+    state = [0.0, 0.0, 0.0, 5.0]
+    for tick in range(5):
+        ref = lane_change(state)
+        u_ipopt, x_ipopt = ipopt.solve(ref)
+        u_sqp, _ = sqp.solve(ref)
+        assert sqp.iter_count <= 20
+        np.testing.assert_allclose(u_sqp, u_ipopt, rtol=0, atol=1e-3)
+        assert abs(sqp.last_cost - ipopt.last_cost) <= 1e-5 * ipopt.last_cost
+        cost, converged_cost, violation = sqp.convergence_gap()
+        assert abs(cost - converged_cost) <= 1e-5 * converged_cost
+        assert violation <= 1e-6
+        state = x_ipopt[1, :4].tolist()
+
+
+def test_rti_tracks_the_ipopt_solution():
+    rti_max_du = (1.0, 0.1)
+    rti, _ = build(init_state=[0.0, 0.0, 0.0, 5.0], solver_mode='rti', rti_max_du=rti_max_du)
+    state = [0.0, 0.0, 0.0, 5.0]
+    for tick in range(10):
+        w0 = rti.warm_start.w0.copy()
+        _, x = rti.solve(lane_change(state))
+        cost, converged_cost, violation = rti.convergence_gap()
+        if tick == 0:
+            # the cold start is solved to convergence
+            assert rti.iter_count > 1
+            assert abs(cost - converged_cost) <= 1e-6 * converged_cost
+            assert violation <= 1e-5
+        else:
+            # one QP per tick, every control moves at most rti_max_du from the shifted solution
+            assert rti.iter_count == 1
+            du = np.abs(rti._last_x.reshape(-1)[4:].reshape(-1, 6)[:, :2] - w0[4:].reshape(-1, 6)[:, :2])
+            assert np.all(du <= np.array(rti_max_du) + 1e-9)
+            # within 0.1 % of the optimal cost, at a point that violates the dynamics by at most 0.1
+            assert abs(cost - converged_cost) <= 1e-3 * converged_cost
+            assert violation <= 0.1
+        state = x[1, :4].tolist()
+
+    # reset() starts cold again
+    rti.reset(state)
+    rti.solve(lane_change(state))
+    assert rti.iter_count > 1
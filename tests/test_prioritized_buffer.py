@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+from ReplayBuffer import PrioritizedBuffer
+from SegmentTree import SumSegmentTree, MinSegmentTree
+
+
+@pytest.mark.parametrize('capacity', [1, 13, 64])
+def test_segment_trees_match_numpy(capacity):
+	rng = np.random.default_rng(capacity)
+	sum_tree, min_tree = SumSegmentTree(capacity), MinSegmentTree(capacity)
+	leaves = np.zeros(capacity)
+	for step in range(50):
+		# batches with duplicated leaves, and single leaves as set by add()
+		ind = rng.integers(0, capacity, size=rng.integers(1, 2 * capacity + 1)) if step % 2 else [rng.integers(capacity)]
+		val = rng.uniform(0.1, 10, size=len(ind))
+		sum_tree[ind] = val
+		min_tree[ind] = val
+		# the last value written to a duplicated leaf is kept, as with numpy fancy indexing
+		leaves[ind] = val
+		assert sum_tree.sum() == pytest.approx(leaves.sum(), rel=1e-12)
+		assert min_tree.min() == leaves[leaves > 0].min()
+		np.testing.assert_array_equal(sum_tree[np.arange(capacity)], leaves)
+
+
+def test_find_prefixsum_idx_matches_the_cumulative_sum():
+	rng = np.random.default_rng(0)
+	# integer leaves, so that the sums up to the leaf boundaries are exact
+	leaves = rng.integers(1, 10, size=100).astype(np.float64)
+	tree = SumSegmentTree(len(leaves))
+	tree[np.arange(len(leaves))] = leaves
+	prefixsum = np.concatenate([rng.uniform(0, leaves.sum(), size=1000), np.cumsum(leaves)[:-1], [0.0]])
+	# the highest i with sum(leaves[:i]) <= prefixsum
+	expected = np.searchsorted(np.cumsum(leaves), prefixsum, side='right')
+	np.testing.assert_array_equal(tree.find_prefixsum_idx(prefixsum), expected)
+
+
+def filled_buffer(size, priorities):
+	buffer = PrioritizedBuffer(3, 2, True, max_size=size, beta_increment=0.0)
+	for i in range(size):
+		buffer.add(np.full(3, i), np.zeros(2), float(i), np.full(3, i + 1), False)
+	buffer.update_priorities(np.arange(size), priorities)
+	return buffer
+
+
+def test_sampling_is_proportional_to_priority_alpha():
+	np.random.seed(0)
+	priorities = np.arange(1, 17, dtype=np.float64)
+	buffer = filled_buffer(16, priorities)
+	counts = np.zeros(16)
+	for _ in range(2000):
+		s, a, r, s_prime, dead, weights, ind = buffer.sample(64)
+		# the rows are those of the sampled indices
+		np.testing.assert_array_equal(r.numpy().reshape(-1), ind)
+		counts += np.bincount(ind, minlength=16)
+	expected = (priorities + buffer.eps) ** buffer.alpha
+	np.testing.assert_allclose(counts / counts.sum(), expected / expected.sum(), rtol=0.02)
+
+
+def test_importance_sampling_weights():
+	np.random.seed(1)
+	priorities = np.random.uniform(0.1, 5, size=32)
+	buffer = filled_buffer(32, priorities)
+	*_, weights, ind = buffer.sample(256)
+	p = (priorities + buffer.eps) ** buffer.alpha
+	p = p / p.sum()
+	expected = (p * 32) ** (-buffer.beta) / ((p.min() * 32) ** (-buffer.beta))
+	np.testing.assert_allclose(weights.numpy().reshape(-1), expected[ind], rtol=1e-6)
+	assert weights.max() <= 1.0
+
+
+def test_update_priorities_sets_both_trees_and_the_priority_of_new_transitions():
+	buffer = filled_buffer(8, np.ones(8))
+	buffer.update_priorities(np.array([2, 5]), np.array([-3.0, 0.0]))
+	leaves = buffer.sum_tree[np.arange(8)]
+	assert leaves[2] == pytest.approx((3.0 + buffer.eps) ** buffer.alpha)
+	assert leaves[5] == pytest.approx(buffer.eps ** buffer.alpha)
+	assert buffer.min_tree.min() == pytest.approx(buffer.eps ** buffer.alpha)
+	assert buffer.sum_tree.sum() == pytest.approx(leaves.sum())
+	# a new transition overwrites the oldest slot with the highest priority seen
+	assert buffer.max_priority == pytest.approx(3.0 + buffer.eps)
+	buffer.add(np.zeros(3), np.zeros(2), 0.0, np.zeros(3), False)
+	assert buffer.sum_tree[0] == pytest.approx(buffer.max_priority ** buffer.alpha)
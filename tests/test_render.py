@@ -0,0 +1,34 @@
+import zipfile
+
+import numpy as np
+import pytest
+
+# MapImage needs the CARLA client and pygame, but no server for these tests
+render = pytest.importorskip('gym_carla.envs.render')
+
+
+@pytest.fixture
+def map_image():
+  return render.MapImage.__new__(render.MapImage)
+
+
+def test_load_missing_cache(map_image, tmp_path):
+  assert not map_image._load(str(tmp_path / 'missing.npz'))
+
+
+def test_load_corrupt_cache(map_image, tmp_path):
+  path = str(tmp_path / 'map.npz')
+  np.savez_compressed(path, surface=np.zeros((4, 4, 3), dtype=np.uint8), world_offset=np.zeros(2), \
+    width=1.0, pixels_per_meter=1.0)
+  with open(path, 'rb') as f:
+    data = f.read()
+
+  # truncated archive, without its central directory
+  with open(path, 'wb') as f:
+    f.write(data[:len(data) // 2])
+  assert not map_image._load(path)
+
+  # damaged member data
+  with zipfile.ZipFile(path, 'w') as zf:
+    zf.writestr('surface.npy', b'\x93NUMPY')
+  assert not map_image._load(path)
@@ -0,0 +1,209 @@
+import multiprocessing as mp
+import time
+
+import numpy as np
+import pytest
+import torch
+
+from ReplayBuffer import RandomBuffer, TensorBuffer, LinkedBuffer, MemmapBuffer, BatchPrefetcher, SharedBuffer
+
+
+def _write(buffer, worker, stop):
+	'''Add transitions whose every field holds the same number'''
+	step = 0
+	while not stop.is_set():
+		step += 1
+		x = float(worker * 1e6 + step)
+		buffer.add(np.full(64, x), np.full(2, x), x, np.full(64, x), False)
+	buffer.close()
+
+
+def test_shared_buffer_sample_is_never_torn():
+	ctx = mp.get_context('spawn')
+	# a small ring, so the actors overwrite the slots being sampled all the time
+	buffer = SharedBuffer(64, 2, True, max_size=64, ctx=ctx)
+	stop = ctx.Event()
+	actors = [ctx.Process(target=_write, args=(buffer, worker, stop)) for worker in range(2)]
+	for actor in actors:
+		actor.start()
+	try:
+		while buffer.size < buffer.max_size:
+			time.sleep(0.01)
+		end = time.perf_counter() + 1.0
+		while time.perf_counter() < end:
+			s, a, r, s_prime, dead = buffer.sample(32)
+			assert (s == r).all() and (a == r).all() and (s_prime == r).all()
+	finally:
+		stop.set()
+		for actor in actors:
+			actor.join()
+		buffer.unlink()
+
+
+def test_shared_buffer_state_dict_is_never_torn():
+	ctx = mp.get_context('spawn')
+	buffer = SharedBuffer(64, 2, True, max_size=64, ctx=ctx)
+	stop = ctx.Event()
+	actors = [ctx.Process(target=_write, args=(buffer, worker, stop)) for worker in range(2)]
+	for actor in actors:
+		actor.start()
+	try:
+		while buffer.size < buffer.max_size:
+			time.sleep(0.01)
+		end = time.perf_counter() + 1.0
+		while time.perf_counter() < end:
+			state = buffer.state_dict()
+			r = state['reward']
+			assert len(r) == buffer.max_size
+			assert (state['state'] == r).all() and (state['action'] == r).all() and (state['next_state'] == r).all()
+	finally:
+		stop.set()
+		for actor in actors:
+			actor.join()
+		buffer.unlink()
+
+
+def test_linked_buffer_rebuilds_the_transitions_of_random_buffer():
+	rng = np.random.default_rng(0)
+	torch.manual_seed(0)
+	# a ring of 16 slots takes some 300 transitions of episodes of 1 to 6 steps
+	linked = LinkedBuffer(3, 2, True, max_size=16)
+	reference = RandomBuffer(3, 2, True, max_size=1000)
+	for episode in range(100):
+		length, dead = rng.integers(1, 7), rng.random() < 0.5
+		for t in range(length):
+			s, s_prime = np.array([episode, t, 0.0]), np.array([episode, t + 1, 0.0])
+			args = (s, np.array([episode, t]), 100.0 * episode + t, s_prime, dead and t == length - 1)
+			linked.add(*args)
+			reference.add(*args)
+	# the transitions of a slot are identified by their reward
+	rows = {float(reference.reward[i, 0]): i for i in range(reference.size)}
+
+	def assert_rows_match(s, a, r, s_prime, dead):
+		ind = [rows[float(reward)] for reward in r.reshape(-1)]
+		np.testing.assert_array_equal(s, reference.state[ind])
+		np.testing.assert_array_equal(a, reference.action[ind])
+		np.testing.assert_array_equal(s_prime, reference.next_state[ind])
+		np.testing.assert_array_equal(dead, reference.dead[ind])
+
+	# the slots hold the latest transitions, s' taken from the next slot across the ring wrap
+	valid = np.flatnonzero(linked.valid)
+	assert len(valid) == linked.size and linked.size < linked.max_size
+	assert_rows_match(linked.obs[valid], linked.action[valid], linked.reward[valid], \
+					  linked.obs[(valid + 1) % linked.max_size], linked.dead[valid])
+	assert sorted(rows[float(r)] for r in linked.reward[valid, 0]) == list(range(reference.size - linked.size, reference.size))
+	for _ in range(50):
+		assert_rows_match(*(x.numpy() for x in linked.sample(32)))
+
+
+@pytest.mark.parametrize('buffer_class', [RandomBuffer, TensorBuffer])
+@pytest.mark.parametrize('n_step', [2, 3, 5])
+def test_n_step_transitions_match_brute_force(buffer_class, n_step):
+	rng = np.random.default_rng(n_step)
+	gamma = 0.9
+	buffer = buffer_class(2, 1, True, max_size=1000, n_step=n_step, gamma=gamma)
+	expected = []
+	for episode in range(40):
+		# episodes shorter and longer than n, ending dead or truncated (done) anywhere in the window
+		length, dead_end = rng.integers(1, 3 * n_step), rng.random() < 0.5
+		states = [np.array([episode, t], dtype=np.float32) for t in range(length + 1)]
+		rewards = rng.standard_normal(length).astype(np.float32)
+		for t in range(length):
+			last = t == length - 1
+			buffer.add(states[t], np.array([t]), rewards[t], states[t + 1], dead_end and last, done=last)
+		for k in range(length):
+			m = min(n_step, length - k)
+			ret = sum(gamma ** i * float(rewards[k + i]) for i in range(m))
+			expected.append((states[k], ret, states[k + m], dead_end and k + m == length, gamma ** m))
+	assert buffer.size == len(expected)
+	s, r, s_prime, dead, discount = (np.array(column) for column in zip(*expected))
+	np.testing.assert_array_equal(buffer.state[:buffer.size], s)
+	np.testing.assert_allclose(buffer.reward[:buffer.size, 0], r, rtol=1e-5, atol=1e-5)
+	np.testing.assert_array_equal(buffer.next_state[:buffer.size], s_prime)
+	np.testing.assert_array_equal(buffer.dead[:buffer.size, 0], dead)
+	np.testing.assert_allclose(buffer.discount[:buffer.size, 0], discount, rtol=1e-6)
+
+	# sample() returns the discount of every transition as a sixth column
+	batch = [x.numpy() for x in buffer.sample(64)]
+	assert len(batch) == 6
+	rows = {tuple(state): i for i, state in enumerate(s)}
+	ind = [rows[tuple(state)] for state in batch[0]]
+	np.testing.assert_allclose(batch[5].reshape(-1), discount[ind], rtol=1e-6)
+
+
+class FailingBuffer(RandomBuffer):
+	def sample(self, batch_size):
+		raise ValueError('sampling failed')
+
+
+def test_prefetcher_raises_the_error_of_its_thread():
+	buffer = BatchPrefetcher(FailingBuffer(4, 2, True, max_size=16), batch_size=8, K=2)
+	for _ in range(2):
+		with pytest.raises(ValueError, match='sampling failed'):
+			buffer.sample(8)
+	buffer.close()
+
+
+def test_prefetcher_samples_from_its_thread():
+	buffer = BatchPrefetcher(RandomBuffer(4, 2, True, max_size=16), batch_size=8, K=2)
+	for i in range(16):
+		buffer.add(np.full(4, i), np.zeros(2), float(i), np.full(4, i + 1), False)
+	s, a, r, s_prime, dead = buffer.sample(8)
+	assert s.shape == (8, 4) and (s[:, 0] == r[:, 0]).all()
+	buffer.close()
+
+
+def add_numbered(buffer, first, count):
+	'''Add transitions whose fields hold their number'''
+	for i in range(first, first + count):
+		buffer.add(np.full(4, i), np.full(2, i), float(i), np.full(4, i), False)
+
+
+def assert_samples_from(buffer, valid):
+	'''Every sampled transition is one of the numbered ones in valid'''
+	for _ in range(20):
+		s, a, r, s_prime, dead = buffer.sample(64)
+		assert (s[:, 0] == r[:, 0]).all() and (s_prime[:, 0] == r[:, 0]).all()
+		assert set(r[:, 0].int().tolist()) <= valid
+
+
+def test_memmap_buffer_reopens_without_the_slots_written_after_save(tmp_path):
+	buffer = MemmapBuffer(4, 2, True, max_size=100, buffer_dir=str(tmp_path))
+	buffer.reserve_slots = 10
+	add_numbered(buffer, 0, 150)
+	buffer.save()
+	# a crash after 25 more transitions, which may or may not have reached the files
+	add_numbered(buffer, 150, 25)
+	buffer.state.flush()
+	buffer.reward.flush()
+	del buffer
+
+	reopened = MemmapBuffer(4, 2, True, max_size=100, buffer_dir=str(tmp_path))
+	# the 30 slots announced after the save are dropped, the rest holds saved transitions
+	assert reopened.size == 70 and reopened.ptr == 50
+	assert_samples_from(reopened, set(range(80, 150)))
+	# new transitions fill the dropped slots first
+	add_numbered(reopened, 1000, 30)
+	assert reopened.size == 100
+	assert_samples_from(reopened, set(range(80, 150)) | set(range(1000, 1030)))
+
+
+def test_memmap_buffer_load_state_dict_drops_the_slots_written_since(tmp_path):
+	buffer = MemmapBuffer(4, 2, True, max_size=100, buffer_dir=str(tmp_path))
+	buffer.reserve_slots = 10
+	add_numbered(buffer, 0, 60)
+	state = buffer.state_dict()
+	add_numbered(buffer, 60, 30)
+	buffer.load_state_dict(state)
+	# the slots written since were free at the state
+	assert buffer.size == 60 and buffer.ptr == 60
+	assert_samples_from(buffer, set(range(60)))
+
+	add_numbered(buffer, 60, 70)
+	state = buffer.state_dict()
+	add_numbered(buffer, 130, 20)
+	del buffer
+	reopened = MemmapBuffer(4, 2, True, max_size=100, buffer_dir=str(tmp_path))
+	reopened.load_state_dict(state)
+	assert reopened.size == 80 and reopened.ptr == 30
+	assert_samples_from(reopened, set(range(50, 130)))
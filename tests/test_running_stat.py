@@ -0,0 +1,65 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from RunningStat import RunningStat, ZFilter
+
+
+def test_merged_shards_match_the_concatenation():
+    rng = np.random.default_rng(0)
+    # a large offset, where the naive sum of squares loses precision
+    data = rng.standard_normal((1000, 3)) * [1.0, 10.0, 0.1] + 1e4
+    shards = np.split(data, [0, 1, 7, 300, 301, 640])
+    stats = []
+    for i, shard in enumerate(shards):
+        rs = RunningStat((3,))
+        if i % 2:
+            for x in shard:
+                rs.push(x)
+        else:
+            rs.push_batch(shard)
+        stats.append(rs)
+    merged = RunningStat((3,))
+    for rs in stats:
+        merged.merge(rs)
+    assert merged.n == len(data)
+    np.testing.assert_allclose(merged.mean, data.mean(axis=0), rtol=1e-12)
+    np.testing.assert_allclose(merged.var, data.var(axis=0, ddof=1), rtol=1e-9)
+    np.testing.assert_allclose(merged.std, data.std(axis=0, ddof=1), rtol=1e-9)
+
+    # the same as pushing every observation
+    pushed = RunningStat((3,))
+    for x in data:
+        pushed.push(x)
+    np.testing.assert_allclose(merged.var, pushed.var, rtol=1e-9)
+
+
+def test_std_follows_the_updates():
+    rs = RunningStat((2,))
+    rs.push_batch(np.array([[0.0, 0.0], [2.0, 4.0]]))
+    np.testing.assert_allclose(rs.std, np.sqrt([2.0, 8.0]))
+    rs.push(np.array([4.0, 8.0]))
+    np.testing.assert_allclose(rs.std, [2.0, 4.0])
+    # pickled without the cache, which is rebuilt
+    clone = pickle.loads(pickle.dumps(rs))
+    np.testing.assert_array_equal(clone.std, rs.std)
+    clone.push(np.array([6.0, 12.0]))
+    assert clone.n == 4 and rs.n == 3
+
+
+@pytest.mark.parametrize('clip', [10.0, None])
+def test_zfilter_save_load_round_trip(tmp_path, clip):
+    rng = np.random.default_rng(1)
+    zfilter = ZFilter((4,), destd=False, clip=clip)
+    for x in rng.standard_normal((50, 4)) * 3 + 1:
+        zfilter(x)
+    path = str(tmp_path / 'running_state.npz')
+    zfilter.save(path)
+    loaded = ZFilter.load(path)
+    assert loaded.rs.n == zfilter.rs.n
+    np.testing.assert_array_equal(loaded.rs.mean, zfilter.rs.mean)
+    np.testing.assert_array_equal(loaded.rs.var, zfilter.rs.var)
+    assert (loaded.demean, loaded.destd, bool(loaded.clip)) == (zfilter.demean, zfilter.destd, bool(zfilter.clip))
+    x = rng.standard_normal(4) * 50
+    np.testing.assert_array_equal(loaded(x, update=False), zfilter(x, update=False))
@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+import torch
+
+from SAC import SAC_Agent, Actor, Q_Critic, Ensemble_Q_Critic
+
+
+def copy_critic(ensemble, critic):
+	'''Load the weights of the two nets of a Q_Critic into a two-critic Ensemble_Q_Critic'''
+	nets = [[m for m in net if isinstance(m, torch.nn.Linear)] for net in (critic.Q_1, critic.Q_2)]
+	with torch.no_grad():
+		for j, (weight, bias) in enumerate(zip(ensemble.weights, ensemble.biases)):
+			weight.copy_(torch.stack([net[j].weight.t() for net in nets]))
+			bias.copy_(torch.stack([net[j].bias.reshape(1, -1) for net in nets]))
+
+
+def random_batch(batch_size, state_dim=5, action_dim=2):
+	return (torch.randn(batch_size, state_dim), torch.rand(batch_size, action_dim) * 2 - 1, torch.randn(batch_size, 1), \
+			torch.randn(batch_size, state_dim), (torch.rand(batch_size, 1) < 0.2).float())
+
+
+def test_two_critic_ensemble_matches_q_critic():
+	torch.manual_seed(0)
+	critic = Q_Critic(5, 2, (16, 16))
+	ensemble = Ensemble_Q_Critic(5, 2, (16, 16), num_critics=2)
+	copy_critic(ensemble, critic)
+	s, a = random_batch(32)[:2]
+	q1, q2 = critic(s, a)
+	torch.testing.assert_close(ensemble(s, a), torch.stack([q1, q2]), rtol=1e-6, atol=1e-6)
+
+	# the agents then compute the same clipped double Q loss, TD errors and gradients
+	agent = SAC_Agent(5, 2, hid_shape=(16, 16))
+	ensemble_agent = SAC_Agent(5, 2, hid_shape=(16, 16), ensemble_critic=True)
+	ensemble_agent.actor.load_state_dict(agent.actor.state_dict())
+	copy_critic(ensemble_agent.q_critic, agent.q_critic)
+	copy_critic(ensemble_agent.q_critic_target, agent.q_critic_target)
+	s, a, r, s_prime, dead = random_batch(64)
+	losses = []
+	for sac in (agent, ensemble_agent):
+		torch.manual_seed(1)
+		q_loss, td_errors = sac._critic_loss(s, a, r, s_prime, dead, 0.99, None, 0.2)
+		q_loss.backward()
+		losses.append((q_loss, td_errors))
+	torch.testing.assert_close(losses[1][0], losses[0][0])
+	torch.testing.assert_close(losses[1][1], losses[0][1])
+	nets = [[m for m in net if isinstance(m, torch.nn.Linear)] for net in (agent.q_critic.Q_1, agent.q_critic.Q_2)]
+	for j, weight in enumerate(ensemble_agent.q_critic.weights):
+		torch.testing.assert_close(weight.grad, torch.stack([net[j].weight.grad.t() for net in nets]), rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize('critic_subset', [2, 5])
+def test_target_is_the_min_of_a_random_critic_subset(critic_subset):
+	torch.manual_seed(0)
+	agent = SAC_Agent(5, 2, hid_shape=(16, 16), ensemble_critic=True, num_critics=5, critic_subset=critic_subset)
+	# constant critics: the target ones return 1, ..., 5, the trained ones 0
+	with torch.no_grad():
+		for critic in (agent.q_critic, agent.q_critic_target):
+			critic.weights[-1].zero_()
+			critic.biases[-1].zero_()
+		agent.q_critic_target.biases[-1][:, 0, 0] = torch.arange(1.0, 6.0)
+	s, a, _, s_prime, _ = random_batch(8)
+	targets = []
+	for _ in range(2000):
+		# no reward, no entropy term, so |TD error| is the min of the target critics drawn
+		_, td_errors = agent._critic_loss(s, a, torch.zeros(8, 1), s_prime, torch.zeros(8, 1), 1.0, None, 0.0)
+		# one subset for the whole batch
+		assert (td_errors == td_errors[0]).all()
+		targets.append(float(td_errors[0]))
+	frequencies = np.bincount(np.array(targets, dtype=int), minlength=6)[1:] / len(targets)
+	if critic_subset == 5:
+		np.testing.assert_array_equal(frequencies, [1, 0, 0, 0, 0])
+	else:
+		# P(min of 2 of 5 = k) = (5 - k) / 10
+		np.testing.assert_allclose(frequencies, [0.4, 0.3, 0.2, 0.1, 0.0], atol=0.03)
+
+
+@pytest.mark.parametrize('h_acti', [torch.nn.LeakyReLU, torch.nn.ReLU])
+def test_numpy_policy_matches_the_deterministic_select_action(h_acti):
+	torch.manual_seed(0)
+	agent = SAC_Agent(77, 8)
+	agent.actor = Actor(77, 8, (256, 256), h_acti=h_acti, o_acti=h_acti)
+	policy = agent.export_policy()
+	rng = np.random.default_rng(0)
+	for _ in range(100):
+		state = rng.standard_normal(77) * 10
+		np.testing.assert_allclose(policy(state), agent.select_action(state, deterministic=True), rtol=1e-5, atol=1e-6)
+
+
+def test_numpy_policy_rejects_other_activations():
+	agent = SAC_Agent(5, 2, hid_shape=(16, 16))
+	agent.actor.a_net[1] = torch.nn.Tanh()
+	with pytest.raises(ValueError, match='Tanh'):
+		agent.export_policy()
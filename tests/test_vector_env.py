@@ -0,0 +1,43 @@
+import gym
+import numpy as np
+
+import gym_carla
+from test_high_mpc import PARAMS, lane_change
+
+
+def test_seeded_vector_env_draws_the_scenarios_of_the_single_env():
+    single = gym.make('carla-kinematic-v0', params=PARAMS).unwrapped
+    vector = gym.make('carla-vector-v0', params=dict(PARAMS, num_envs=1)).unwrapped
+    single.seed(3)
+    vector.seed(3)
+    obs = single.reset()
+    vector_obs = vector.reset()
+    np.testing.assert_array_equal(vector.agent_s[0], single.agent_s)
+    np.testing.assert_array_equal(vector.agent_d[0], single.agent_d)
+    np.testing.assert_array_equal(vector.agent_speed_des[0], single.agent_speed_des)
+    np.testing.assert_allclose(vector_obs[0], obs)
+
+
+def test_detector_sees_the_agent_ahead():
+    env = gym.make('carla-kinematic-v0', params=PARAMS).unwrapped
+    env.ego_array = np.array([0.0, 0.0, 0.0, 5.0])
+    env.agent_s = np.array([20.0, 100.0])
+    env.agent_d = np.array([0.0, 3.5])
+    distances = env._detector_distances()
+    # the middle beam points along the ego heading, at the rear of the first agent
+    assert distances[env.detector_num // 2] == 20.0 - env.vehicle_length/2
+    assert distances[0] == distances[-1] == env.detect_range
+
+
+def test_solve_mpc_warm_starts_from_the_terminal_state_of_the_solution():
+    env = gym.make('carla-vector-v0', params=dict(PARAMS, num_envs=2)).unwrapped
+    env.seed(0)
+    env.reset()
+    mpc = env.high_mpcs[0]
+    ref_trajs = [lane_change(state) for state in env.ego_state]
+    w0 = [high_mpc.warm_start.w0.copy() for high_mpc in env.high_mpcs]
+    _, _, x_N = mpc.solve_batch(ref_trajs, x0_list=w0)
+    env.solve_mpc(ref_trajs)
+    for i, high_mpc in enumerate(env.high_mpcs):
+        # the shifted warm start ends with the terminal state of the solution and the padded stage
+        np.testing.assert_array_equal(high_mpc.warm_start.w0[-10:-6], x_N[i])